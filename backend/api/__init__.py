@@ -1,8 +1,12 @@
-from api import metric, repo, statictics, system
+from api import metric, queue, repo, statictics, system, webhook
 from api.exception import client_failure_handler, server_failure_handler
 from api.helpers.response import FailServerResponse
 from exception import ClientFailure, ServerFailure
 from fastapi import FastAPI, status
+from service.metric_buffer import start_metric_update_buffer, stop_metric_update_buffer
+from service.metric_udp import start_metric_udp_listener, stop_metric_udp_listener
+from service.run_config_cache import start_run_config_invalidation_listener
+from service.run_queue import start_run_dispatcher
 
 
 def init_api() -> FastAPI:
@@ -26,8 +30,17 @@ def init_api() -> FastAPI:
     app.include_router(repo.router)
     app.include_router(metric.router)
     app.include_router(statictics.router)
+    app.include_router(queue.router)
+    app.include_router(webhook.router)
 
     app.exception_handler(ClientFailure)(client_failure_handler)
     app.exception_handler(ServerFailure)(server_failure_handler)
 
+    app.on_event("startup")(start_run_config_invalidation_listener)
+    app.on_event("startup")(start_metric_update_buffer)
+    app.on_event("startup")(start_metric_udp_listener)
+    app.on_event("startup")(start_run_dispatcher)
+    app.on_event("shutdown")(stop_metric_udp_listener)
+    app.on_event("shutdown")(stop_metric_update_buffer)
+
     return app
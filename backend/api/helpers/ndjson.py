@@ -0,0 +1,41 @@
+from typing import AsyncIterator, Optional
+
+import pydantic
+from exception import ClientFailure
+from model import ClientMetricsUpdate
+
+
+def parse_metric_update_line(line: bytes, line_number: int) -> Optional[ClientMetricsUpdate]:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return ClientMetricsUpdate.parse_raw(line)
+    except pydantic.ValidationError as e:
+        raise ClientFailure(f"invalid metric update on line {line_number}: {e}")
+
+
+async def iter_ndjson_metric_updates(
+    stream: AsyncIterator[bytes], chunk_size: int
+) -> AsyncIterator[list[ClientMetricsUpdate]]:
+    """Reads NDJSON body and yields parsed updates in chunks of at most chunk_size"""
+    tail = b""
+    line_number = 0
+    chunk = []
+
+    async for data in stream:
+        *lines, tail = (tail + data).split(b"\n")
+        for line in lines:
+            line_number += 1
+            update = parse_metric_update_line(line, line_number)
+            if update is not None:
+                chunk.append(update)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+    update = parse_metric_update_line(tail, line_number + 1)
+    if update is not None:
+        chunk.append(update)
+    if chunk:
+        yield chunk
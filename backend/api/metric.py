@@ -1,27 +1,70 @@
-from db import local_session
+import os
+
+from api.helpers.ndjson import iter_ndjson_metric_updates
+from db import async_local_session
 from fastapi import APIRouter, Request, status
 from model import ClientMetricsConfig, ClientMetricsUpdate
-from service.metric import add_metric_update, save_metrics_config
+from service.metric import (
+    add_metric_update,
+    add_metric_updates,
+    apply_metric_updates,
+    get_cached_run_config_by_client_ip,
+    save_metrics_config,
+)
 
 router = APIRouter(
     prefix="/metric",
     tags=["Operating metrics"],
 )
 
+stream_chunk_size = int(os.getenv("METRIC_STREAM_CHUNK_SIZE", "1000"))
+
 
 @router.post(
     "/init",
     status_code=status.HTTP_200_OK,
 )
-def init_metrics_for_session(request: Request, metrics: ClientMetricsConfig):
-    with local_session() as session:
-        save_metrics_config(metrics, request.client.host, session)
+async def init_metrics_for_session(request: Request, metrics: ClientMetricsConfig):
+    async with async_local_session() as session:
+        await save_metrics_config(metrics, request.client.host, session)
 
 
 @router.post(
     "/update",
     status_code=status.HTTP_200_OK,
 )
-def update_metrics_for_session(request: Request, metrics: ClientMetricsUpdate):
-    with local_session() as session:
-        add_metric_update(metrics, request.client.host, session)
+async def update_metrics_for_session(request: Request, metrics: ClientMetricsUpdate):
+    async with async_local_session() as session:
+        await add_metric_update(metrics, request.client.host, session)
+
+
+@router.post(
+    "/update/batch",
+    status_code=status.HTTP_200_OK,
+)
+async def update_metrics_batch_for_session(
+    request: Request, metrics: list[ClientMetricsUpdate]
+):
+    async with async_local_session() as session:
+        await add_metric_updates(metrics, request.client.host, session)
+
+
+@router.post(
+    "/update/stream",
+    status_code=status.HTTP_200_OK,
+)
+async def update_metrics_stream_for_session(request: Request):
+    """Accepts NDJSON body, one ClientMetricsUpdate per line.
+
+    Run config is resolved once, updates are written in chunks of METRIC_STREAM_CHUNK_SIZE,
+    so chunks before an invalid line stay saved.
+    """
+    async with async_local_session() as session:
+        run_config = await get_cached_run_config_by_client_ip(
+            request.client.host, session
+        )
+
+        async for chunk in iter_ndjson_metric_updates(
+            request.stream(), stream_chunk_size
+        ):
+            await apply_metric_updates(chunk, run_config, session)
@@ -0,0 +1,15 @@
+from api.helpers.auth import CookieAuthMiddlewareRoute
+from fastapi import APIRouter, Request, status
+from model import RunQueueStats
+from service.run_queue import get_run_queue_stats
+
+router = APIRouter(
+    prefix="/queue",
+    tags=["Run queue"],
+    route_class=CookieAuthMiddlewareRoute,
+)
+
+
+@router.get("", status_code=status.HTTP_200_OK, response_model=RunQueueStats)
+def get_queue_stats(request: Request):
+    return get_run_queue_stats(request.state.account.id, request.state.session)
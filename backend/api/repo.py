@@ -48,6 +48,16 @@ def update_repo(request: Request, body: RepoWrite, repo_id: str):
     )
 
 
+@router.post(
+    "/{repo_id}/webhook-secret",
+    status_code=status.HTTP_200_OK,
+    response_model=Repo,
+)
+def rotate_webhook_secret(request: Request, repo_id: str):
+    """New secret of the github webhook of the repo, deliveries signed with the old one are rejected"""
+    return repo_service.rotate_webhook_secret(repo_id, request.state.account, request.state.session)
+
+
 @router.delete(
     "/{repo_id}",
     status_code=status.HTTP_200_OK,
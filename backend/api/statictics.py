@@ -1,9 +1,12 @@
-import sqlmodel
-from sqlalchemy import or_
+import datetime
+from typing import Optional
 
 from api.helpers.auth import CookieAuthMiddlewareRoute
-from fastapi import APIRouter, Request, status
-from model import Commit, Repo
+from exception import ClientFailure
+from fastapi import APIRouter, Query, Request, Response, status
+from model import LogStreamEnum, MetricChangePoint, MetricSeries, Repo
+from service import statistics as statistics_service
+from service.commit_log import read_commit_log
 
 router = APIRouter(
     prefix="/statistics",
@@ -12,16 +15,110 @@ router = APIRouter(
 )
 
 
-@router.get("/{repo_id}", status_code=status.HTTP_200_OK, response_model=list[Commit])
-def get_commits(request: Request, repo_id: int):
-    repo = request.state.session.get(Repo, repo_id)
-    commits = request.state.session.exec(
-        sqlmodel.select(Commit).where(
-            or_(*[Commit.branch_id == b.id for b in repo.branches]),
-        )
-    ).all()
+@router.get("/{repo_id}", status_code=status.HTTP_200_OK, response_model=list[dict])
+def get_commits(
+    request: Request,
+    response: Response,
+    repo_id: int,
+    fields: Optional[str] = Query(
+        default=None, description=f"comma separated, any of: {', '.join(statistics_service.default_fields)}"
+    ),
+    branch: Optional[str] = None,
+    since: Optional[datetime.datetime] = Query(default=None, description="committed at or after"),
+    until: Optional[datetime.datetime] = Query(default=None, description="committed before"),
+    commit_status: Optional[statistics_service.CommitStatusEnum] = Query(default=None, alias="status"),
+    limit: int = Query(default=100, ge=1, le=statistics_service.max_page_size),
+    cursor: Optional[str] = None,
+):
+    """Commits from newest to oldest, the next page is requested with cursor from X-Next-Cursor or Link header"""
+    commits, next_cursor = statistics_service.get_commits_page(
+        repo_id,
+        request.state.account,
+        request.state.session,
+        fields=fields.split(",") if fields else None,
+        branch=branch,
+        since=since,
+        until=until,
+        commit_status=commit_status,
+        limit=limit,
+        cursor=cursor,
+    )
 
-    for c in commits:
-        _ = c.branch
+    if next_cursor is not None:
+        next_url = request.url.include_query_params(cursor=next_cursor)
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
 
     return commits
+
+
+@router.get("/{repo_id}/series", status_code=status.HTTP_200_OK, response_model=MetricSeries)
+def get_metric_series(
+    request: Request,
+    repo_id: int,
+    metric: str,
+    branch: Optional[str] = None,
+    points: Optional[int] = Query(default=None, ge=2, description="downsample to about this many points"),
+    method: statistics_service.DownsampleMethodEnum = statistics_service.DownsampleMethodEnum.lttb,
+):
+    return statistics_service.get_metric_series(
+        repo_id,
+        request.state.account,
+        request.state.session,
+        metric,
+        branch=branch,
+        points=points,
+        method=method,
+    )
+
+
+@router.get("/{repo_id}/change-points", status_code=status.HTTP_200_OK, response_model=list[MetricChangePoint])
+def get_change_points(
+    request: Request,
+    repo_id: int,
+    metric: Optional[str] = None,
+    branch: Optional[str] = None,
+    since: Optional[datetime.datetime] = Query(default=None, description="committed at or after"),
+    limit: int = Query(default=100, ge=1, le=statistics_service.max_page_size),
+):
+    """Commits from which a metric shifted, with the shift relative to the preceding values"""
+    return statistics_service.get_change_points(
+        repo_id,
+        request.state.account,
+        request.state.session,
+        metric=metric,
+        branch=branch,
+        since=since,
+        limit=limit,
+    )
+
+
+@router.get("/{repo_id}/logs/{sha}/{stream}", status_code=status.HTTP_200_OK)
+def get_commit_log(
+    request: Request,
+    repo_id: int,
+    sha: str,
+    stream: LogStreamEnum,
+    offset: int = Query(default=0, ge=0),
+    length: Optional[int] = Query(default=None, ge=0),
+    tail: Optional[int] = Query(default=None, ge=0, description="last bytes of the log, overrides offset"),
+):
+    """Captured container output of the commit run, whole or a byte range of it"""
+    repo = request.state.session.get(Repo, repo_id)
+    if repo is None or repo.account_id != request.state.account.id:
+        raise ClientFailure("no repo with such ID")
+
+    data, start, end, log = read_commit_log(
+        repo_id, sha, stream, request.state.session, offset=offset, length=length, tail=tail
+    )
+    partial = start > 0 or end < log.size
+    return Response(
+        content=data,
+        media_type="text/plain; charset=utf-8",
+        status_code=status.HTTP_206_PARTIAL_CONTENT if partial else status.HTTP_200_OK,
+        headers={
+            "Content-Range": f"bytes {start}-{max(end - 1, start)}/{log.size}",
+            "X-Log-Total-Size": str(log.total_size),
+            "X-Log-Truncated": str(log.truncated).lower(),
+        },
+    )
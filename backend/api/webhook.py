@@ -0,0 +1,23 @@
+from typing import Optional
+
+from fastapi import APIRouter, Header, Request, status
+from service.webhook import handle_github_event
+from starlette.concurrency import run_in_threadpool
+
+router = APIRouter(
+    prefix="/webhook",
+    tags=["Receiving git hosting webhooks"],
+)
+
+
+@router.post("/github", status_code=status.HTTP_200_OK)
+async def github_webhook(
+    request: Request,
+    x_github_event: str = Header(),
+    x_hub_signature_256: Optional[str] = Header(default=None),
+):
+    """Push events of repos, signed with Repo.webhook_secret set as the secret of the github webhook"""
+    # the signature covers the exact bytes, so the body is read before any parsing
+    body = await request.body()
+    repos = await run_in_threadpool(handle_github_event, x_github_event, body, x_hub_signature_256)
+    return {"repos": repos}
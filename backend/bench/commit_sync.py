@@ -0,0 +1,202 @@
+"""Commit sync of a poll: the set-based pipeline against the previous per-row one.
+
+Run against a development database, for example inside the server container:
+
+    python -m bench.commit_sync --branches 40 --commits 5000 --branch-commits 50 --new-commits 5
+
+A synthetic repo has a main line of --commits commits and --branches branches forked from random points of
+it, each with --branch-commits own commits. Every algorithm syncs its own copy of the repo twice: an initial
+sync of the whole history and an incremental one after every branch got --new-commits commits. Commits come
+from an in-memory client, so only the database side is measured: time and number of executed statements.
+The previous algorithm selects every branch, inserts commits one by one, commits per branch and filters
+queued shas with NOT IN. Everything the benchmark creates is removed at the end.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import sqlmodel
+from db import engine, local_session
+from model import Account, Branch, Commit, Repo, RunQueueEntry
+from service.commit import get_commits_to_run
+from service.repo import sync_branch_commits
+from sqlalchemy import delete, event
+from sqlalchemy.dialects.postgresql import insert
+
+
+class SyntheticGitClient:
+    """Branch heads and histories of a generated repo, histories are lists of commits from oldest to newest.
+
+    Commits are created along with the histories, so fetching them costs nothing in the measurement.
+    """
+
+    def __init__(self, branches: int, commits: int, branch_commits: int):
+        self.started = datetime(2020, 1, 1)
+        self.next_sha = 0
+        main = self._new_commits([], commits)
+        self.histories = {"main": main}
+        for i in range(branches - 1):
+            fork = random.randrange(1, len(main) + 1)
+            self.histories[f"branch-{i}"] = self._new_commits(main[:fork], branch_commits)
+
+    def _new_commits(self, history: list[Commit], count: int) -> list[Commit]:
+        new = []
+        for _ in range(count):
+            self.next_sha += 1
+            new.append(
+                Commit(
+                    sha=f"{self.next_sha:040x}",
+                    committed_datetime=self.started + timedelta(minutes=self.next_sha),
+                    message="bench",
+                )
+            )
+        return history + new
+
+    def push(self, new_commits: int):
+        for name, history in self.histories.items():
+            self.histories[name] = self._new_commits(history, new_commits)
+
+    def get_repo_branches_if_changed(self, repo: Repo) -> list[Branch]:
+        return [Branch(name=name, sha=h[-1].sha, repo_id=repo.id) for name, h in self.histories.items()]
+
+    def get_branch_commits(self, repo: Repo, branch: Branch, known_sha: Optional[str] = None) -> list[Commit]:
+        history = self.histories[branch.name]
+        shas = [c.sha for c in history]
+        start = shas.index(known_sha) + 1 if known_sha in shas else 0
+        return history[start:]
+
+
+def sync_per_row(repo: Repo, git_client: SyntheticGitClient, branches: list[Branch], session) -> list[Commit]:
+    for remote_branch in branches:
+        branch = session.exec(
+            sqlmodel.select(Branch).where(Branch.repo_id == repo.id, Branch.name == remote_branch.name)
+        ).first()
+        if branch is not None and branch.sha == remote_branch.sha:
+            continue
+
+        if branch is None:
+            known_sha = None
+            branch = Branch(name=remote_branch.name, sha=remote_branch.sha, repo_id=repo.id)
+        else:
+            known_sha = branch.sha
+            branch.sha = remote_branch.sha
+        session.add(branch)
+        session.flush()
+
+        for commit in git_client.get_branch_commits(repo, branch, known_sha=known_sha):
+            session.exec(
+                insert(Commit)
+                .values(
+                    sha=commit.sha,
+                    committed_datetime=commit.committed_datetime,
+                    message=commit.message,
+                    branch_id=branch.id,
+                )
+                .on_conflict_do_nothing(constraint="branch_id_sha_constraint")
+            )
+        session.commit()
+
+    queued_shas = (
+        sqlmodel.select(Commit.sha)
+        .join(RunQueueEntry, RunQueueEntry.commit_id == Commit.id)
+        .where(RunQueueEntry.repo_id == repo.id)
+    )
+    return session.exec(
+        sqlmodel.select(Commit)
+        .distinct(Commit.sha)
+        .where(
+            Commit.processed == False,
+            Commit.branch_id.in_(sqlmodel.select(Branch.id).where(Branch.repo_id == repo.id)),
+            Commit.sha.not_in(queued_shas),
+        )
+        .order_by(Commit.sha, Commit.id)
+    ).all()
+
+
+def sync_set_based(repo: Repo, git_client: SyntheticGitClient, branches: list[Branch], session) -> list[Commit]:
+    sync_branch_commits(repo, git_client, branches, session)
+    return get_commits_to_run(repo.id, session)
+
+
+def create_repo(account_id: int) -> int:
+    with local_session() as session:
+        repo = Repo(owner="bench", name="bench", account_id=account_id)
+        session.add(repo)
+        session.commit()
+        return repo.id
+
+
+def cleanup(account_id: int, repo_ids: list[int]):
+    with local_session() as session:
+        branch_ids = sqlmodel.select(Branch.id).where(Branch.repo_id.in_(repo_ids))
+        session.exec(
+            delete(Commit).where(Commit.branch_id.in_(branch_ids)).execution_options(synchronize_session=False)
+        )
+        session.exec(delete(Branch).where(Branch.repo_id.in_(repo_ids)))
+        session.exec(delete(Repo).where(Repo.id.in_(repo_ids)))
+        session.exec(delete(Account).where(Account.id == account_id))
+        session.commit()
+
+
+def measure(name: str, phase: str, sync, repo_id: int, git_client: SyntheticGitClient):
+    statements = 0
+
+    def count(*_):
+        nonlocal statements
+        statements += 1
+
+    with local_session() as session:
+        repo = session.get(Repo, repo_id)
+        branches = git_client.get_repo_branches_if_changed(repo)
+
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            started = time.perf_counter()
+            to_run = sync(repo, git_client, branches, session)
+            elapsed = time.perf_counter() - started
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
+    print(
+        f"{name:>9} {phase:>11}: {elapsed * 1000:8.0f}ms, {statements:6} statements, "
+        f"{len(to_run)} commits to run"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--branches", type=int, default=40)
+    parser.add_argument("--commits", type=int, default=5000)
+    parser.add_argument("--branch-commits", type=int, default=50)
+    parser.add_argument("--new-commits", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # statements are counted, not printed
+    engine.echo = False
+
+    with local_session() as session:
+        account = Account(email=f"bench-{time.time_ns()}@traig.space", password="-", github_personal_api_token="-")
+        session.add(account)
+        session.commit()
+        account_id = account.id
+
+    repo_ids = []
+    try:
+        for name, sync in (("per-row", sync_per_row), ("set-based", sync_set_based)):
+            random.seed(args.seed)
+            git_client = SyntheticGitClient(args.branches, args.commits, args.branch_commits)
+            repo_id = create_repo(account_id)
+            repo_ids.append(repo_id)
+
+            measure(name, "initial", sync, repo_id, git_client)
+            git_client.push(args.new_commits)
+            measure(name, "incremental", sync, repo_id, git_client)
+    finally:
+        cleanup(account_id, repo_ids)
+
+
+if __name__ == "__main__":
+    main()
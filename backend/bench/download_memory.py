@@ -0,0 +1,104 @@
+"""Peak memory of downloading and extracting a large commit archive.
+
+Serves a synthetic tarball of --size-mb incompressible data from a local HTTP server and downloads it
+in a fresh process twice: buffered in memory (how zipball download worked before) and streamed
+through GithubClient.download_and_unzip_commit. Run inside the worker container:
+
+    python -m bench.download_memory --size-mb 300
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+def make_archive(path: str, size_mb: int, files: int = 30):
+    with tarfile.open(path, "w:gz", compresslevel=1) as tar:
+        file_size = size_mb * 1024 * 1024 // files
+        for i in range(files):
+            info = tarfile.TarInfo(f"owner-repo-sha/data/file-{i}.bin")
+            info.size = file_size
+            tar.addfile(info, io.BytesIO(os.urandom(file_size)))
+
+
+def serve(directory: str) -> ThreadingHTTPServer:
+    class Handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def translate_path(self, path):
+            # every /repos/{owner}/{name}/tarball/{sha} request gets the same archive
+            return os.path.join(directory, "archive.tar.gz")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_buffered(url: str, destination: str):
+    response = requests.get(f"{url}/repos/owner/repo/tarball/sha")
+    archive_path = os.path.join(destination, "archive.tar.gz")
+    with open(archive_path, "wb") as f:
+        f.write(response.content)
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(destination)
+    os.unlink(archive_path)
+
+
+def run_streaming(url: str, destination: str):
+    from git.github import GithubClient
+    from model import Account, Branch, Commit, Repo
+
+    os.environ["REPOS_DOWNLOAD_PATH"] = destination
+    repo = Repo(id=1, owner="owner", name="repo", account=Account(id=1))
+    branch = Branch(id=1, name="main", sha="sha", repo_id=1, repo=repo)
+    commit = Commit(sha="sha", message="", branch=branch)
+
+    GithubClient("token", api_url=url).download_and_unzip_commit(commit)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=300)
+    parser.add_argument("--child", choices=["buffered", "streaming"])
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    if args.child:
+        with tempfile.TemporaryDirectory() as destination:
+            {"buffered": run_buffered, "streaming": run_streaming}[args.child](args.url, destination)
+        print(json.dumps({"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_archive(os.path.join(directory, "archive.tar.gz"), args.size_mb)
+        server = serve(directory)
+        url = f"http://127.0.0.1:{server.server_port}"
+
+        print(f"archive: {os.path.getsize(os.path.join(directory, 'archive.tar.gz')) / 2**20:.0f} MB")
+        for mode in ("buffered", "streaming"):
+            result = subprocess.run(
+                [sys.executable, "-m", "bench.download_memory", "--child", mode, "--url", url],
+                check=True,
+                capture_output=True,
+            )
+            max_rss_mb = json.loads(result.stdout.splitlines()[-1])["max_rss_kb"] / 1024
+            print(f"{mode:>10}: peak rss {max_rss_mb:.0f} MB")
+
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Branch commit fetching of a poll: sequential requests without connection reuse against the pooled,
+concurrent fetch_branch_commits.
+
+Runs against a local stand-in for the github api, no database or network is needed:
+
+    python -m bench.github_fetch --branches 60 --commits 250 --latency-ms 80 --connect-ms 150
+
+The stand-in serves /branches and paginated /compare of a synthetic repo. Every request is answered after
+--latency-ms, every new connection is accepted after --connect-ms, which stands for the TCP and TLS
+handshakes of api.github.com. Each branch has --commits new commits, fetched in pages of 100.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from git import fetch_concurrency
+from git.github import GithubClient
+from model import Repo
+from service.repo import fetch_branch_commits
+
+
+class StandInGithub(BaseHTTPRequestHandler):
+    # keep-alive, so pooled connections skip the handshake delay
+    protocol_version = "HTTP/1.1"
+    branches: int
+    commits: int
+    latency: float
+    connect_latency: float
+
+    def setup(self):
+        time.sleep(self.connect_latency)
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, headers: dict = None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path.endswith("/branches"):
+            self._send_json(
+                [
+                    {"name": f"branch-{i}", "commit": {"sha": f"{i:04d}-{self.commits:06d}"}}
+                    for i in range(self.branches)
+                ]
+            )
+            return
+
+        per_page, page = int(query.get("per_page", 30)), int(query.get("page", 1))
+        if "/compare/" in url.path:
+            # commits after the known head of a branch oldest first, shas are <branch>-<number>
+            base, head = url.path.rsplit("/", 1)[1].split("...")
+            branch, known, last = head.split("-")[0], int(base.split("-")[1]), int(head.split("-")[1])
+            numbers = range(known + 1 + (page - 1) * per_page, min(known + 1 + page * per_page, last + 1))
+            self._send_json({"status": "ahead", "total_commits": last - known, "commits": self._items(branch, numbers)})
+            return
+
+        # commits of a branch from its head back
+        branch, head = query["sha"].split("-")
+        numbers = range(int(head) - (page - 1) * per_page, max(int(head) - page * per_page, -1), -1)
+        headers = {}
+        if len(numbers) == per_page and numbers[-1] > 0:
+            next_query = f"sha={query['sha']}&per_page={per_page}&page={page + 1}"
+            headers["Link"] = f'<http://{self.headers["Host"]}{url.path}?{next_query}>; rel="next"'
+        self._send_json(self._items(branch, numbers), headers)
+
+    @staticmethod
+    def _items(branch: str, numbers: range) -> list[dict]:
+        return [
+            {
+                "sha": f"{branch}-{n:06d}",
+                "commit": {"committer": {"date": f"2023-01-01T00:00:{n % 60:02d}Z"}, "message": "bench"},
+            }
+            for n in numbers
+        ]
+
+
+class NoRateLimit:
+    def acquire(self):
+        pass
+
+    def observe(self, response: requests.Response):
+        pass
+
+
+class UnpooledGithubClient(GithubClient):
+    """The previous client, a new connection for every request"""
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        return requests.get(url, **kwargs)
+
+
+def run(name: str, client: GithubClient, repo: Repo, concurrency: int, args) -> float:
+    client.rate_limiter = NoRateLimit()
+    branches = client.get_repo_branches(repo)
+    # known heads are the first commits of the branches, so every branch has args.commits new ones
+    known_heads = {b.name: b.sha.split("-")[0] + "-000000" for b in branches}
+
+    started = time.perf_counter()
+    branch_commits = fetch_branch_commits(repo, client, branches, known_heads, concurrency=concurrency)
+    elapsed = time.perf_counter() - started
+
+    fetched = sum(len(commits) for commits in branch_commits.values())
+    print(f"{name:>10}: {elapsed:6.2f}s, {fetched} commits of {len(branch_commits)} branches")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--branches", type=int, default=60)
+    parser.add_argument("--commits", type=int, default=250)
+    parser.add_argument("--latency-ms", type=float, default=80)
+    parser.add_argument("--connect-ms", type=float, default=150)
+    parser.add_argument("--concurrency", type=int, default=fetch_concurrency)
+    args = parser.parse_args()
+
+    StandInGithub.branches = args.branches
+    StandInGithub.commits = args.commits
+    StandInGithub.latency = args.latency_ms / 1000
+    StandInGithub.connect_latency = args.connect_ms / 1000
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInGithub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f"http://127.0.0.1:{server.server_port}"
+
+    repo = Repo(id=0, owner="bench", name="bench", account_id=0)
+    try:
+        sequential = run("sequential", UnpooledGithubClient("-", api_url=api_url), repo, 1, args)
+        pooled = run("pooled", GithubClient("-", api_url=api_url, http_session=requests.Session()), repo, 1, args)
+        concurrent = run("concurrent", GithubClient("-", api_url=api_url), repo, args.concurrency, args)
+        print(f"speedup: pooled {sequential / pooled:.1f}x, pooled and concurrent {sequential / concurrent:.1f}x")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
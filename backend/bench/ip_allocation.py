@@ -0,0 +1,173 @@
+"""Client ip allocation under contention: the IpLease pool against the previous linear scan.
+
+Run against a development database with an empty IpLease table, for example inside the worker container:
+
+    python -m bench.ip_allocation --concurrency 32 --allocations 2000
+
+The pool is seeded with a synthetic /20 subnet instead of the docker network. Every thread allocates
+an address, holds it for --hold-ms, and releases it again. The linear scan is the previous algorithm:
+it loads every RunConfig, walks the subnet, and retries INSERTs until one does not hit the unique
+constraint. Everything the benchmark creates is removed at the end.
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from ipaddress import IPv4Network
+from unittest import mock
+
+import sqlalchemy.exc
+import sqlmodel
+from db import engine, local_session
+from model import Account, Branch, Commit, IpLease, Repo, RunConfig
+from service import ip_pool
+from sqlalchemy import delete
+
+
+def seed(commits: int) -> tuple[int, list[int]]:
+    with local_session() as session:
+        account = Account(
+            email=f"bench-{time.time_ns()}@traig.space",
+            password="-",
+            github_personal_api_token="-",
+        )
+        session.add(account)
+        session.flush()
+        repo = Repo(owner="bench", name="bench", account_id=account.id)
+        session.add(repo)
+        session.flush()
+        branch = Branch(name="bench", sha="0" * 40, repo_id=repo.id)
+        session.add(branch)
+        session.flush()
+        commit_rows = [
+            Commit(
+                sha=f"{i:040d}",
+                committed_datetime=datetime.now(),
+                message="bench",
+                branch_id=branch.id,
+            )
+            for i in range(commits)
+        ]
+        session.add_all(commit_rows)
+        session.commit()
+        return account.id, [c.id for c in commit_rows]
+
+
+def cleanup(account_id: int, commit_ids: list[int]):
+    with local_session() as session:
+        session.exec(delete(RunConfig).where(RunConfig.commit_id.in_(commit_ids)))
+        session.exec(delete(IpLease))
+        session.delete(session.get(Account, account_id))
+        session.commit()
+
+
+def allocate_linear(commit_id: int, network: IPv4Network, stats: dict) -> RunConfig:
+    with local_session() as session:
+        reserved_ips = [x.client_ip for x in session.exec(sqlmodel.select(RunConfig)).all()]
+
+        hosts = network.hosts()
+        next(hosts)
+        for host in hosts:
+            if str(host) in reserved_ips:
+                continue
+
+            run_config = RunConfig(commit_id=commit_id, client_ip=str(host))
+            session.add(run_config)
+            try:
+                session.commit()
+                session.refresh(run_config)
+                return run_config
+            except sqlalchemy.exc.IntegrityError:
+                session.rollback()
+                stats["conflicts"] += 1
+
+    raise RuntimeError("no free ip")
+
+
+def release_linear(run_config: RunConfig):
+    with local_session() as session:
+        session.exec(delete(RunConfig).where(RunConfig.id == run_config.id))
+        session.commit()
+
+
+def release_pool(run_config: RunConfig):
+    with local_session() as session:
+        session.exec(delete(RunConfig).where(RunConfig.id == run_config.id))
+        ip_pool.release_ip(run_config.client_ip, run_config.commit_id, session)
+        session.commit()
+
+
+def run(name: str, allocate, release, commit_ids: list[int], args) -> dict:
+    latencies = []
+    stats = {"conflicts": 0}
+    lock = threading.Lock()
+
+    def worker(i: int):
+        commit_id = commit_ids[i % len(commit_ids)]
+        started = time.perf_counter()
+        run_config = allocate(commit_id, stats)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+        time.sleep(args.hold_ms / 1000)
+        release(run_config)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(worker, range(args.allocations)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(
+        f"{name:>6}: {args.allocations / elapsed:7.0f} alloc/s, "
+        f"p50={statistics.median(latencies) * 1000:.1f}ms "
+        f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, "
+        f"unique violations {stats['conflicts']}"
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--allocations", type=int, default=2000)
+    parser.add_argument("--hold-ms", type=float, default=5)
+    parser.add_argument("--subnet", default="10.250.0.0/20")
+    args = parser.parse_args()
+
+    # statements are not printed, logging them would dominate the measurement
+    engine.echo = False
+
+    with local_session() as session:
+        if session.exec(sqlmodel.select(IpLease.id).limit(1)).first() is not None:
+            raise SystemExit("IpLease table is not empty, run the benchmark against a development database")
+
+    network = IPv4Network(args.subnet)
+    account_id, commit_ids = seed(args.concurrency)
+    try:
+        run(
+            "linear",
+            lambda commit_id, stats: allocate_linear(commit_id, network, stats),
+            release_linear,
+            commit_ids,
+            args,
+        )
+
+        with mock.patch.object(
+            ip_pool, "get_traig_docker_network_subnet", return_value=(args.subnet, [], None)
+        ):
+            run(
+                "pool",
+                lambda commit_id, stats: ip_pool.lease_ip_for_commit(commit_id),
+                release_pool,
+                commit_ids,
+                args,
+            )
+    finally:
+        cleanup(account_id, commit_ids)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Concurrent metric ingestion throughput against a running server.
+
+Run inside the server container (so the server sees requests from 127.0.0.1):
+
+    python -m bench.metric_ingest --url http://127.0.0.1:80 --concurrency 64 --requests 20000
+
+Creates a throwaway account/repo/commit with a RunConfig for --client-ip, hammers /metric/update
+from --concurrency threads and meanwhile measures latency of a sync, database-backed route
+(/system/login with wrong credentials), which competes for the same threadpool.
+Run it against the build before and after a change to compare.
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from db import local_session
+from model import Account, Branch, Commit, MetricAggregate, Repo, RunConfig
+from sqlalchemy import delete
+
+
+def seed(client_ip: str) -> int:
+    with local_session() as session:
+        account = Account(
+            email=f"bench-{time.time_ns()}@traig.space",
+            password="-",
+            github_personal_api_token="-",
+        )
+        session.add(account)
+        session.flush()
+        repo = Repo(owner="bench", name="bench", account_id=account.id)
+        session.add(repo)
+        session.flush()
+        branch = Branch(name="bench", sha="0" * 40, repo_id=repo.id)
+        session.add(branch)
+        session.flush()
+        commit = Commit(
+            sha="0" * 40,
+            committed_datetime=datetime.now(),
+            message="bench",
+            branch_id=branch.id,
+        )
+        session.add(commit)
+        session.flush()
+        session.add(RunConfig(client_ip=client_ip, commit_id=commit.id))
+        session.commit()
+        return account.id
+
+
+def cleanup(account_id: int):
+    with local_session() as session:
+        account = session.get(Account, account_id)
+        for repo in account.repos:
+            for branch in repo.branches:
+                for commit in branch.commits:
+                    session.exec(delete(RunConfig).where(RunConfig.commit_id == commit.id))
+                    session.exec(
+                        delete(MetricAggregate).where(MetricAggregate.commit_id == commit.id)
+                    )
+        session.delete(account)
+        session.commit()
+
+
+def percentile(values: list[float], q: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:80")
+    parser.add_argument("--client-ip", default="127.0.0.1")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    account_id = seed(args.client_ip)
+    try:
+        requests.post(
+            f"{args.url}/metric/init",
+            json={"data": {"latency": "median", "calls": "count"}},
+        ).raise_for_status()
+
+        local = threading.local()
+        latencies, errors = [], []
+
+        def send(i: int):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            started = time.perf_counter()
+            response = local.session.post(
+                f"{args.url}/metric/update", json={"data": {"latency": i % 100, "calls": 1}}
+            )
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+        probe_latencies = []
+        done = threading.Event()
+
+        def probe():
+            with requests.Session() as session:
+                while not done.is_set():
+                    started = time.perf_counter()
+                    session.post(
+                        f"{args.url}/system/login",
+                        json={"email": "bench@traig.space", "password": "-"},
+                    )
+                    probe_latencies.append(time.perf_counter() - started)
+                    time.sleep(0.05)
+
+        probe_thread = threading.Thread(target=probe, daemon=True)
+        probe_thread.start()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(send, range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+        done.set()
+        probe_thread.join()
+
+        print(f"requests:       {args.requests} ({len(errors)} failed) with concurrency {args.concurrency}")
+        print(f"throughput:     {args.requests / elapsed:.0f} req/s")
+        print(
+            f"update latency: p50={statistics.median(latencies) * 1000:.1f}ms "
+            f"p99={percentile(latencies, 0.99) * 1000:.1f}ms"
+        )
+        print(
+            f"login latency:  p50={statistics.median(probe_latencies) * 1000:.1f}ms "
+            f"p99={percentile(probe_latencies, 0.99) * 1000:.1f}ms (sync route under load)"
+        )
+    finally:
+        cleanup(account_id)
+
+
+if __name__ == "__main__":
+    main()
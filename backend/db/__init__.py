@@ -1,7 +1,11 @@
 import contextlib
+import logging
 import os
 
+import sqlalchemy
 from model import *
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 
 def get_dsn():
@@ -15,9 +19,45 @@ def get_dsn():
 
 engine = sqlmodel.create_engine(get_dsn(), pool_size=30, max_overflow=20, echo=True)
 
+# used by metric ingestion hot path, so statements are not echoed
+async_engine = create_async_engine(
+    get_dsn().replace("postgresql://", "postgresql+asyncpg://", 1),
+    pool_size=30,
+    max_overflow=20,
+)
+
+
+def _add_missing_columns():
+    """create_all only creates missing tables, columns added to models of existing ones are added here.
+
+    Columns that are NOT NULL without a server default can not be added to filled tables and are only reported.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for table in sqlmodel.SQLModel.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    logging.error(f"column {table.name}.{column.name} is missing and has to be added manually")
+                    continue
+
+                ddl = f"ALTER TABLE {quote(table.name)} ADD COLUMN IF NOT EXISTS {quote(column.name)} "
+                ddl += column.type.compile(dialect=engine.dialect)
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    ddl += f" DEFAULT {default if isinstance(default, str) else default.text}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                connection.exec_driver_sql(ddl)
+                logging.info(f"added column {table.name}.{column.name}")
+
 
 def init_db():
     sqlmodel.SQLModel.metadata.create_all(engine)
+    _add_missing_columns()
 
 
 def get_session() -> sqlmodel.Session:
@@ -29,3 +69,9 @@ def get_session() -> sqlmodel.Session:
 def local_session() -> sqlmodel.Session:
     with sqlmodel.Session(engine) as session:
         yield session
+
+
+@contextlib.asynccontextmanager
+async def async_local_session() -> AsyncSession:
+    async with AsyncSession(async_engine) as session:
+        yield session
@@ -1,44 +1,60 @@
 import logging
 
 import sqlmodel
-from model import Commit, Repo
-from sqlalchemy import text, or_
+from model import MetricValue, Repo
+from sqlalchemy import func
 from sqlmodel import Session
 
 
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
 def create_metrics_view(repo: Repo, session: Session):
-    successfully_processed_commits = session.exec(
-        sqlmodel.select(Commit).where(
-            or_(*[Commit.branch_id == b.id for b in repo.branches]), Commit.processed == True, Commit.run_ok == True
+    """repo_{id} view with a column per metric, pivoted from MetricValue of the repo"""
+    metrics = session.exec(
+        sqlmodel.select(
+            MetricValue.metric_name,
+            func.bool_or(MetricValue.text_value != None),
         )
-    )
-
-    all_metric_keys = set([])
-    for commit in successfully_processed_commits:
-        all_metric_keys.update(commit.json_run_result.keys())
+        .where(MetricValue.repo_id == repo.id)
+        .group_by(MetricValue.metric_name)
+        .order_by(MetricValue.metric_name)
+    ).all()
 
-    if len(all_metric_keys) == 0:
+    if len(metrics) == 0:
         logging.debug(f"no metrics found for repo_id={repo.id}")
         return
 
-    json_metric_to_field = [
-        f"json_run_result::json->'{m}' as {m}" for m in all_metric_keys
-    ]
-
-    branch_filters = ' or '.join([f'branch_id = {b.id}' for b in repo.branches])
+    metric_to_field = []
+    for metric_name, has_text in metrics:
+        # metrics that ever had a text value are shown as text
+        value = "coalesce(text_value, numeric_value::text)" if has_text else "numeric_value"
+        metric_to_field.append(
+            f"max({value}) filter (where metric_name = {_quote_literal(metric_name)}) "
+            f"as {_quote_identifier(metric_name)}"
+        )
 
-    stmt = text(
-        f"""create or replace view repo_{repo.id} as select
-                    branch_id,
-                    sha,
-                    message,
-                    committed_datetime,
+    # executed without any parameter parsing, metric names are client provided and may contain : or %
+    stmt = (
+        f"""drop view if exists repo_{repo.id};
+            create view repo_{repo.id} as select
+                    mv.branch_id,
+                    mv.sha,
+                    c.message,
+                    mv.committed_datetime,
         """
-        + ", ".join(json_metric_to_field)
+        + ", ".join(metric_to_field)
         + f"""
-                      from commit where ({branch_filters}) and processed is true and run_ok is true"""
+                      from metricvalue mv join commit c on c.id = mv.commit_id
+                      where mv.repo_id = {int(repo.id)}
+                      group by mv.commit_id, mv.branch_id, mv.sha, c.message, mv.committed_datetime"""
     )
 
     with session.connection().engine.connect() as conn:
         with conn.begin():
-            conn.execute(stmt)
+            conn.execution_options(no_parameters=True).exec_driver_sql(stmt)
@@ -1,14 +1,105 @@
+import logging
+import os
+import shutil
+import tarfile
 from abc import ABC
+from typing import BinaryIO, Optional
 
-from model import Commit, Repo, Branch
+from exception import ServerFailure
+from model import Branch, Commit, GitSourceEnum, Repo
+
+
+def extract_tar_stream(fileobj: BinaryIO, destination: str, mode: str = "r|*"):
+    """Extracts tar archive read sequentially from fileobj into destination, without archive's top level directory.
+
+    Nothing but the current member is held in memory, so archive size does not matter.
+    """
+    root = os.path.realpath(destination)
+    os.makedirs(root, exist_ok=True)
+
+    def strip_top_dir(name: str) -> str:
+        parts = name.split("/", 1)
+        return parts[1] if len(parts) == 2 else ""
+
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            member.name = strip_top_dir(member.name)
+            if not member.name:
+                continue
+
+            target = os.path.realpath(os.path.join(root, member.name))
+            if os.path.commonpath([root, target]) != root:
+                raise ServerFailure(f"archive member {member.name} points outside of {root}")
+            if member.islnk():
+                member.linkname = strip_top_dir(member.linkname)
+
+            tar.extract(member, root)
+
+
+# branches whose commits are fetched at once during a poll, also the connection pool size of github clients
+fetch_concurrency = int(os.getenv("GIT_FETCH_CONCURRENCY", "8"))
+
+
+def new_commits_limit(known_sha: Optional[str]) -> int:
+    """Without known_sha (new branch) at most GIT_INITIAL_COMMITS_LIMIT commits are taken,
+    if known_sha is not in history (force push) at most GIT_MAX_NEW_COMMITS."""
+    if known_sha is None:
+        return int(os.getenv("GIT_INITIAL_COMMITS_LIMIT", "100"))
+    return int(os.getenv("GIT_MAX_NEW_COMMITS", "1000"))
 
 
 class _BaseGitClient(ABC):
+    @staticmethod
+    def construct_repo_branch_path(branch: Branch):
+        save_base_path = os.getenv("REPOS_DOWNLOAD_PATH")
+        if not save_base_path:
+            raise ServerFailure("REPOS_DOWNLOAD_PATH is not set, unable to save file")
+        return os.path.join(save_base_path, f"{branch.repo.account.id}__{branch.repo_id}__"
+                                            f"{branch.id}")
+
+    @classmethod
+    def make_commit_dir(cls, commit: Commit) -> str:
+        repo_path = cls.construct_repo_branch_path(commit.branch)
+        os.makedirs(repo_path, exist_ok=True)
+
+        commit_dir_path = os.path.join(repo_path, commit.sha)
+        try:
+            os.makedirs(commit_dir_path, exist_ok=False)
+        except FileExistsError:
+            logging.warning(
+                f"strangely dir for commit {commit.sha} already exists at {commit_dir_path}, will remove it"
+            )
+            shutil.rmtree(commit_dir_path)
+            os.makedirs(commit_dir_path, exist_ok=False)
+
+        return commit_dir_path
+
     def get_repo_branches(self, repo: Repo) -> list[Branch]:
         pass
 
-    def get_branch_commits(self, branch: Branch) -> list[Commit]:
+    def get_branch_commits(
+        self, repo: Repo, branch: Branch, known_sha: Optional[str] = None
+    ) -> list[Commit]:
+        """Commits reachable from branch.sha and not from known_sha, the previously processed head"""
         pass
 
+    def get_repo_branches_if_changed(self, repo: Repo) -> Optional[list[Branch]]:
+        """Same as get_repo_branches, but returns None when nothing changed since the last processed call"""
+        return self.get_repo_branches(repo)
+
     def download_and_unzip_commit(self, commit: Commit) -> str:
+        """Materializes commit files into {commit dir}/{owner}-{name}-{sha} and returns the commit dir"""
         pass
+
+
+def get_git_client(repo: Repo, **kwargs) -> _BaseGitClient:
+    """Client for repo.git_source, kwargs are passed to GithubClient only"""
+    token = repo.account.github_personal_api_token
+    if repo.git_source == GitSourceEnum.git_http:
+        from git.git_http import GitHTTPClient
+
+        return GitHTTPClient(token)
+
+    from git.github import GithubClient
+
+    return GithubClient(token, **kwargs)
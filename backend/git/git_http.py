@@ -1,5 +1,177 @@
-from git import _BaseGitClient
+import base64
+import fcntl
+import logging
+import os
+import subprocess
+from contextlib import contextmanager
+from typing import Optional
+
+import dateutil.parser
+from exception import ServerFailure
+from git import _BaseGitClient, extract_tar_stream, new_commits_limit
+from model import Branch, Commit, Repo
+
+# control characters used as separators, they do not occur in shas, dates and commit messages
+_FIELD_SEP = "\x1f"
+_RECORD_SEP = "\x1e"
 
 
 class GitHTTPClient(_BaseGitClient):
-    pass
+    """Keeps one bare mirror per repo under REPOS_DOWNLOAD_PATH/mirrors and serves everything from it.
+
+    The mirror is cloned once and then refreshed with incremental fetches, so branches, commits
+    and commit files cost one network round trip per check instead of a request per branch
+    and a full archive per commit. base_url may be a file:// url of a directory with repositories.
+    """
+
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        base_url: Optional[str] = None,
+    ):
+        self.token = token
+        self.base_url = (base_url or os.getenv("GIT_HTTP_BASE_URL", "https://github.com")).rstrip("/")
+
+    def remote_url(self, repo: Repo) -> str:
+        return f"{self.base_url}/{repo.owner}/{repo.name}.git"
+
+    @staticmethod
+    def mirror_path(repo: Repo) -> str:
+        save_base_path = os.getenv("REPOS_DOWNLOAD_PATH")
+        if not save_base_path:
+            raise ServerFailure("REPOS_DOWNLOAD_PATH is not set, unable to keep mirror")
+        return os.path.join(save_base_path, "mirrors", f"{repo.account_id}__{repo.id}.git")
+
+    def _env(self) -> dict[str, str]:
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        if self.token and self.base_url.startswith("https://"):
+            # passed through environment, so the token is neither in process args nor in mirror config
+            credentials = base64.b64encode(f"x-access-token:{self.token}".encode()).decode()
+            env.update(
+                GIT_CONFIG_COUNT="1",
+                GIT_CONFIG_KEY_0="http.extraHeader",
+                GIT_CONFIG_VALUE_0=f"Authorization: Basic {credentials}",
+            )
+        return env
+
+    def _git(self, repo: Repo, *args: str, check: bool = True) -> subprocess.CompletedProcess:
+        result = subprocess.run(
+            ["git", "--git-dir", self.mirror_path(repo), *args],
+            env=self._env(),
+            capture_output=True,
+            text=True,
+        )
+        if check and result.returncode != 0:
+            raise ServerFailure(f"git {args[0]} failed for repo_id={repo.id}: {result.stderr.strip()}")
+        return result
+
+    @contextmanager
+    def _mirror_lock(self, repo: Repo):
+        """Fetches of one mirror from api and worker processes are serialized, reads need no lock"""
+        path = self.mirror_path(repo)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch(self, repo: Repo):
+        with self._mirror_lock(repo) as path:
+            if not os.path.isdir(path):
+                subprocess.run(["git", "init", "--quiet", "--bare", path], check=True)
+                # branches only, pull request refs of github would multiply the mirror size
+                self._git(repo, "remote", "add", "origin", self.remote_url(repo))
+                self._git(repo, "config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*")
+            else:
+                # owner or name could have been changed by update_repo
+                self._git(repo, "remote", "set-url", "origin", self.remote_url(repo))
+
+            self._git(repo, "fetch", "--quiet", "--prune", "--no-tags", "origin")
+
+    def _has_commit(self, repo: Repo, sha: str) -> bool:
+        return self._git(repo, "cat-file", "-e", f"{sha}^{{commit}}", check=False).returncode == 0
+
+    def get_repo_branches(self, repo: Repo) -> list[Branch]:
+        self.fetch(repo)
+        output = self._git(
+            repo, "for-each-ref", "--format=%(refname:lstrip=2) %(objectname)", "refs/heads"
+        ).stdout
+
+        branches = []
+        for line in output.splitlines():
+            name, sha = line.rsplit(" ", 1)
+            branches.append(Branch(name=name, sha=sha, repo_id=repo.id))
+        return branches
+
+    def get_branch_commits(
+        self, repo: Repo, branch: Branch, known_sha: Optional[str] = None
+    ) -> list[Commit]:
+        """Reads history of branch.sha from the mirror, number of commits is bounded by new_commits_limit"""
+        args = [
+            "log",
+            f"--format=%H{_FIELD_SEP}%cI{_FIELD_SEP}%B{_RECORD_SEP}",
+            f"--max-count={new_commits_limit(known_sha)}",
+            # oldest first, so commits with equal dates keep history order after sorting
+            "--reverse",
+            branch.sha,
+        ]
+        if known_sha is not None:
+            if self._has_commit(repo, known_sha) and self._git(
+                repo, "merge-base", "--is-ancestor", known_sha, branch.sha, check=False
+            ).returncode == 0:
+                args.append(f"^{known_sha}")
+            else:
+                logging.warning(
+                    f"known head {known_sha} of branch {branch.name} (repo_id={branch.repo_id}) "
+                    f"is not an ancestor of {branch.sha}, history was probably rewritten"
+                )
+
+        commits = []
+        for record in self._git(repo, *args).stdout.split(_RECORD_SEP):
+            record = record.lstrip("\n")
+            if not record:
+                continue
+            sha, committed, message = record.split(_FIELD_SEP, 2)
+            commits.append(
+                Commit(
+                    sha=sha,
+                    committed_datetime=dateutil.parser.isoparse(committed),
+                    message=message.rstrip("\n"),
+                    branch_id=branch.id,
+                )
+            )
+
+        return sorted(commits, key=lambda x: x.committed_datetime)
+
+    def download_and_unzip_commit(self, commit: Commit) -> str:
+        """Pipes git archive of the commit from the mirror into extraction, fetching only if it is missing"""
+        repo = commit.branch.repo
+        if not self._has_commit(repo, commit.sha):
+            self.fetch(repo)
+
+        commit_dir_path = self.make_commit_dir(commit)
+
+        top_dir = f"{repo.owner}-{repo.name}-{commit.sha}"
+        process = subprocess.Popen(
+            [
+                "git", "--git-dir", self.mirror_path(repo),
+                "archive", "--format=tar", f"--prefix={top_dir}/", commit.sha,
+            ],
+            env=self._env(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            extract_tar_stream(process.stdout, os.path.join(commit_dir_path, top_dir), mode="r|")
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise ServerFailure(f"git archive of {commit.sha} failed: {stderr.decode(errors='replace').strip()}")
+
+        return commit_dir_path
@@ -1,68 +1,97 @@
 import logging
 import os
-import shutil
-import zipfile
+from http.cookiejar import DefaultCookiePolicy
+from typing import Optional
 
 import dateutil.parser
 import requests
 from exception import ServerFailure
-from git import _BaseGitClient
+from git import _BaseGitClient, extract_tar_stream, fetch_concurrency, new_commits_limit
+from git.http_cache import ConditionalRequestCache
+from git.rate_limit import GithubRateLimiter
 from model import Commit, Repo, Branch
+from requests.adapters import HTTPAdapter
+
+
+def get_http_session() -> requests.Session:
+    """Session shared by github clients of the process, connections are kept alive between polls"""
+    if not hasattr(get_http_session, "session"):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=fetch_concurrency)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # clients of different tokens share the session, nothing may be carried between them
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        get_http_session.session = session
+
+    return get_http_session.session
 
 
 class GithubClient(_BaseGitClient):
-    def __init__(self, token: str):
+    def __init__(
+        self,
+        token: str,
+        cache: Optional[ConditionalRequestCache] = None,
+        api_url: str = "https://api.github.com",
+        http_session: Optional[requests.Session] = None,
+    ):
         self.token = token
+        self.cache = cache
+        self.api_url = api_url
+        self.rate_limiter = GithubRateLimiter(token)
+        self.http_session = http_session or get_http_session()
 
     @staticmethod
     def check_response(response: requests.Response):
+        if response.status_code in (403, 429) and (
+            response.headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in response.headers
+        ):
+            raise ServerFailure(
+                f"github rate limit exceeded, reset at {response.headers.get('X-RateLimit-Reset')}, "
+                f"retry after {response.headers.get('Retry-After')}"
+            )
         if response.status_code != 200:
             raise ServerFailure(
                 f"response from github is not 200 (it is {response.status_code}), text: {response.text}"
             )
 
-    @staticmethod
-    def construct_repo_branch_path(branch: Branch):
-        save_base_path = os.getenv("REPOS_DOWNLOAD_PATH")
-        if not save_base_path:
-            raise ServerFailure("REPOS_DOWNLOAD_PATH is not set, unable to save file")
-        return os.path.join(save_base_path, f"{branch.repo.account.id}__{branch.repo_id}__"
-                                            f"{branch.id}")
-
-    def get_repo_branches(self, repo: Repo) -> list[Branch]:
-        response = requests.get(
-            f"https://api.github.com/repos/{repo.owner}/{repo.name}/branches",
-            headers={
-                "Accept": "application/vnd.github+json",
-                "Authorization": f"Bearer {self.token}",
-                "X-GitHub-Api-Version": "2022-11-28",
-            },
-            params={
-                'per_page': 100
-            }
-        )
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        """GET within the rate limit budget of the token, the budget is updated from the response"""
+        self.rate_limiter.acquire()
+        response = self.http_session.get(url, **kwargs)
+        self.rate_limiter.observe(response)
+        return response
+
+    def _headers(self) -> dict[str, str]:
+        return {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {self.token}",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+
+    def _get_json_if_changed(self, url: str, params: dict) -> Optional[list]:
+        """Returns None on 304 Not Modified, which github does not count against the rate limit"""
+        headers = self._headers()
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.token, url, params)
+            headers.update(self.cache.get_headers(key))
+
+        response = self._get(url, headers=headers, params=params)
+        if response.status_code == 304:
+            return None
 
         self.check_response(response)
 
-        return [Branch(name=x['name'], sha=x['commit']['sha'], repo_id=repo.id) for x in response.json()]
-
-    def get_branch_commits(self, branch: Branch) -> list[Commit]:
-        repo = branch.repo
-        response = requests.get(
-            f"https://api.github.com/repos/{repo.owner}/{repo.name}/commits",
-            headers={
-                "Accept": "application/vnd.github+json",
-                "Authorization": f"Bearer {self.token}",
-                "X-GitHub-Api-Version": "2022-11-28",
-            },
-            params={
-                'sha': branch.sha,
-                'per_page': 100
-            }
-        )
+        if key is not None:
+            self.cache.stage(key, response)
 
-        self.check_response(response)
+        return response.json()
 
+    def _branches_from_json(self, repo: Repo, data: list) -> list[Branch]:
+        return [Branch(name=x['name'], sha=x['commit']['sha'], repo_id=repo.id) for x in data]
+
+    def _commits_from_json(self, branch: Branch, data: list) -> list[Commit]:
         return sorted(
             [
                 Commit(
@@ -73,47 +102,104 @@ class GithubClient(_BaseGitClient):
                     message=item["commit"]["message"],
                     branch_id=branch.id,
                 )
-                for item in response.json()
+                for item in data
             ],
             key=lambda x: x.committed_datetime,
         )
 
-    def download_and_unzip_commit(self, commit: Commit) -> str:
-        repo = commit.branch.repo
-        response = requests.get(
-            f"https://api.github.com/repos/{repo.owner}/{repo.name}/zipball/{commit.sha}",
-            headers={
-                "Accept": "application/vnd.github+json",
-                "Authorization": f"Bearer {self.token}",
-                "X-GitHub-Api-Version": "2022-11-28",
-            },
-            allow_redirects=True,
-        )
+    def _branches_request(self, repo: Repo) -> tuple[str, dict]:
+        return f"{self.api_url}/repos/{repo.owner}/{repo.name}/branches", {'per_page': 100}
 
-        self.check_response(response)
+    def get_repo_branches(self, repo: Repo) -> list[Branch]:
+        url, params = self._branches_request(repo)
+        response = self._get(url, headers=self._headers(), params=params)
 
-        logging.debug(f"got zip from github, headers: {response.headers}")
+        self.check_response(response)
 
-        repo_path = self.construct_repo_branch_path(commit.branch)
-        os.makedirs(repo_path, exist_ok=True)
+        return self._branches_from_json(repo, response.json())
+
+    def get_repo_branches_if_changed(self, repo: Repo) -> Optional[list[Branch]]:
+        data = self._get_json_if_changed(*self._branches_request(repo))
+        return None if data is None else self._branches_from_json(repo, data)
+
+    def get_branch_commits(
+        self, repo: Repo, branch: Branch, known_sha: Optional[str] = None
+    ) -> list[Commit]:
+        """Commits reachable from branch.sha and not from known_sha, bounded by new_commits_limit.
+
+        They are taken from the comparison of known_sha with branch.sha. History listed by date would miss
+        commits of branches merged since known_sha that are older than it. New branches are walked back
+        from branch.sha.
+        """
+        limit = new_commits_limit(known_sha)
+        if known_sha is None:
+            return self._walk_branch_commits(repo, branch, limit)
+
+        url = f"{self.api_url}/repos/{repo.owner}/{repo.name}/compare/{known_sha}...{branch.sha}"
+        per_page = 100
+        response = self._get(url, headers=self._headers(), params={"per_page": per_page, "page": 1})
+        if response.status_code == 404:
+            logging.warning(
+                f"known head {known_sha} of branch {branch.name} (repo_id={branch.repo_id}) "
+                f"no longer exists, history was probably rewritten"
+            )
+            return self._walk_branch_commits(repo, branch, limit)
+        self.check_response(response)
 
-        commit_dir_path = os.path.join(repo_path, commit.sha)
-        try:
-            os.makedirs(commit_dir_path, exist_ok=False)
-        except FileExistsError:
+        data = response.json()
+        if data["status"] == "diverged":
             logging.warning(
-                f"strangely dir for commit {commit.sha} already exists at {commit_dir_path}, will remove it"
+                f"known head {known_sha} of branch {branch.name} (repo_id={branch.repo_id}) "
+                f"is not an ancestor of {branch.sha}, history was probably rewritten"
             )
-            shutil.rmtree(commit_dir_path)
-            os.makedirs(commit_dir_path, exist_ok=False)
 
-        commit_zip_path = f"{commit_dir_path}.zip"
-        with open(commit_zip_path, "wb") as f:
-            f.write(response.content)
+        # pages are oldest first, only the ones with the newest limit commits are fetched
+        total = data["total_commits"]
+        first_page = max(total - limit, 0) // per_page + 1
+        items = data["commits"] if first_page == 1 else []
+        for page in range(max(first_page, 2), (total + per_page - 1) // per_page + 1):
+            response = self._get(url, headers=self._headers(), params={"per_page": per_page, "page": page})
+            self.check_response(response)
+            items.extend(response.json()["commits"])
+
+        return self._commits_from_json(branch, items[-limit:])
+
+    def _walk_branch_commits(self, repo: Repo, branch: Branch, limit: int) -> list[Commit]:
+        """Walks history back from branch.sha following Link pagination"""
+        items = []
+        url = f"{self.api_url}/repos/{repo.owner}/{repo.name}/commits"
+        params = {'sha': branch.sha, 'per_page': min(limit, 100)}
+        while url is not None and len(items) < limit:
+            response = self._get(url, headers=self._headers(), params=params)
+            self.check_response(response)
+            items.extend(response.json())
+
+            # next link already carries all query params
+            url, params = response.links.get("next", {}).get("url"), None
 
-        with zipfile.ZipFile(commit_zip_path, "r") as zip_ref:
-            zip_ref.extractall(commit_dir_path)
+        return self._commits_from_json(branch, items[:limit])
 
-        os.unlink(commit_zip_path)
+    def download_and_unzip_commit(self, commit: Commit) -> str:
+        """Pipes tarball from github straight into extraction, no archive is kept in memory or on disk"""
+        repo = commit.branch.repo
+
+        commit_dir_path = self.make_commit_dir(commit)
+
+        with self._get(
+            f"{self.api_url}/repos/{repo.owner}/{repo.name}/tarball/{commit.sha}",
+            headers=self._headers(),
+            allow_redirects=True,
+            stream=True,
+        ) as response:
+            self.check_response(response)
+
+            logging.debug(f"got tarball from github, headers: {response.headers}")
+
+            response.raw.decode_content = True
+            extract_tar_stream(
+                response.raw,
+                os.path.join(commit_dir_path, f"{repo.owner}-{repo.name}-{commit.sha}"),
+                mode="r|gz",
+            )
 
         return commit_dir_path
@@ -0,0 +1,68 @@
+import hashlib
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+import requests
+import sqlmodel
+from db import local_session
+from model import HttpValidatorCache
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+
+
+class ConditionalRequestCache:
+    """Persistent ETag / Last-Modified validators for conditional GET requests.
+
+    Validators of new responses are kept in memory until save() is called, so a response
+    that failed to be processed is fetched again in full next time instead of being answered with 304.
+    """
+
+    def __init__(self, max_age: timedelta = timedelta(days=30)):
+        self.max_age = max_age
+        self._pending: dict[str, dict] = {}
+
+    @staticmethod
+    def make_key(token: str, url: str, params: dict = None) -> str:
+        query = urlencode(sorted((params or {}).items()))
+        return hashlib.sha256(f"{token}\n{url}?{query}".encode("utf-8")).hexdigest()
+
+    def get_headers(self, key: str) -> dict[str, str]:
+        with local_session() as session:
+            entry = session.exec(
+                sqlmodel.select(HttpValidatorCache).where(HttpValidatorCache.key == key)
+            ).first()
+
+        headers = {}
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def stage(self, key: str, response: requests.Response):
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._pending[key] = {"etag": etag, "last_modified": last_modified}
+
+    def save(self):
+        now = datetime.now()
+        with local_session() as session:
+            if self._pending:
+                stmt = insert(HttpValidatorCache).values(
+                    [{"key": key, "updated_at": now, **v} for key, v in self._pending.items()]
+                )
+                session.exec(
+                    stmt.on_conflict_do_update(
+                        index_elements=[HttpValidatorCache.key],
+                        set_={
+                            "etag": stmt.excluded.etag,
+                            "last_modified": stmt.excluded.last_modified,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                    )
+                )
+            session.exec(
+                delete(HttpValidatorCache).where(HttpValidatorCache.updated_at < now - self.max_age)
+            )
+            session.commit()
+        self._pending = {}
@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import os
+import time
+from typing import Optional
+
+import pubsub
+import redis
+import requests
+from exception import ServerFailure
+
+# budget of a token when github did not report one yet, github grants 5000 requests per hour to a user token
+default_rate_per_hour = int(os.getenv("GITHUB_RATE_LIMIT_PER_HOUR", "5000"))
+burst = int(os.getenv("GITHUB_RATE_LIMIT_BURST", "100"))
+# requests left untouched for the user's own use of the token
+reserve = int(os.getenv("GITHUB_RATE_LIMIT_RESERVE", "100"))
+# a request waiting longer than this for the bucket fails instead, the poll is repeated later
+max_wait = float(os.getenv("GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS", "60"))
+
+# refills the bucket and takes a token, returns seconds to wait before trying again, 0 when taken
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local default_rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate', 'rate_until', 'blocked_until')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local rate = tonumber(state[3]) or default_rate
+local rate_until = tonumber(state[4]) or 0
+local blocked_until = tonumber(state[5]) or 0
+
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+if rate_until <= now then
+    rate = default_rate
+end
+
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 7200)
+return tostring(wait)
+"""
+
+# gives back the token of a request github did not count,
+# and spreads what github reports as remaining over the time until its reset
+_OBSERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local remaining = tonumber(ARGV[2])
+local reset = tonumber(ARGV[3])
+local blocked_until = tonumber(ARGV[4])
+local refund = tonumber(ARGV[5])
+local capacity = tonumber(ARGV[6])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+
+if blocked_until > now then
+    redis.call('HSET', KEYS[1], 'blocked_until', tostring(blocked_until), 'tokens', '0', 'ts', tostring(now))
+else
+    if tokens ~= nil then
+        tokens = math.min(capacity, tokens + refund)
+    end
+    if remaining >= 0 then
+        if tokens == nil or tokens > remaining then
+            tokens = remaining
+        end
+        local rate = math.max(remaining, 1) / math.max(reset - now, 1)
+        redis.call(
+            'HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now),
+            'rate', tostring(rate), 'rate_until', tostring(reset)
+        )
+    elseif tokens ~= nil then
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+    end
+end
+redis.call('EXPIRE', KEYS[1], 7200)
+return 0
+"""
+
+
+class GithubRateLimiter:
+    """Token bucket in redis shared by every process using the same github token.
+
+    Starts at default_rate_per_hour, and after every response follows X-RateLimit-Remaining and
+    X-RateLimit-Reset, so the requests left are spread until the reset instead of being spent at once.
+    Exhausted and secondary limits block the token until the reset or Retry-After. Conditional
+    requests answered with 304 are not counted by github, their token is given back. Without redis
+    requests are not limited.
+    """
+
+    def __init__(self, token: str):
+        self.key = "traig:github_rate_limit:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def _scripts():
+        if not hasattr(GithubRateLimiter, "acquire_script"):
+            GithubRateLimiter.acquire_script = pubsub.get_redis().register_script(_ACQUIRE_SCRIPT)
+            GithubRateLimiter.observe_script = pubsub.get_redis().register_script(_OBSERVE_SCRIPT)
+        return GithubRateLimiter.acquire_script, GithubRateLimiter.observe_script
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            try:
+                acquire_script, _ = self._scripts()
+                wait = float(
+                    acquire_script(keys=[self.key], args=[time.time(), default_rate_per_hour / 3600, burst])
+                )
+            except redis.RedisError as e:
+                logging.error(f"github rate limiter is unavailable, request is not limited: {e}")
+                return
+            if wait <= 0:
+                return
+            if waited + wait > max_wait:
+                raise ServerFailure(f"github rate limit budget is exhausted for the next {wait:.0f}s")
+            time.sleep(wait)
+            waited += wait
+
+    def observe(self, response: requests.Response):
+        now = time.time()
+        remaining = _int_header(response, "X-RateLimit-Remaining")
+        reset = _int_header(response, "X-RateLimit-Reset")
+
+        blocked_until = 0.0
+        retry_after = _int_header(response, "Retry-After")
+        if response.status_code in (403, 429):
+            if retry_after is not None:
+                blocked_until = now + retry_after
+            elif remaining == 0 and reset is not None:
+                blocked_until = reset
+        refund = 1 if response.status_code == 304 else 0
+        if remaining is None or reset is None:
+            if blocked_until == 0 and not refund:
+                return
+            remaining, reset = -1, now
+        else:
+            remaining = max(remaining - reserve, 0)
+
+        try:
+            _, observe_script = self._scripts()
+            observe_script(keys=[self.key], args=[now, remaining, reset, blocked_until, refund, burst])
+        except redis.RedisError as e:
+            logging.error(f"failed to update github rate limiter: {e}")
+
+
+def _int_header(response: requests.Response, name: str) -> Optional[int]:
+    try:
+        return int(response.headers[name])
+    except (KeyError, ValueError):
+        return None
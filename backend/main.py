@@ -2,6 +2,8 @@ import logging
 
 from api import init_api
 from db import init_db
+from service.metric_value import backfill_metric_values
+from service.repo import backfill_webhook_secrets
 
 
 def init_logging():
@@ -15,4 +17,6 @@ def init_logging():
 def init_fastapi():
     init_logging()
     init_db()
+    backfill_metric_values()
+    backfill_webhook_secrets()
     return init_api()
@@ -3,8 +3,9 @@ from enum import Enum
 from typing import Optional
 
 import pydantic
+import sqlalchemy
 import sqlmodel
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import Index, UniqueConstraint
 from sqlmodel import Field, Relationship, SQLModel
 
 
@@ -41,9 +42,22 @@ class Login(pydantic.BaseModel):
     password: str
 
 
+class GitSourceEnum(str, Enum):
+    github = "github"  # github REST api, commit files are downloaded as tarballs
+    git_http = "git_http"  # local bare mirror fetched over git http protocol
+
+
+class BuildCacheModeEnum(str, Enum):
+    clean = "clean"  # every layer is rebuilt for every commit
+    cached = "cached"  # layers are reused between commits of the repo
+    skip_unchanged = "skip_unchanged"  # as cached, and no build at all if build context did not change
+
+
 class Repo(SQLBase, table=True):
     owner: str
     name: str
+    git_source: GitSourceEnum = Field(default=GitSourceEnum.github, nullable=False)
+    build_cache_mode: BuildCacheModeEnum = Field(default=BuildCacheModeEnum.clean, nullable=False)
 
     account: Account = Relationship(
         back_populates="repos", sa_relationship_kwargs={"cascade": "delete"}
@@ -60,14 +74,29 @@ class Repo(SQLBase, table=True):
         default="docker-compose.traig.yml", nullable=False
     )
 
+    # adaptive polling interval of the repo, the minimum one when not set
+    poll_interval_seconds: Optional[int] = Field(default=None)
+    # HMAC key of X-Hub-Signature-256 of github webhooks, generated when the repo is added
+    webhook_secret: Optional[str] = Field(default=None)
+    # last verified webhook delivery, while set commits are polled only to reconcile missed ones
+    webhook_received_at: Optional[datetime.datetime] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), nullable=True)
+    )
+
 
 class RepoWrite(pydantic.BaseModel):
     owner: str
     name: str
+    git_source: GitSourceEnum = GitSourceEnum.github
+    build_cache_mode: BuildCacheModeEnum = BuildCacheModeEnum.clean
 
 
 class Branch(SQLBase, table=True):
+    __table_args__ = (
+        UniqueConstraint("repo_id", "name", name="repo_id_name_constraint"),
+    )
     name: str
+    # head that was processed last, commits up to it are already stored
     sha: str
 
     commits: list["Commit"] = Relationship(
@@ -83,6 +112,8 @@ class Branch(SQLBase, table=True):
 class Commit(SQLBase, table=True):
     __table_args__ = (
         UniqueConstraint("sha", "branch_id", name="branch_id_sha_constraint"),
+        # keyset pagination of statistics
+        Index("commit_branch_id_committed_datetime_idx", "branch_id", "committed_datetime", "id"),
     )
     sha: str
     committed_datetime: datetime.datetime
@@ -100,15 +131,141 @@ class Commit(SQLBase, table=True):
     )
     run_finished_at: Optional[datetime.datetime] = sqlmodel.Field(default=None)
     run_error: Optional[str] = sqlmodel.Field(default=None)
-    container_stdout: Optional[str] = sqlmodel.Field(default=None)
-    container_stderr: Optional[str] = sqlmodel.Field(default=None)
     is_interrupted: Optional[bool] = sqlmodel.Field(default=None)
 
 
-class MetricUpdate(SQLBase, table=True):
+class LogStreamEnum(str, Enum):
+    stdout = "stdout"
+    stderr = "stderr"
+
+
+class CommitLog(SQLBase, table=True):
+    """Captured container output of a commit run, shared by commit rows of the sha in all branches"""
+
+    __table_args__ = (
+        UniqueConstraint("repo_id", "sha", "stream", name="repo_id_sha_stream_constraint"),
+    )
+    repo_id: int = Field(index=True, nullable=False)
+    sha: str = Field(nullable=False)
+    stream: LogStreamEnum = Field(nullable=False)
+
+    # zlib compressed head and tail of the output with a marker of the skipped middle
+    data: bytes = Field(sa_column=sqlmodel.Column(sqlmodel.LargeBinary(), nullable=False))
+    # length of decompressed data
+    size: int = Field(nullable=False)
+    # length of the whole output produced by the container
+    total_size: int = Field(nullable=False)
+    truncated: bool = Field(nullable=False)
+
+
+class MetricValue(SQLBase, table=True):
+    """One metric of a successful run result, typed and indexed for queries by metric and time range.
+
+    Written from Commit.json_run_result when a run finishes, rows of commits of one sha
+    in different branches are separate, like the commits themselves.
+    """
+
+    __table_args__ = (
+        UniqueConstraint("commit_id", "metric_name", name="metric_value_commit_id_metric_name_constraint"),
+        Index("metric_value_repo_metric_committed_idx", "repo_id", "metric_name", "committed_datetime"),
+        Index("metric_value_not_analyzed_idx", "repo_id", postgresql_where=sqlalchemy.text("not analyzed")),
+    )
+    commit_id: int = sqlmodel.Field(
+        sa_column=sqlmodel.Column(
+            sqlmodel.ForeignKey("commit.id", ondelete="CASCADE"), nullable=False
+        )
+    )
+    repo_id: int = Field(nullable=False)
+    branch_id: int = Field(nullable=False)
+    sha: str = Field(nullable=False)
+    committed_datetime: datetime.datetime = Field(nullable=False)
+
+    metric_name: str = Field(nullable=False)
+    numeric_value: Optional[float] = Field(default=None)
+    # strings and booleans, null values of metrics have neither value
+    text_value: Optional[str] = Field(default=None)
+    # reset when the value is written, set once change point analysis has seen it
+    analyzed: bool = sqlmodel.Field(
+        default=False,
+        sa_column=sqlmodel.Column(sqlmodel.Boolean(), nullable=False, server_default="false")
+    )
+
+
+class ChangeDirectionEnum(str, Enum):
+    increase = "increase"
+    decrease = "decrease"
+
+
+class MetricChangePoint(SQLBase, table=True):
+    """Commit from which a metric of a branch shifted, found by service.change_point"""
+
+    __table_args__ = (
+        UniqueConstraint(
+            "branch_id", "metric_name", "commit_id", name="metric_change_point_branch_metric_commit_constraint"
+        ),
+        Index("metric_change_point_repo_committed_idx", "repo_id", "committed_datetime"),
+    )
+    commit_id: int = sqlmodel.Field(
+        sa_column=sqlmodel.Column(
+            sqlmodel.ForeignKey("commit.id", ondelete="CASCADE"), nullable=False
+        )
+    )
+    repo_id: int = Field(nullable=False)
+    branch_id: int = Field(nullable=False)
+    sha: str = Field(nullable=False)
+    committed_datetime: datetime.datetime = Field(nullable=False)
+    metric_name: str = Field(nullable=False)
+
+    direction: ChangeDirectionEnum = Field(nullable=False)
+    # median of the values before the commit and of the commit and the following ones
+    baseline: float = Field(nullable=False)
+    value: float = Field(nullable=False)
+    # relative shift, null when the baseline is 0
+    effect_size: Optional[float] = Field(default=None)
+    # shift in MADs of the baseline, scaled to standard deviations of normal noise
+    score: float = Field(nullable=False)
+    # 0..1, how consistently the following runs sit beyond the threshold
+    confidence: float = Field(nullable=False)
+
+
+class MetricAnalysisState(SQLBase, table=True):
+    """Last point of a metric series of a branch decided by change point analysis"""
+
+    __table_args__ = (
+        UniqueConstraint("branch_id", "metric_name", name="metric_analysis_state_branch_metric_constraint"),
+    )
+    repo_id: int = Field(nullable=False, index=True)
+    branch_id: int = Field(nullable=False)
+    metric_name: str = Field(nullable=False)
+    decided_datetime: Optional[datetime.datetime] = Field(default=None)
+    decided_commit_id: Optional[int] = Field(default=None)
+
+
+class MetricAggregate(SQLBase, table=True):
+    """Running aggregate of one metric of a commit run, updated as metric updates arrive"""
+
+    __table_args__ = (
+        UniqueConstraint("commit_id", "name", name="commit_id_name_constraint"),
+    )
     commit_id: int = Field(foreign_key="commit.id")
+    name: str
 
-    data: Optional[dict] = sqlmodel.Field(
+    count: int = Field(default=0, nullable=False)
+    # JSON columns keep ints as ints, same as values in json_run_result
+    sum: Optional[int | float] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.JSON(), nullable=True)
+    )
+    min: Optional[int | float] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.JSON(), nullable=True)
+    )
+    max: Optional[int | float] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.JSON(), nullable=True)
+    )
+    last: Optional[int | float | str] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.JSON(), nullable=True)
+    )
+    # bounded [value, count] pairs, used for median and mode
+    sketch: Optional[list] = sqlmodel.Field(
         sa_column=sqlmodel.Column(sqlmodel.JSON(), nullable=True)
     )
 
@@ -131,6 +288,10 @@ class ClientMetricsConfig(pydantic.BaseModel):
 class ClientMetricsUpdate(pydantic.BaseModel):
     data: dict[str, int | float | str]
 
+    class Config:
+        # otherwise floats are coerced to int by the first member of the union
+        smart_union = True
+
 
 class RunConfig(SQLBase, table=True):
     client_ip: str = Field(unique=True, nullable=False)
@@ -141,6 +302,96 @@ class RunConfig(SQLBase, table=True):
     )
 
 
+class IpLease(SQLBase, table=True):
+    """Address of the traig docker network, leased to at most one run at a time"""
+
+    ip: str = Field(unique=True, nullable=False)
+    # integer value of ip, addresses are leased from the top of the subnet
+    position: int = Field(sa_column=sqlmodel.Column(sqlmodel.BigInteger(), nullable=False, index=True))
+    # gateway and addresses of containers attached to the network when the pool was seeded
+    reserved: bool = Field(default=False, nullable=False)
+
+    commit_id: Optional[int] = Field(default=None)
+    leased_at: Optional[datetime.datetime] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), nullable=True)
+    )
+
+
+class RunConfigSnapshot(pydantic.BaseModel):
+    """Detached read-only copy of RunConfig, safe to share between requests"""
+
+    id: int
+    client_ip: str
+    commit_id: int
+    metrics_config: Optional[dict[str, MetricTypeEnum]]
+
+    class Config:
+        allow_mutation = False
+
+
+class MetricSeriesPoint(pydantic.BaseModel):
+    committed_datetime: datetime.datetime
+    sha: str
+    value: int | float
+
+    class Config:
+        smart_union = True
+
+
+class MetricSeries(pydantic.BaseModel):
+    metric: str
+    # number of commits with a numeric value of the metric before downsampling
+    total_points: int
+    points: list[MetricSeriesPoint]
+
+
+class HttpValidatorCache(SQLBase, table=True):
+    """ETag / Last-Modified of the last processed response, keyed by hash of token, url and params"""
+
+    key: str = Field(unique=True, nullable=False)
+    etag: Optional[str] = Field(default=None)
+    last_modified: Optional[str] = Field(default=None)
+    updated_at: datetime.datetime = Field(nullable=False)
+
+
+class RunQueueStatusEnum(str, Enum):
+    queued = "queued"  # waiting for a free run slot
+    running = "running"  # dispatched to workers, holds a slot until the run finishes
+
+
+class RunQueueEntry(SQLBase, table=True):
+    """Commit waiting for or holding a run slot, created_at is the enqueue time"""
+
+    commit_id: int = sqlmodel.Field(
+        sa_column=sqlmodel.Column(
+            sqlmodel.ForeignKey("commit.id", ondelete="CASCADE"), unique=True, nullable=False
+        )
+    )
+    # denormalized, so caps and fairness are computed without joins
+    repo_id: int = Field(index=True, nullable=False)
+    account_id: int = Field(index=True, nullable=False)
+
+    status: RunQueueStatusEnum = Field(default=RunQueueStatusEnum.queued, nullable=False, index=True)
+    # within an account, higher priority and then newer commits are run first
+    priority: int = Field(default=0, nullable=False)
+    committed_datetime: datetime.datetime
+    # commit files are downloaded ahead of the run while slots are busy
+    prefetch_requested: bool = Field(default=False, nullable=False)
+    download_path: Optional[str] = Field(default=None)
+    started_at: Optional[datetime.datetime] = sqlmodel.Field(
+        sa_column=sqlmodel.Column(sqlmodel.DateTime(timezone=True), nullable=True)
+    )
+
+
+class RunQueueStats(pydantic.BaseModel):
+    queued: int
+    running: int
+    # seconds the oldest queued commit has been waiting
+    oldest_queued_wait: Optional[float]
+    # mean seconds between enqueue and start of currently running commits
+    mean_running_wait: Optional[float]
+
+
 # for name, item in list(globals().items()):
 #     if not isinstance(item, pydantic.main.ModelMetaclass):
 #         continue
@@ -0,0 +1,48 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+import redis
+from tasks.celery import redis_url
+
+
+def get_redis() -> redis.Redis:
+    if not hasattr(get_redis, "client"):
+        get_redis.client = redis.Redis.from_url(redis_url)
+
+    return get_redis.client
+
+
+def publish(channel: str, message: str):
+    try:
+        get_redis().publish(channel, message)
+    except redis.RedisError as e:
+        logging.error(f"failed to publish to {channel}: {e}")
+
+
+def subscribe(channel: str, callback: Callable[[str], None], on_reconnect: Callable[[], None] = None):
+    """Calls callback for every message in channel from a daemon thread, resubscribing on connection errors.
+
+    on_reconnect is called after every (re)subscription, since messages sent in between are lost.
+    """
+
+    def listen():
+        while True:
+            try:
+                pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                if on_reconnect is not None:
+                    on_reconnect()
+                for message in pubsub.listen():
+                    try:
+                        callback(message["data"].decode("utf-8"))
+                    except Exception as e:
+                        logging.error(f"failed to handle message from {channel}: {e}")
+            except redis.RedisError as e:
+                logging.error(f"lost subscription to {channel}, will retry: {e}")
+                time.sleep(1)
+
+    thread = threading.Thread(target=listen, name=f"subscriber-{channel}", daemon=True)
+    thread.start()
+    return thread
@@ -1,9 +1,29 @@
 import os
+import random
+from datetime import datetime, timedelta
 
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
 from sqlalchemy import create_engine
 
+# jobs that became due while no scheduler was running are spread over this many seconds after start
+startup_spread_seconds = int(os.getenv("SCHEDULER_STARTUP_SPREAD_SECONDS", "120"))
+
+
+def _spread_overdue_jobs(scheduler: BackgroundScheduler):
+    """Without this every poll missed during a restart would fire in the same second.
+
+    Interval jobs are spread over at most their interval.
+    """
+    now = datetime.now().astimezone()
+    for job in scheduler.get_jobs():
+        if job.next_run_time is None or job.next_run_time > now:
+            continue
+        spread = startup_spread_seconds
+        if getattr(job.trigger, "interval", None) is not None:
+            spread = min(spread, job.trigger.interval.total_seconds())
+        job.modify(next_run_time=now + timedelta(seconds=random.uniform(0, spread)))
+
 
 def get_jobs_scheduler() -> BackgroundScheduler:
     if not hasattr(get_jobs_scheduler, "scheduler"):
@@ -21,7 +41,9 @@ def get_jobs_scheduler() -> BackgroundScheduler:
             f"postgresql+psycopg2://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db_name}"
         )
         scheduler.add_jobstore(SQLAlchemyJobStore(engine=engine))
-        scheduler.start()
+        scheduler.start(paused=True)
+        _spread_overdue_jobs(scheduler)
+        scheduler.resume()
 
         get_jobs_scheduler.scheduler = scheduler
 
@@ -0,0 +1,193 @@
+import bisect
+import os
+from typing import Any
+
+import sqlmodel
+from exception import ServerFailure
+from model import (
+    ClientMetricsUpdate,
+    MetricAggregate,
+    MetricTypeEnum,
+    RunConfig,
+    RunConfigSnapshot,
+)
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+median_sketch_size = int(os.getenv("METRIC_MEDIAN_SKETCH_SIZE", "512"))
+mode_sketch_size = int(os.getenv("METRIC_MODE_SKETCH_SIZE", "512"))
+
+numeric_metric_types = (
+    MetricTypeEnum.max,
+    MetricTypeEnum.min,
+    MetricTypeEnum.sum,
+    MetricTypeEnum.mean,
+    MetricTypeEnum.median,
+)
+
+
+def _as_number(value: Any) -> int | float | None:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _add_to_median_sketch(centroids: list[list], value: float) -> list[list]:
+    """Keeps sorted [value, count] pairs, merging the two closest ones when there are too many.
+
+    The median is exact while number of distinct values fits into the sketch.
+    """
+    values = [c[0] for c in centroids]
+    i = bisect.bisect_left(values, value)
+    if i < len(centroids) and centroids[i][0] == value:
+        centroids[i][1] += 1
+        return centroids
+
+    centroids.insert(i, [value, 1])
+    if len(centroids) <= median_sketch_size:
+        return centroids
+
+    gaps = [centroids[j + 1][0] - centroids[j][0] for j in range(len(centroids) - 1)]
+    j = gaps.index(min(gaps))
+    (left, left_count), (right, right_count) = centroids[j], centroids[j + 1]
+    count = left_count + right_count
+    centroids[j : j + 2] = [[(left * left_count + right * right_count) / count, count]]
+    return centroids
+
+
+def _median_from_sketch(centroids: list[list]):
+    total = sum(c[1] for c in centroids)
+
+    def value_at(rank: int):
+        seen = 0
+        for value, count in centroids:
+            seen += count
+            if rank < seen:
+                return value
+
+    lower, upper = value_at((total - 1) // 2), value_at(total // 2)
+    return lower if lower == upper else (lower + upper) / 2
+
+
+def _add_to_mode_sketch(counters: list[list], value: Any) -> list[list]:
+    """Misra-Gries heavy hitters over [value, count] pairs, exact while distinct values fit into the sketch"""
+    for counter in counters:
+        if counter[0] == value and type(counter[0]) is type(value):
+            counter[1] += 1
+            return counters
+
+    if len(counters) < mode_sketch_size:
+        counters.append([value, 1])
+        return counters
+
+    return [[v, c - 1] for v, c in counters if c > 1]
+
+
+def _mode_from_sketch(counters: list[list]):
+    max_count = max(c for _, c in counters)
+    result = [v for v, c in counters if c == max_count]
+    return result[0] if len(result) == 1 else result
+
+
+def fold_metric_value(aggregate: MetricAggregate, metric_type: MetricTypeEnum, value: Any):
+    aggregate.count += 1
+    aggregate.last = value
+
+    number = _as_number(value) if metric_type in numeric_metric_types else None
+    if number is not None:
+        aggregate.sum = number if aggregate.sum is None else aggregate.sum + number
+        aggregate.min = number if aggregate.min is None else min(aggregate.min, number)
+        aggregate.max = number if aggregate.max is None else max(aggregate.max, number)
+
+    # JSON columns are not tracked for in-place mutations, so the sketch is always reassigned
+    if metric_type == MetricTypeEnum.median and number is not None:
+        aggregate.sketch = _add_to_median_sketch([list(c) for c in aggregate.sketch or []], number)
+    elif metric_type == MetricTypeEnum.mode:
+        aggregate.sketch = _add_to_mode_sketch([list(c) for c in aggregate.sketch or []], value)
+
+
+def finalize_metric_aggregate(aggregate: MetricAggregate, metric_type: MetricTypeEnum):
+    if aggregate.count == 0:
+        return None
+    elif metric_type == MetricTypeEnum.value:
+        return aggregate.last
+    elif metric_type == MetricTypeEnum.max:
+        return aggregate.max
+    elif metric_type == MetricTypeEnum.min:
+        return aggregate.min
+    elif metric_type == MetricTypeEnum.sum:
+        return aggregate.sum
+    elif metric_type == MetricTypeEnum.mean:
+        return None if aggregate.sum is None else aggregate.sum / aggregate.count
+    elif metric_type == MetricTypeEnum.median:
+        return _median_from_sketch(aggregate.sketch) if aggregate.sketch else None
+    elif metric_type == MetricTypeEnum.count:
+        return aggregate.count
+    elif metric_type == MetricTypeEnum.mode:
+        return _mode_from_sketch(aggregate.sketch) if aggregate.sketch else None
+    else:
+        raise ServerFailure(f'metric type "{metric_type}" is not known')
+
+
+def _lock_aggregates_stmt(commit_ids: list[int]):
+    return (
+        sqlmodel.select(MetricAggregate)
+        .where(MetricAggregate.commit_id.in_(commit_ids))
+        .order_by(MetricAggregate.commit_id, MetricAggregate.name)
+        .with_for_update()
+    )
+
+
+def _fold_batches(
+    aggregates: list[MetricAggregate],
+    batches: list[tuple[RunConfig | RunConfigSnapshot, list[ClientMetricsUpdate]]],
+) -> list[MetricAggregate]:
+    by_key = {(a.commit_id, a.name): a for a in aggregates}
+
+    for run_config, updates in batches:
+        for metrics in updates:
+            for metric_name, metric_value in metrics.data.items():
+                key = (run_config.commit_id, metric_name)
+                if key not in by_key:
+                    by_key[key] = MetricAggregate(
+                        commit_id=run_config.commit_id, name=metric_name, count=0
+                    )
+                fold_metric_value(
+                    by_key[key],
+                    run_config.metrics_config[metric_name],
+                    metric_value,
+                )
+
+    return list(by_key.values())
+
+
+def fold_metric_updates(
+    batches: list[tuple[RunConfig | RunConfigSnapshot, list[ClientMetricsUpdate]]],
+    session: Session,
+):
+    """Folds updates of one or more commits into their running aggregates in one transaction.
+
+    Aggregate rows are locked in (commit_id, name) order, so concurrent folds are serialized without deadlocks.
+    """
+    commit_ids = sorted({run_config.commit_id for run_config, _ in batches})
+    aggregates = session.exec(_lock_aggregates_stmt(commit_ids)).all()
+
+    session.add_all(_fold_batches(aggregates, batches))
+    session.commit()
+
+
+async def fold_metric_updates_async(
+    batches: list[tuple[RunConfig | RunConfigSnapshot, list[ClientMetricsUpdate]]],
+    session: AsyncSession,
+):
+    """Same as fold_metric_updates, for the async engine"""
+    commit_ids = sorted({run_config.commit_id for run_config, _ in batches})
+    aggregates = (await session.exec(_lock_aggregates_stmt(commit_ids))).all()
+
+    session.add_all(_fold_batches(aggregates, batches))
+    await session.commit()
@@ -0,0 +1,227 @@
+import logging
+import os
+from typing import NamedTuple, Optional
+
+import numpy as np
+import sqlmodel
+from db import local_session
+from model import (
+    ChangeDirectionEnum,
+    MetricAnalysisState,
+    MetricChangePoint,
+    MetricValue,
+)
+from numpy.lib.stride_tricks import sliding_window_view
+from sqlalchemy import delete, func, tuple_, update
+from sqlmodel import Session
+
+# values before a commit it is compared with, also the minimal distance between two change points
+window = int(os.getenv("CHANGE_POINT_WINDOW", "20"))
+# the commit and the following values whose median has to be shifted, so one noisy run is not flagged
+confirm_points = int(os.getenv("CHANGE_POINT_CONFIRM_POINTS", "3"))
+# commits with fewer values before them are never flagged
+min_history = int(os.getenv("CHANGE_POINT_MIN_HISTORY", "5"))
+score_threshold = float(os.getenv("CHANGE_POINT_SCORE_THRESHOLD", "4"))
+# relative shift, keeps metrics without noise from flagging every tiny change
+min_effect = float(os.getenv("CHANGE_POINT_MIN_EFFECT", "0.05"))
+
+# MAD of normal noise times this is its standard deviation
+_MAD_SCALE = 1.4826
+# first key of pg_advisory_xact_lock(class, repo_id) taken while series of a repo are analyzed
+_ANALYSIS_LOCK_CLASS = 3
+
+
+class ChangePoints(NamedTuple):
+    # index of the last point a decision was made for, None if no point has enough values after it
+    decided: Optional[int]
+    positions: np.ndarray
+    baseline: np.ndarray
+    shifted: np.ndarray
+    effect_size: np.ndarray
+    score: np.ndarray
+    confidence: np.ndarray
+
+
+def find_change_points(values: np.ndarray, start: int) -> ChangePoints:
+    """Change points among values[start:], values before start are history that was already decided.
+
+    Every point is scored by the shift of the median of it and the following confirm_points - 1 values
+    from the median of the window values before it, in scaled MADs of those. A point is flagged when both
+    the shift and the point itself pass score_threshold and the shift is at least min_effect relative,
+    of the flags within window points only the first one is kept, at the start of the shift.
+    values before start are expected to include 2 * window points of history, or the whole series.
+    """
+    n = len(values)
+    last = n - confirm_points
+    first = max(start - window, min_history)
+    empty = np.empty(0)
+    if last < start:
+        return ChangePoints(None, empty.astype(int), empty, empty, empty, empty, empty)
+    if last < first:
+        return ChangePoints(last, empty.astype(int), empty, empty, empty, empty, empty)
+
+    # points from first on, the ones before start are only scored to suppress repeated flags
+    positions = np.arange(first, last + 1)
+    # before[i] are values[p - window:p] of p = positions[i], padded with nan at the series start
+    padded = np.concatenate([np.full(window, np.nan), values])
+    before = sliding_window_view(padded, window)[positions]
+    after = sliding_window_view(values, confirm_points)[positions]
+
+    baseline = np.nanmedian(before, axis=1)
+    mad = np.nanmedian(np.abs(before - baseline[:, None]), axis=1)
+    # a series without noise has zero MAD, its scale is floored so a min_effect shift scores the threshold
+    scale = np.maximum(_MAD_SCALE * mad, min_effect * np.abs(baseline) / score_threshold)
+    scale = np.maximum(scale, 1e-12)
+
+    shifted = np.median(after, axis=1)
+    shift = shifted - baseline
+    direction = np.sign(shift)
+    score = np.abs(shift) / scale
+    # scores of the individual after values in the direction of the shift, < 0 when on the other side
+    after_scores = (after - baseline[:, None]) * direction[:, None] / scale[:, None]
+    effect_size = np.divide(
+        shift, np.abs(baseline), out=np.full_like(shift, np.nan), where=baseline != 0
+    )
+
+    flagged = (
+        (score >= score_threshold)
+        & (after_scores[:, 0] >= score_threshold)
+        & (np.isnan(effect_size) | (np.abs(effect_size) >= min_effect))
+    )
+    # number of flags among the window points before every position
+    flags_before = np.concatenate([[0], np.cumsum(flagged)])
+    lower = np.maximum(np.arange(len(positions)) - window, 0)
+    kept = flagged & (flags_before[:-1] - flags_before[lower] == 0) & (positions >= start)
+
+    confidence = np.clip(after_scores / score_threshold, 0, 1).mean(axis=1)
+    return ChangePoints(
+        last,
+        positions[kept],
+        baseline[kept],
+        shifted[kept],
+        effect_size[kept],
+        score[kept],
+        confidence[kept],
+    )
+
+
+def _series_query(branch_id: int, metric_name: str, *columns):
+    return sqlmodel.select(*columns).where(
+        MetricValue.branch_id == branch_id,
+        MetricValue.metric_name == metric_name,
+        MetricValue.numeric_value != None,
+    )
+
+
+def analyze_series(repo_id: int, branch_id: int, metric_name: str, session: Session) -> int:
+    """Decides points of the series from its first changed or undecided one, returns the number of change points"""
+    key_columns = (MetricValue.committed_datetime, MetricValue.commit_id)
+    point_key = tuple_(*key_columns)
+    state = session.exec(
+        sqlmodel.select(MetricAnalysisState).where(
+            MetricAnalysisState.branch_id == branch_id,
+            MetricAnalysisState.metric_name == metric_name,
+        )
+    ).first()
+    if state is None:
+        state = MetricAnalysisState(repo_id=repo_id, branch_id=branch_id, metric_name=metric_name)
+
+    # values written since the last analysis may be older than already decided points
+    starts = [
+        session.exec(
+            _series_query(branch_id, metric_name, *key_columns)
+            .where(MetricValue.analyzed == False)
+            .order_by(*key_columns)
+            .limit(1)
+        ).first()
+    ]
+    # and the first undecided point, which is the first point of the series until one is decided
+    undecided = _series_query(branch_id, metric_name, *key_columns)
+    if state.decided_commit_id is not None:
+        undecided = undecided.where(point_key > tuple_(state.decided_datetime, state.decided_commit_id))
+    starts.append(session.exec(undecided.order_by(*key_columns).limit(1)).first())
+    starts = [tuple(s) for s in starts if s is not None]
+    if len(starts) == 0:
+        return 0
+    start = min(starts)
+
+    columns = (
+        MetricValue.id,
+        MetricValue.commit_id,
+        MetricValue.sha,
+        MetricValue.committed_datetime,
+        MetricValue.numeric_value,
+    )
+    history = session.exec(
+        _series_query(branch_id, metric_name, *columns)
+        .where(point_key < tuple_(*start))
+        .order_by(MetricValue.committed_datetime.desc(), MetricValue.commit_id.desc())
+        .limit(2 * window)
+    ).all()[::-1]
+    new = session.exec(
+        _series_query(branch_id, metric_name, *columns)
+        .where(point_key >= tuple_(*start))
+        .order_by(*key_columns)
+    ).all()
+    points = history + new
+
+    found = find_change_points(np.array([p.numeric_value for p in points], dtype=float), len(history))
+
+    session.exec(
+        delete(MetricChangePoint).where(
+            MetricChangePoint.branch_id == branch_id,
+            MetricChangePoint.metric_name == metric_name,
+            tuple_(MetricChangePoint.committed_datetime, MetricChangePoint.commit_id) >= tuple_(*start),
+        )
+    )
+    for i, position in enumerate(found.positions):
+        point = points[position]
+        increased = found.shifted[i] > found.baseline[i]
+        session.add(
+            MetricChangePoint(
+                commit_id=point.commit_id,
+                repo_id=repo_id,
+                branch_id=branch_id,
+                sha=point.sha,
+                committed_datetime=point.committed_datetime,
+                metric_name=metric_name,
+                direction=ChangeDirectionEnum.increase if increased else ChangeDirectionEnum.decrease,
+                baseline=float(found.baseline[i]),
+                value=float(found.shifted[i]),
+                effect_size=None if np.isnan(found.effect_size[i]) else float(found.effect_size[i]),
+                score=float(found.score[i]),
+                confidence=float(found.confidence[i]),
+            )
+        )
+
+    session.exec(
+        update(MetricValue).where(MetricValue.id.in_([p.id for p in new])).values(analyzed=True)
+    )
+    if found.decided is not None and found.decided >= len(history):
+        state.decided_datetime = points[found.decided].committed_datetime
+        state.decided_commit_id = points[found.decided].commit_id
+    session.add(state)
+    return len(found.positions)
+
+
+def detect_change_points(repo_id: int):
+    """Analyzes every metric series of the repo with values not analyzed yet, called when a run finishes"""
+    with local_session() as session:
+        session.exec(sqlmodel.select(func.pg_advisory_xact_lock(_ANALYSIS_LOCK_CLASS, repo_id)))
+        series = session.exec(
+            sqlmodel.select(MetricValue.branch_id, MetricValue.metric_name)
+            .where(
+                MetricValue.repo_id == repo_id,
+                MetricValue.analyzed == False,
+                MetricValue.numeric_value != None,
+            )
+            .distinct()
+        ).all()
+
+        found = 0
+        for branch_id, metric_name in series:
+            found += analyze_series(repo_id, branch_id, metric_name, session)
+        session.commit()
+
+    if found:
+        logging.info(f"found {found} change points in repo_id={repo_id}")
@@ -0,0 +1,78 @@
+import sqlmodel
+from model import Branch, Commit, RunQueueEntry
+from service.metric_value import write_metric_values
+from sqlalchemy import update
+from sqlalchemy.orm import aliased
+from sqlmodel import Session
+
+# Commit rows of one sha in different branches of a repo share a single run, these fields are its result
+run_result_fields = (
+    "processed",
+    "run_ok",
+    "json_run_result",
+    "run_finished_at",
+    "run_error",
+    "is_interrupted",
+)
+
+
+def _repo_branch_ids(repo_id: int):
+    return sqlmodel.select(Branch.id).where(Branch.repo_id == repo_id)
+
+
+def fan_out_run_result(commit: Commit, repo_id: int, session: Session):
+    """Copies run result of commit to unprocessed rows of the same sha in other branches of the repo
+    and writes metric values of all of them"""
+    session.exec(
+        update(Commit)
+        .where(
+            Commit.sha == commit.sha,
+            Commit.id != commit.id,
+            Commit.processed == False,
+            Commit.branch_id.in_(_repo_branch_ids(repo_id)),
+        )
+        .values({field: getattr(commit, field) for field in run_result_fields})
+        .execution_options(synchronize_session=False)
+    )
+    write_metric_values(session, repo_id=repo_id, sha=commit.sha)
+
+
+def adopt_existing_run_results(repo_id: int, session: Session):
+    """Unprocessed commits whose sha was already run in another branch take over that result,
+    this covers commits that became reachable from a new branch after the run"""
+    source = aliased(Commit)
+    session.exec(
+        update(Commit)
+        .where(
+            Commit.processed == False,
+            Commit.branch_id.in_(_repo_branch_ids(repo_id)),
+            source.sha == Commit.sha,
+            source.processed == True,
+            source.branch_id.in_(_repo_branch_ids(repo_id)),
+        )
+        .values({field: getattr(source, field) for field in run_result_fields})
+        .execution_options(synchronize_session=False)
+    )
+    write_metric_values(session, repo_id=repo_id, missing_only=True)
+
+
+def get_commits_to_run(repo_id: int, session: Session) -> list[Commit]:
+    """One unprocessed commit per sha of the repo, skipping shas that are already queued or running"""
+    queued = aliased(Commit)
+    sha_is_queued = (
+        sqlmodel.select(RunQueueEntry.id)
+        .join(queued, queued.id == RunQueueEntry.commit_id)
+        .where(RunQueueEntry.repo_id == repo_id, queued.sha == Commit.sha)
+        .exists()
+    )
+    return session.exec(
+        sqlmodel.select(Commit)
+        .join(Branch, Branch.id == Commit.branch_id)
+        .distinct(Commit.sha)
+        .where(
+            Branch.repo_id == repo_id,
+            Commit.processed == False,
+            ~sha_is_queued,
+        )
+        .order_by(Commit.sha, Commit.id)
+    ).all()
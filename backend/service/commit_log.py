@@ -0,0 +1,58 @@
+import zlib
+from typing import Optional
+
+import sqlmodel
+from exception import ClientFailure
+from model import CommitLog, LogStreamEnum
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+
+
+def save_commit_log(
+    repo_id: int, sha: str, stream: LogStreamEnum, data: bytes, total_size: int, session: Session
+):
+    """Replaces log of a previous run of the sha, if any"""
+    stmt = insert(CommitLog).values(
+        repo_id=repo_id,
+        sha=sha,
+        stream=stream,
+        data=zlib.compress(data),
+        size=len(data),
+        total_size=total_size,
+        truncated=total_size > len(data),
+    )
+    session.exec(
+        stmt.on_conflict_do_update(
+            constraint="repo_id_sha_stream_constraint",
+            set_={
+                "data": stmt.excluded.data,
+                "size": stmt.excluded.size,
+                "total_size": stmt.excluded.total_size,
+                "truncated": stmt.excluded.truncated,
+            },
+        )
+    )
+
+
+def read_commit_log(
+    repo_id: int,
+    sha: str,
+    stream: LogStreamEnum,
+    session: Session,
+    offset: int = 0,
+    length: Optional[int] = None,
+    tail: Optional[int] = None,
+) -> tuple[bytes, int, int, CommitLog]:
+    """Returns requested bytes of decompressed log with their start and end, tail takes precedence over offset"""
+    log = session.exec(
+        sqlmodel.select(CommitLog).where(
+            CommitLog.repo_id == repo_id, CommitLog.sha == sha, CommitLog.stream == stream
+        )
+    ).first()
+    if log is None:
+        raise ClientFailure("no log for such commit")
+
+    data = zlib.decompress(log.data)
+    start = max(len(data) - tail, 0) if tail is not None else min(offset, len(data))
+    end = len(data) if length is None else min(start + length, len(data))
+    return data[start:end], start, end, log
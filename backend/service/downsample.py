@@ -0,0 +1,55 @@
+from typing import Sequence
+
+
+def lttb(xs: Sequence[float], ys: Sequence[float], threshold: int) -> list[int]:
+    """Largest-Triangle-Three-Buckets, returns indices of the points to keep.
+
+    First and last points are always kept, from every bucket in between the point forming the largest
+    triangle with the previously kept point and the mean of the next bucket is taken, so spikes survive.
+    """
+    n = len(xs)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        return [0, n - 1][:threshold]
+
+    kept = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        next_start, next_end = end, min(int((i + 2) * bucket_size) + 1, n)
+        next_count = next_end - next_start
+        mean_x = sum(xs[next_start:next_end]) / next_count
+        mean_y = sum(ys[next_start:next_end]) / next_count
+
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((xs[a] - mean_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (mean_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        kept.append(best)
+        a = best
+
+    kept.append(n - 1)
+    return kept
+
+
+def min_max_buckets(ys: Sequence[float], threshold: int) -> list[int]:
+    """Indices of minimum and maximum of every bucket, in order, threshold // 2 buckets"""
+    n = len(ys)
+    if threshold >= n:
+        return list(range(n))
+
+    buckets = max(threshold // 2, 1)
+    kept = []
+    for i in range(buckets):
+        start, end = i * n // buckets, (i + 1) * n // buckets
+        if start == end:
+            continue
+        low = min(range(start, end), key=ys.__getitem__)
+        high = max(range(start, end), key=ys.__getitem__)
+        kept.extend(sorted({low, high}))
+    return kept
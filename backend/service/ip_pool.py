@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import subprocess
+from datetime import datetime, timedelta, timezone
+from ipaddress import IPv4Network
+
+import sqlmodel
+from db import local_session
+from exception import ServerFailure
+from model import IpLease, RunConfig
+from sqlalchemy import delete, func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+
+docker_network_name = os.getenv("DOCKER_NETWORK_NAME", "traig_traignetwork")
+# leases held longer than this belong to crashed workers and are given to new runs
+lease_ttl = timedelta(seconds=int(os.getenv("IP_LEASE_TTL_SECONDS", "3600")))
+
+# first key of pg_advisory_xact_lock(class, 0) taken while the pool is seeded
+_SEED_LOCK_CLASS = 2
+
+
+def get_traig_docker_network_subnet() -> tuple[str, list[str], str | None]:
+    """Subnet, addresses of attached containers and ip range of dynamic allocation if configured"""
+    result = subprocess.run(
+        f"docker network inspect {docker_network_name}",
+        shell=True,
+        check=True,
+        capture_output=True,
+    )
+    network_info = [
+        x for x in json.loads(result.stdout) if x["Name"] == docker_network_name
+    ][0]
+    ipam_config = network_info["IPAM"]["Config"][0]
+    reserved_ips = [
+        x["IPv4Address"].split("/")[0] for x in network_info["Containers"].values()
+    ]
+    return ipam_config["Subnet"], reserved_ips, ipam_config.get("IPRange") or None
+
+
+def _seed_ip_pool(session: Session):
+    subnet_str, reserved_ips, ip_range = get_traig_docker_network_subnet()
+    network = IPv4Network(subnet_str)
+    dynamic_range = IPv4Network(ip_range) if ip_range else None
+
+    hosts = network.hosts()
+    gateway = next(hosts)
+    rows = [{"ip": str(gateway), "position": int(gateway), "reserved": True}]
+    for host in hosts:
+        reserved = str(host) in reserved_ips or (dynamic_range is not None and host in dynamic_range)
+        rows.append({"ip": str(host), "position": int(host), "reserved": reserved})
+
+    for i in range(0, len(rows), 5000):
+        session.exec(
+            insert(IpLease).values(rows[i:i + 5000]).on_conflict_do_nothing(index_elements=[IpLease.ip])
+        )
+    logging.info(f"seeded ip pool with {len(rows)} addresses of {subnet_str}")
+
+
+def ensure_ip_pool(session: Session):
+    """Seeds the pool from the docker network once, an empty table means it was never seeded"""
+    if session.exec(sqlmodel.select(IpLease.id).limit(1)).first() is not None:
+        return
+
+    session.exec(sqlmodel.select(func.pg_advisory_xact_lock(_SEED_LOCK_CLASS, 0)))
+    if session.exec(sqlmodel.select(IpLease.id).limit(1)).first() is None:
+        _seed_ip_pool(session)
+    session.commit()
+
+
+def lease_ip_for_commit(commit_id: int) -> RunConfig:
+    """Takes a free or stale address with SELECT ... FOR UPDATE SKIP LOCKED and creates RunConfig for it.
+
+    Concurrent allocators skip rows locked by each other instead of waiting or retrying on conflicts.
+    Addresses are taken from the top of the subnet, docker assigns dynamic ones from the bottom.
+    """
+    with local_session() as session:
+        ensure_ip_pool(session)
+
+        now = datetime.now(timezone.utc)
+        lease = session.exec(
+            sqlmodel.select(IpLease)
+            .where(
+                IpLease.reserved == False,
+                or_(IpLease.commit_id == None, IpLease.leased_at < now - lease_ttl),
+            )
+            .order_by(IpLease.position.desc())
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if lease is None:
+            raise ServerFailure("unable to find available ip, will retry later")
+
+        if lease.commit_id is not None:
+            logging.warning(
+                f"reclaiming ip {lease.ip} leased at {lease.leased_at} for commit_id={lease.commit_id}"
+            )
+        # left behind by a crashed run, client_ip is unique
+        session.exec(delete(RunConfig).where(RunConfig.client_ip == lease.ip))
+
+        lease.commit_id = commit_id
+        lease.leased_at = now
+        session.add(lease)
+
+        run_config = RunConfig(commit_id=commit_id, client_ip=lease.ip)
+        session.add(run_config)
+        session.commit()
+        session.refresh(run_config)
+
+    return run_config
+
+
+def release_ip(ip: str, commit_id: int, session: Session):
+    """Frees the lease unless it was already reclaimed by another run"""
+    session.exec(
+        update(IpLease)
+        .where(IpLease.ip == ip, IpLease.commit_id == commit_id)
+        .values(commit_id=None, leased_at=None)
+    )
@@ -1,19 +1,32 @@
 import logging
+import math
 
 import sqlmodel
+from fastapi.concurrency import run_in_threadpool
 from exception import ClientFailure, ServerFailure
 from model import (
     ClientMetricsConfig,
     ClientMetricsUpdate,
+    MetricAggregate,
     MetricTypeEnum,
-    MetricUpdate,
     RunConfig,
+    RunConfigSnapshot,
 )
-from sqlmodel import Session
+from service.aggregate import fold_metric_updates_async
+from service.metric_buffer import metric_update_buffer, write_behind_enabled
+from service.run_config_cache import (
+    publish_run_config_invalidation,
+    run_config_cache,
+    snapshot_run_config,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 
-def save_metrics_config(metrics: ClientMetricsConfig, ip: str, session: Session):
-    run_config = get_run_config_by_client_ip(ip, session)
+async def save_metrics_config(
+    metrics: ClientMetricsConfig, ip: str, session: AsyncSession
+):
+    run_config = await get_run_config_by_client_ip(ip, session)
     logging.debug(
         f"got init for metrics: {metrics.data} from ip={ip}, "
         f"resolved commit_id={run_config.commit_id}"
@@ -21,20 +34,35 @@ def save_metrics_config(metrics: ClientMetricsConfig, ip: str, session: Session)
 
     run_config.metrics_config = metrics.data
     session.add(run_config)
-    session.commit()
+
+    if len(metrics.data) > 0:
+        await session.exec(
+            insert(MetricAggregate)
+            .values(
+                [
+                    {"commit_id": run_config.commit_id, "name": name, "count": 0}
+                    for name in metrics.data.keys()
+                ]
+            )
+            .on_conflict_do_nothing(
+                index_elements=MetricAggregate.__table_args__[0].columns
+            )
+        )
+    await session.commit()
+
+    await run_in_threadpool(publish_run_config_invalidation, ip)
 
 
 def is_number(s):
     try:
-        float(s)
-        return True
-    except ValueError:
+        return math.isfinite(float(s))
+    except (TypeError, ValueError):
         return False
 
 
-def get_run_config_by_client_ip(ip: str, session: Session) -> RunConfig:
-    run_config = session.exec(
-        sqlmodel.select(RunConfig).where(RunConfig.client_ip == ip)
+async def get_run_config_by_client_ip(ip: str, session: AsyncSession) -> RunConfig:
+    run_config = (
+        await session.exec(sqlmodel.select(RunConfig).where(RunConfig.client_ip == ip))
     ).first()
     if not run_config:
         raise ServerFailure(f"unknown client ip: {ip}")
@@ -42,13 +70,23 @@ def get_run_config_by_client_ip(ip: str, session: Session) -> RunConfig:
     return run_config
 
 
-def add_metric_update(metrics: ClientMetricsUpdate, ip: str, session: Session):
-    run_config = get_run_config_by_client_ip(ip, session)
-    logging.debug(
-        f"got update for metrics: {metrics.data} from ip={ip}, "
-        f"resolved commit_id={run_config.commit_id}"
-    )
+async def get_cached_run_config_by_client_ip(
+    ip: str, session: AsyncSession
+) -> RunConfigSnapshot:
+    run_config = run_config_cache.get(ip)
+    if run_config is not None:
+        return run_config
+
+    generation = run_config_cache.generation
+    run_config = snapshot_run_config(await get_run_config_by_client_ip(ip, session))
+    run_config_cache.put(run_config, generation)
+
+    return run_config
+
 
+def validate_metric_update(
+    metrics: ClientMetricsUpdate, run_config: RunConfig | RunConfigSnapshot
+):
     if not run_config.metrics_config:
         raise ClientFailure(
             f"trying to update metrics for commit_id={run_config.commit_id} before init. "
@@ -62,6 +100,12 @@ def add_metric_update(metrics: ClientMetricsUpdate, ip: str, session: Session):
                 f'metric "{metric_name}" was not defined during init, aborting update'
             )
 
+        # json columns of postgres can not store nan and infinities
+        if isinstance(metric_value, float) and not math.isfinite(metric_value):
+            raise ClientFailure(
+                f'value for metric "{metric_name}" must be finite, but it is "{metric_value}"'
+            )
+
         if run_config.metrics_config[metric_name] in (
             MetricTypeEnum.max,
             MetricTypeEnum.min,
@@ -73,7 +117,47 @@ def add_metric_update(metrics: ClientMetricsUpdate, ip: str, session: Session):
                 f' must be a number, but it is "{metric_value}"'
             )
 
-    update = MetricUpdate(commit_id=run_config.commit_id, data=metrics.data)
 
-    session.add(update)
-    session.commit()
+async def add_metric_update(
+    metrics: ClientMetricsUpdate, ip: str, session: AsyncSession
+):
+    run_config = await get_cached_run_config_by_client_ip(ip, session)
+    logging.debug(
+        f"got update for metrics: {metrics.data} from ip={ip}, "
+        f"resolved commit_id={run_config.commit_id}"
+    )
+
+    await apply_metric_updates([metrics], run_config, session)
+
+
+async def apply_metric_updates(
+    updates: list[ClientMetricsUpdate],
+    run_config: RunConfig | RunConfigSnapshot,
+    session: AsyncSession,
+):
+    """Validates all updates first, then folds them into aggregates in one transaction
+    or hands them to the write-behind buffer when METRIC_WRITE_BEHIND=1"""
+    for metrics in updates:
+        validate_metric_update(metrics, run_config)
+
+    if len(updates) == 0:
+        return
+
+    if write_behind_enabled:
+        # waiting for room in the buffer must not block the event loop
+        if not metric_update_buffer.try_put(updates, run_config):
+            await run_in_threadpool(metric_update_buffer.put, updates, run_config)
+    else:
+        await fold_metric_updates_async([(run_config, updates)], session)
+
+
+async def add_metric_updates(
+    updates: list[ClientMetricsUpdate], ip: str, session: AsyncSession
+):
+    run_config = await get_cached_run_config_by_client_ip(ip, session)
+    logging.debug(
+        f"got batch of {len(updates)} metric updates from ip={ip}, "
+        f"resolved commit_id={run_config.commit_id}"
+    )
+
+    await apply_metric_updates(updates, run_config, session)
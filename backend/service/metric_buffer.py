@@ -0,0 +1,231 @@
+import logging
+import os
+import threading
+import time
+
+import pubsub
+from db import local_session
+from exception import ServerFailure
+from model import ClientMetricsUpdate, RunConfigSnapshot
+from service.aggregate import fold_metric_updates
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+METRIC_BUFFER_DRAIN_CHANNEL = "traig:metric_buffer:drain"
+
+write_behind_enabled = os.getenv("METRIC_WRITE_BEHIND", "0") == "1"
+
+
+def drained_key(commit_id: int) -> str:
+    return f"traig:metric_buffer:drained:{commit_id}"
+
+
+def _is_transient(error: Exception) -> bool:
+    """Database unavailable or overloaded, the updates themselves are fine"""
+    return isinstance(error, (OperationalError, InterfaceError, PoolTimeoutError))
+
+
+class MetricUpdateBuffer:
+    """Bounded in-memory queue of validated metric updates, folded into aggregates by a background flusher"""
+
+    def __init__(
+        self,
+        max_size: int,
+        flush_size: int,
+        flush_interval_seconds: float,
+        put_timeout_seconds: float,
+        max_flush_attempts: int,
+        max_flush_backoff_seconds: float,
+    ):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.put_timeout_seconds = put_timeout_seconds
+        self.max_flush_attempts = max_flush_attempts
+        self.max_flush_backoff_seconds = max_flush_backoff_seconds
+
+        self._pending: dict[int, tuple[RunConfigSnapshot, list[ClientMetricsUpdate]]] = {}
+        self._size = 0
+        self._condition = threading.Condition()
+        # only one flush at a time, otherwise batches of one commit could be folded out of order
+        self._flush_lock = threading.Lock()
+        # commit_id -> number of flushes in a row the database rejected its updates in
+        self._rejections: dict[int, int] = {}
+
+    def _append(self, updates: list[ClientMetricsUpdate], run_config: RunConfigSnapshot):
+        if run_config.commit_id in self._pending:
+            self._pending[run_config.commit_id][1].extend(updates)
+        else:
+            self._pending[run_config.commit_id] = (run_config, list(updates))
+        self._size += len(updates)
+
+        if self._size >= self.flush_size:
+            self._condition.notify_all()
+
+    def _has_room(self, count: int) -> bool:
+        return self._size == 0 or self._size + count <= self.max_size
+
+    def try_put(self, updates: list[ClientMetricsUpdate], run_config: RunConfigSnapshot) -> bool:
+        """Never blocks, returns False when the buffer is full"""
+        with self._condition:
+            if not self._has_room(len(updates)):
+                self._condition.notify_all()
+                return False
+            self._append(updates, run_config)
+            return True
+
+    def put(self, updates: list[ClientMetricsUpdate], run_config: RunConfigSnapshot):
+        """Blocks while the buffer is full, fails after put_timeout_seconds"""
+        with self._condition:
+            deadline = time.monotonic() + self.put_timeout_seconds
+            while not self._has_room(len(updates)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ServerFailure("metric update buffer is full, retry later")
+                self._condition.notify_all()
+                self._condition.wait(remaining)
+
+            self._append(updates, run_config)
+
+    def _take(self, commit_id: int = None) -> list[tuple[RunConfigSnapshot, list[ClientMetricsUpdate]]]:
+        with self._condition:
+            if commit_id is None:
+                batches = list(self._pending.values())
+                self._pending = {}
+            else:
+                batch = self._pending.pop(commit_id, None)
+                batches = [] if batch is None else [batch]
+            self._size -= sum(len(updates) for _, updates in batches)
+            self._condition.notify_all()
+        return batches
+
+    def _requeue(self, batches: list[tuple[RunConfigSnapshot, list[ClientMetricsUpdate]]]):
+        """Puts failed batches back before the updates that arrived during the flush"""
+        with self._condition:
+            for run_config, updates in batches:
+                pending = self._pending.pop(run_config.commit_id, None)
+                newer = [] if pending is None else pending[1]
+                self._pending[run_config.commit_id] = (run_config, updates + newer)
+                self._size += len(updates)
+
+    def _fold(self, batches: list[tuple[RunConfigSnapshot, list[ClientMetricsUpdate]]]) -> Exception | None:
+        try:
+            with local_session() as session:
+                fold_metric_updates(batches, session)
+        except Exception as e:
+            return e
+        for run_config, _ in batches:
+            self._rejections.pop(run_config.commit_id, None)
+        return None
+
+    def _may_retry(self, batch: tuple[RunConfigSnapshot, list[ClientMetricsUpdate]], error: Exception) -> bool:
+        run_config, updates = batch
+        attempts = self._rejections.pop(run_config.commit_id, 0) + 1
+        if attempts < self.max_flush_attempts:
+            self._rejections[run_config.commit_id] = attempts
+            return True
+        logging.error(
+            f"dropping {len(updates)} metric updates of commit_id={run_config.commit_id}, "
+            f"rejected {attempts} times: {error}"
+        )
+        return False
+
+    def flush(self, commit_id: int = None):
+        """Folds pending updates of one commit or of all commits into aggregates.
+
+        Updates that failed to fold are queued again and ServerFailure is raised. While the database is
+        unavailable they are kept, updates of a commit rejected max_flush_attempts times in a row are dropped.
+        """
+        with self._flush_lock:
+            batches = self._take(commit_id)
+            if len(batches) == 0:
+                return
+
+            error = self._fold(batches)
+            if error is None:
+                logging.debug(
+                    f"flushed {sum(len(u) for _, u in batches)} metric updates of {len(batches)} commits"
+                )
+                return
+
+            if len(batches) > 1 and not _is_transient(error):
+                # updates of one commit rejected by the database fail the whole transaction
+                failed = [(batch, e) for batch in batches if (e := self._fold([batch])) is not None]
+            else:
+                failed = [(batch, error) for batch in batches]
+            retried = [batch for batch, e in failed if _is_transient(e) or self._may_retry(batch, e)]
+            self._requeue(retried)
+
+        raise ServerFailure(
+            f"failed to flush metric updates of {len(failed)} commits, {len(retried)} are queued again: {error}"
+        )
+
+    def drain(self, commit_id: int):
+        self.flush(commit_id)
+        redis = pubsub.get_redis()
+        redis.rpush(drained_key(commit_id), 1)
+        redis.expire(drained_key(commit_id), 60)
+
+    def run_flusher(self):
+        backoff = 0.0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._size >= self.flush_size,
+                    timeout=self.flush_interval_seconds,
+                )
+            try:
+                self.flush()
+            except Exception as e:
+                # while flushes fail the buffer fills up and puts wait or fail instead of updates being lost
+                backoff = min(max(2 * backoff, self.flush_interval_seconds), self.max_flush_backoff_seconds)
+                logging.error(f"failed to flush metric updates, retrying in {backoff:.1f}s: {e}")
+                time.sleep(backoff)
+            else:
+                backoff = 0.0
+
+
+metric_update_buffer = MetricUpdateBuffer(
+    max_size=int(os.getenv("METRIC_BUFFER_MAX_SIZE", "100000")),
+    flush_size=int(os.getenv("METRIC_BUFFER_FLUSH_SIZE", "5000")),
+    flush_interval_seconds=float(os.getenv("METRIC_BUFFER_FLUSH_INTERVAL_SECONDS", "0.5")),
+    put_timeout_seconds=float(os.getenv("METRIC_BUFFER_PUT_TIMEOUT_SECONDS", "5")),
+    max_flush_attempts=int(os.getenv("METRIC_BUFFER_MAX_FLUSH_ATTEMPTS", "5")),
+    max_flush_backoff_seconds=float(os.getenv("METRIC_BUFFER_MAX_FLUSH_BACKOFF_SECONDS", "30")),
+)
+
+
+def start_metric_update_buffer():
+    if not write_behind_enabled:
+        return
+
+    threading.Thread(
+        target=metric_update_buffer.run_flusher, name="metric-update-flusher", daemon=True
+    ).start()
+    pubsub.subscribe(
+        METRIC_BUFFER_DRAIN_CHANNEL, lambda message: metric_update_buffer.drain(int(message))
+    )
+
+
+def stop_metric_update_buffer():
+    if write_behind_enabled:
+        metric_update_buffer.flush()
+
+
+def request_metric_buffer_drain(commit_id: int):
+    """Called by the worker before finalizing a run: waits until every API process folded buffered updates of commit"""
+    if not write_behind_enabled:
+        return
+
+    redis = pubsub.get_redis()
+    redis.delete(drained_key(commit_id))
+    receivers = redis.publish(METRIC_BUFFER_DRAIN_CHANNEL, str(commit_id))
+
+    timeout = int(os.getenv("METRIC_BUFFER_DRAIN_TIMEOUT_SECONDS", "30"))
+    for _ in range(receivers):
+        if redis.blpop(drained_key(commit_id), timeout=timeout) is None:
+            logging.warning(
+                f"metric buffer was not drained for commit_id={commit_id} in {timeout}s, "
+                f"result may miss some updates"
+            )
+            return
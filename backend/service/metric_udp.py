@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import math
+import os
+from typing import Optional
+
+from db import async_local_session
+from exception import ClientFailure, ServerFailure
+from model import ClientMetricsUpdate
+from service.metric import (
+    apply_metric_updates,
+    get_cached_run_config_by_client_ip,
+    validate_metric_update,
+)
+
+udp_port = os.getenv("METRIC_UDP_PORT")
+queue_size = int(os.getenv("METRIC_UDP_QUEUE_SIZE", "10000"))
+max_batch_size = int(os.getenv("METRIC_UDP_BATCH_SIZE", "1000"))
+
+
+def _parse_value(value: str) -> Optional[int | float | str]:
+    """None for nan and infinities, json columns of postgres can not store them"""
+    for number_type in (int, float):
+        try:
+            number = number_type(value)
+        except ValueError:
+            continue
+        return number if math.isfinite(number) else None
+    return value
+
+
+def parse_datagram(datagram: bytes) -> list[ClientMetricsUpdate]:
+    """Parses StatsD-like lines "name:value|type", type and sample rate are accepted but ignored:
+    metric types are the ones declared with /metric/init. Malformed lines and non-finite values are skipped."""
+    updates = []
+    for line in datagram.decode("utf-8", errors="replace").splitlines():
+        name, sep, rest = line.strip().partition(":")
+        value = rest.split("|", 1)[0]
+        if not sep or not name or not value:
+            continue
+        value = _parse_value(value)
+        if value is None:
+            continue
+        updates.append(ClientMetricsUpdate(data={name: value}))
+    return updates
+
+
+class MetricDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        try:
+            self.queue.put_nowait((addr[0], data))
+        except asyncio.QueueFull:
+            pass
+
+
+async def _apply_datagrams(datagrams: list[tuple[str, bytes]]):
+    updates_by_ip: dict[str, list[ClientMetricsUpdate]] = {}
+    for ip, datagram in datagrams:
+        updates_by_ip.setdefault(ip, []).extend(parse_datagram(datagram))
+
+    async with async_local_session() as session:
+        for ip, updates in updates_by_ip.items():
+            try:
+                run_config = await get_cached_run_config_by_client_ip(ip, session)
+            except ServerFailure:
+                logging.debug(f"dropping {len(updates)} udp metric updates from unknown ip={ip}")
+                continue
+
+            valid_updates = []
+            for update in updates:
+                try:
+                    validate_metric_update(update, run_config)
+                except ClientFailure as e:
+                    logging.debug(f"dropping udp metric update from ip={ip}: {e}")
+                    continue
+                valid_updates.append(update)
+
+            # updates of one ip failing to apply must not drop the ones of other ips in the batch
+            try:
+                await apply_metric_updates(valid_updates, run_config, session)
+            except Exception as e:
+                logging.error(f"failed to apply {len(valid_updates)} udp metric updates from ip={ip}: {e}")
+                await session.rollback()
+
+
+async def _consume(queue: asyncio.Queue):
+    while True:
+        datagrams = [await queue.get()]
+        while not queue.empty() and len(datagrams) < max_batch_size:
+            datagrams.append(queue.get_nowait())
+        try:
+            await _apply_datagrams(datagrams)
+        except Exception as e:
+            logging.error(f"failed to apply {len(datagrams)} udp metric datagrams: {e}")
+
+
+_listener: Optional[tuple[asyncio.DatagramTransport, asyncio.Task]] = None
+
+
+async def start_metric_udp_listener():
+    """Listens on METRIC_UDP_PORT when it is set, datagrams are resolved to runs by source ip"""
+    global _listener
+    if not udp_port:
+        return
+
+    queue = asyncio.Queue(maxsize=queue_size)
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: MetricDatagramProtocol(queue), local_addr=("0.0.0.0", int(udp_port))
+    )
+    _listener = (transport, asyncio.create_task(_consume(queue)))
+    logging.info(f"listening for udp metric updates on port {udp_port}")
+
+
+async def stop_metric_udp_listener():
+    if _listener is not None:
+        transport, consumer = _listener
+        transport.close()
+        consumer.cancel()
@@ -0,0 +1,68 @@
+import logging
+from typing import Optional
+
+from db import local_session
+from sqlalchemy import text
+from sqlmodel import Session
+
+# json_each over run results of successful runs, filters are appended by write_metric_values
+_write_metric_values_sql = """
+insert into metricvalue (
+    commit_id, repo_id, branch_id, sha, committed_datetime, metric_name, numeric_value, text_value
+)
+select
+    c.id,
+    b.repo_id,
+    c.branch_id,
+    c.sha,
+    c.committed_datetime,
+    kv.key,
+    case when json_typeof(kv.value) = 'number' then (kv.value #>> '{{}}')::double precision end,
+    case when json_typeof(kv.value) in ('string', 'boolean') then kv.value #>> '{{}}' end
+from commit c
+join branch b on b.id = c.branch_id
+cross join lateral json_each(c.json_run_result::json) kv
+where c.processed is true
+  and c.run_ok is true
+  and json_typeof(c.json_run_result::json) = 'object'
+  {filters}
+on conflict (commit_id, metric_name) do update set
+    numeric_value = excluded.numeric_value,
+    text_value = excluded.text_value,
+    analyzed = false
+"""
+
+
+def write_metric_values(
+    session: Session,
+    repo_id: Optional[int] = None,
+    sha: Optional[str] = None,
+    missing_only: bool = False,
+) -> int:
+    """Copies run results of successful commits into MetricValue in one statement.
+
+    repo_id and sha narrow the commits, missing_only skips commits that already have values.
+    """
+    filters, params = [], {}
+    if repo_id is not None:
+        filters.append("and b.repo_id = :repo_id")
+        params["repo_id"] = repo_id
+    if sha is not None:
+        filters.append("and c.sha = :sha")
+        params["sha"] = sha
+    if missing_only:
+        filters.append("and not exists (select 1 from metricvalue mv where mv.commit_id = c.id)")
+
+    result = session.exec(
+        text(_write_metric_values_sql.format(filters="\n  ".join(filters))).bindparams(**params)
+    )
+    return result.rowcount
+
+
+def backfill_metric_values():
+    """Fills MetricValue for results saved before it existed, a no-op once everything is written"""
+    with local_session() as session:
+        written = write_metric_values(session, missing_only=True)
+        session.commit()
+    if written:
+        logging.info(f"backfilled {written} metric values")
@@ -1,44 +1,95 @@
 import logging
 import os
-from datetime import datetime
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import sqlmodel
 from apscheduler.triggers.interval import IntervalTrigger
-from celery import chain, chord
-from sqlalchemy import or_
 
 from db import local_session
 from exception import ClientFailure
-from git.github import GithubClient
-from model import Account, Commit, Repo, RepoWrite, RunConfig, Branch
+from git import _BaseGitClient, fetch_concurrency, get_git_client
+from git.http_cache import ConditionalRequestCache
+from model import Account, Commit, Repo, RepoWrite, Branch, RunQueueEntry, RunQueueStatusEnum
 from scheduler import get_jobs_scheduler
+from service.commit import adopt_existing_run_results, get_commits_to_run
+from service.run_queue import dispatch_runs, enqueue_commit_runs, remove_downloads
+from sqlalchemy import update
 from sqlalchemy.dialects.postgresql import insert
 from sqlmodel import Session
-from tasks.tasks import (
-    create_result_metrics_view,
-    download_commit,
-    execute_compose_in_commit_repo,
-)
 
+# rows per INSERT statement of new commits
+commit_insert_batch_size = 1000
+# repos without webhook deliveries are polled at an interval that is reset to the minimum when a poll
+# finds new commits and doubled up to the maximum when it does not
+check_commits_min_interval = timedelta(minutes=int(os.getenv("CHECK_COMMITS_MIN_INTERVAL_MINUTES", "5")))
+check_commits_max_interval = timedelta(minutes=int(os.getenv("CHECK_COMMITS_MAX_INTERVAL_MINUTES", "240")))
+# every run is shifted randomly by up to this fraction of the interval, so polls of repos do not line up
+check_commits_jitter = float(os.getenv("CHECK_COMMITS_JITTER", "0.2"))
+# repos with webhook deliveries are only reconciled
+webhook_reconcile_interval = timedelta(minutes=int(os.getenv("WEBHOOK_RECONCILE_INTERVAL_MINUTES", "60")))
 
-def add_check_commits_job_if_not_present(repo_id: int, account_id: int):
-    job_id = f"check_repo_commits__repo={repo_id}_acc={account_id}"
+
+def _check_commits_job_id(repo: Repo) -> str:
+    return f"check_repo_commits__repo={repo.id}_acc={repo.account_id}"
+
+
+def _check_commits_interval(repo: Repo) -> timedelta:
+    if repo.webhook_received_at is not None:
+        return webhook_reconcile_interval
+    if repo.poll_interval_seconds is None:
+        return check_commits_min_interval
+    return timedelta(seconds=repo.poll_interval_seconds)
+
+
+def _check_commits_trigger(repo: Repo) -> IntervalTrigger:
+    seconds = _check_commits_interval(repo).total_seconds()
+    return IntervalTrigger(seconds=seconds, jitter=int(seconds * check_commits_jitter) or None)
+
+
+def add_check_commits_job_if_not_present(repo: Repo):
+    job_id = _check_commits_job_id(repo)
 
     if get_jobs_scheduler().get_job(job_id) is not None:
         return
 
     get_jobs_scheduler().add_job(
             check_repo_commits,
-            args=(repo_id,),
-            trigger=IntervalTrigger(minutes=5),
+            args=(repo.id,),
+            trigger=_check_commits_trigger(repo),
             id=job_id,
             replace_existing=True,
             next_run_time=datetime.now(),
         )
 
 
+def reschedule_check_commits_job(repo: Repo):
+    """Applies the current polling interval of the repo, counted from now"""
+    if os.getenv("DEV_MODE", "0") == "1":
+        return
+    if get_jobs_scheduler().get_job(_check_commits_job_id(repo)) is None:
+        add_check_commits_job_if_not_present(repo)
+    else:
+        get_jobs_scheduler().reschedule_job(_check_commits_job_id(repo), trigger=_check_commits_trigger(repo))
+
+
+def request_webhook_fallback_check(repo: Repo):
+    """Polls the repo right away, for webhook deliveries that can not be applied on their own"""
+    if os.getenv("DEV_MODE", "0") == "1":
+        check_repo_commits(repo.id, from_webhook=True)
+        return
+    get_jobs_scheduler().add_job(
+        check_repo_commits,
+        args=(repo.id,),
+        kwargs={"from_webhook": True},
+        id=f"{_check_commits_job_id(repo)}__webhook",
+        replace_existing=True,
+    )
+
+
 def add_repo(body: RepoWrite, account: Account, session: Session):
-    repo = Repo(**body.dict(), account_id=account.id)
+    repo = Repo(**body.dict(), account_id=account.id, webhook_secret=_new_webhook_secret())
     session.add(repo)
     session.commit()
     session.refresh(repo)
@@ -46,86 +97,151 @@ def add_repo(body: RepoWrite, account: Account, session: Session):
     if os.getenv("DEV_MODE", "0") == "1":
         check_repo_commits(repo.id)
     else:
-        add_check_commits_job_if_not_present(repo.id, account.id)
+        add_check_commits_job_if_not_present(repo)
 
     return repo
 
 
-def check_repo_commits(repo_id: int, session: Session = None):
+def check_repo_commits(repo_id: int, session: Session = None, from_webhook: bool = False):
     if session is not None:
-        _check_repo_commits(repo_id, session)
+        _check_repo_commits(repo_id, session, from_webhook)
     else:
         with local_session() as valid_session:
-            _check_repo_commits(repo_id, valid_session)
+            _check_repo_commits(repo_id, valid_session, from_webhook)
 
 
-def _check_repo_commits(repo_id: int, session: Session):
-    # TODO: предусмотреть одновременный вызов этой функции из разный мест - тогда вызовется
-    #  одновременный прогон контейнров, что нехорошо
-    repo = session.get(Repo, repo_id)
+def upsert_branch_heads(repo_id: int, branches: list[Branch], session: Session) -> dict[str, int]:
+    """Creates branches or moves their heads in one statement, returns ids by branch name"""
+    stmt = insert(Branch).values(
+        [{"repo_id": repo_id, "name": b.name, "sha": b.sha} for b in branches]
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint="repo_id_name_constraint", set_={"sha": stmt.excluded.sha}
+    ).returning(Branch.id, Branch.name)
+    return {name: branch_id for branch_id, name in session.exec(stmt)}
+
+
+def insert_branch_commits(branch_ids: dict[str, int], branch_commits: dict[str, list[Commit]], session: Session):
+    """Inserts commits of the branches in batches, commits that are already stored are skipped.
+
+    Every batch is one executemany of the same statement, which psycopg2 sends as multi-row inserts,
+    so the statement is compiled once instead of once per batch of rows.
+    """
+    rows = [
+        {
+            "sha": c.sha,
+            "committed_datetime": c.committed_datetime,
+            "message": c.message,
+            "branch_id": branch_ids[name],
+        }
+        for name, commits in branch_commits.items()
+        for c in commits
+    ]
+    stmt = insert(Commit).on_conflict_do_nothing(constraint="branch_id_sha_constraint")
+    for i in range(0, len(rows), commit_insert_batch_size):
+        session.exec(stmt, params=rows[i:i + commit_insert_batch_size])
 
-    if os.getenv("DEV_MODE", "0") == "0":
-        add_check_commits_job_if_not_present(repo.id, repo.account_id)
 
-    git_client = GithubClient(repo.account.github_personal_api_token)
+def fetch_branch_commits(
+    repo: Repo,
+    git_client: _BaseGitClient,
+    branches: list[Branch],
+    known_heads: dict[str, str],
+    concurrency: int = fetch_concurrency,
+) -> dict[str, list[Commit]]:
+    """New commits of every branch by name, up to concurrency branches are fetched at once"""
 
-    branches = git_client.get_repo_branches(repo)
+    def fetch(branch: Branch) -> list[Commit]:
+        return git_client.get_branch_commits(repo, branch, known_sha=known_heads.get(branch.name))
 
-    for branch in branches:
-        branch_found = session.exec(sqlmodel.select(Branch).where(
-            Branch.repo_id == repo.id, Branch.sha == branch.sha)).first()
-        if branch_found is None:
-            session.add(branch)
-            session.commit()
-            session.refresh(branch)
-        else:
-            branch = branch_found
+    if concurrency <= 1 or len(branches) <= 1:
+        return {b.name: fetch(b) for b in branches}
+    with ThreadPoolExecutor(min(concurrency, len(branches)), thread_name_prefix=f"fetch-repo-{repo.id}") as pool:
+        return dict(zip([b.name for b in branches], pool.map(fetch, branches)))
 
-        commits = git_client.get_branch_commits(branch)
 
-        for commit in commits:
-            session.exec(
-                insert(Commit)
-                .values(
-                    **commit.dict(
-                        exclude={
-                            "id",
-                        }
-                    )
-                )
-                # .on_conflict_do_nothing(index_elements=["sha", "branch_id"])
-                .on_conflict_do_nothing(index_elements=Commit.__table_args__[0].columns)
-            )
-        session.commit()
+def sync_branch_commits(repo: Repo, git_client: _BaseGitClient, branches: list[Branch], session: Session) -> int:
+    """Stores new commits of branches whose head moved, with a constant number of queries per call.
 
-    session.refresh(repo)
+    Returns the number of such branches.
+    """
+    known_heads = dict(
+        session.exec(sqlmodel.select(Branch.name, Branch.sha).where(Branch.repo_id == repo.id)).all()
+    )
+    changed = [b for b in branches if known_heads.get(b.name) != b.sha]
+    if not changed:
+        return 0
+
+    branch_commits = fetch_branch_commits(repo, git_client, changed, known_heads)
+    # new heads are saved in the same transaction as commits up to them
+    branch_ids = upsert_branch_heads(repo.id, changed, session)
+    insert_branch_commits(branch_ids, branch_commits, session)
+    session.commit()
+    return len(changed)
 
-    not_processed_commits = session.exec(
-        sqlmodel.select(Commit).where(
-            or_(*[Commit.branch_id == b.id for b in repo.branches]), Commit.processed == False
-        )
-    ).all()
 
-    not_processed_commits = [
-        c
-        for c in not_processed_commits
-        if session.exec(
-            sqlmodel.select(RunConfig).where(RunConfig.commit_id == c.id)
-        ).all() == []
-    ]
+def _adapt_poll_interval(repo: Repo, changed: bool, session: Session):
+    """Tightens the polling interval after activity and backs off exponentially while nothing changes"""
+    if repo.webhook_received_at is not None:
+        return
+    current = _check_commits_interval(repo)
+    interval = check_commits_min_interval if changed else min(current * 2, check_commits_max_interval)
+    if interval == current:
+        return
+
+    repo.poll_interval_seconds = int(interval.total_seconds())
+    session.add(repo)
+    session.commit()
+    reschedule_check_commits_job(repo)
+    logging.debug(f"repo_id={repo.id} is polled every {interval} now")
+
+
+def enqueue_new_commits(repo: Repo, session: Session):
+    """Queues runs of stored commits of the repo that were not run yet"""
+    adopt_existing_run_results(repo.id, session)
+    session.commit()
+
+    not_processed_commits = get_commits_to_run(repo.id, session)
 
     logging.debug(
         f"not_processed_commits: {[(x.id, x.message) for x in not_processed_commits]}"
     )
 
-    if len(not_processed_commits) > 0:
-        chord(
-            chain(
-                download_commit.s(repo.account.id, not_processed_commit.id),
-                execute_compose_in_commit_repo.s(not_processed_commit.id),
-            )
-            for not_processed_commit in not_processed_commits
-        )(create_result_metrics_view.s(repo_id))
+    enqueue_commit_runs(not_processed_commits, repo, session)
+    dispatch_runs()
+
+
+def _check_repo_commits(repo_id: int, session: Session, from_webhook: bool = False):
+    # TODO: предусмотреть одновременный вызов этой функции из разный мест - тогда вызовется
+    #  одновременный прогон контейнров, что нехорошо
+    repo = session.get(Repo, repo_id)
+
+    if os.getenv("DEV_MODE", "0") == "0":
+        add_check_commits_job_if_not_present(repo)
+
+    request_cache = ConditionalRequestCache()
+    git_client = get_git_client(repo, cache=request_cache)
+
+    branches = git_client.get_repo_branches_if_changed(repo)
+    if branches is None:
+        # unchanged branches may still have commits to run, queued ones are skipped by enqueue_new_commits
+        logging.debug(f"branches of repo_id={repo.id} did not change since last check, skipping sync")
+        changed = 0
+    else:
+        changed = sync_branch_commits(repo, git_client, branches, session)
+        request_cache.save()
+
+    if changed and repo.webhook_received_at is not None and not from_webhook:
+        # pushes reach the repo without webhook deliveries, the webhook was probably removed
+        logging.warning(f"reconciliation found {changed} branches of repo_id={repo.id} missed by webhooks")
+        repo.webhook_received_at = None
+        repo.poll_interval_seconds = None
+        session.add(repo)
+        session.commit()
+        reschedule_check_commits_job(repo)
+    _adapt_poll_interval(repo, changed > 0, session)
+
+    enqueue_new_commits(repo, session)
 
 
 def update_repo(
@@ -145,6 +261,47 @@ def update_repo(
     session.commit()
 
 
+def _new_webhook_secret() -> str:
+    return secrets.token_hex(20)
+
+
+def rotate_webhook_secret(repo_id: str, account: Account, session: Session) -> Repo:
+    repo = session.exec(
+        sqlmodel.select(Repo).where(Repo.id == repo_id, Repo.account_id == account.id)
+    ).first()
+    if repo is None:
+        raise ClientFailure("no repo with such ID")
+
+    # deliveries signed with the old secret are rejected, so the repo is polled until new ones arrive
+    had_webhook = repo.webhook_received_at is not None
+    repo.webhook_secret = _new_webhook_secret()
+    repo.webhook_received_at = None
+    repo.poll_interval_seconds = None
+    session.add(repo)
+    session.commit()
+    session.refresh(repo)
+    if had_webhook:
+        reschedule_check_commits_job(repo)
+
+    return repo
+
+
+def backfill_webhook_secrets():
+    """Generates webhook secrets of repos added before they existed, a no-op once every repo has one"""
+    with local_session() as session:
+        repo_ids = session.exec(sqlmodel.select(Repo.id).where(Repo.webhook_secret == None)).all()
+        for repo_id in repo_ids:
+            # another starting process may have generated it already
+            session.exec(
+                update(Repo)
+                .where(Repo.id == repo_id, Repo.webhook_secret == None)
+                .values(webhook_secret=_new_webhook_secret())
+            )
+        session.commit()
+    if repo_ids:
+        logging.info(f"generated webhook secrets of {len(repo_ids)} repos")
+
+
 def delete_repo(repo_id: str, account: Account, session: Session):
     repo = session.exec(
         sqlmodel.select(Repo).where(Repo.id == repo_id, Repo.account_id == account.id)
@@ -152,5 +309,15 @@ def delete_repo(repo_id: str, account: Account, session: Session):
     if repo is None:
         raise ClientFailure("no repo with such ID")
 
+    # queue entries are deleted with the commits, files of running ones are removed by their runs
+    prefetched_paths = session.exec(
+        sqlmodel.select(RunQueueEntry.download_path).where(
+            RunQueueEntry.repo_id == repo.id,
+            RunQueueEntry.status == RunQueueStatusEnum.queued,
+        )
+    ).all()
+
     session.delete(repo)
     session.commit()
+
+    remove_downloads(prefetched_paths)
@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import pubsub
+from model import RunConfig, RunConfigSnapshot
+
+RUN_CONFIG_INVALIDATION_CHANNEL = "traig:run_config:invalidate"
+
+
+class RunConfigCache:
+    """LRU cache of client ip -> run config snapshot with TTL as a fallback for lost invalidations"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._items: OrderedDict[str, tuple[float, RunConfigSnapshot]] = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every invalidation, so a value read from db before invalidation is not cached after it
+        self.generation = 0
+
+    def get(self, ip: str) -> Optional[RunConfigSnapshot]:
+        with self._lock:
+            item = self._items.get(ip)
+            if item is None:
+                return None
+            expires_at, snapshot = item
+            if expires_at < time.monotonic():
+                del self._items[ip]
+                return None
+            self._items.move_to_end(ip)
+            return snapshot
+
+    def put(self, snapshot: RunConfigSnapshot, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[snapshot.client_ip] = (time.monotonic() + self.ttl_seconds, snapshot)
+            self._items.move_to_end(snapshot.client_ip)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, ip: str):
+        with self._lock:
+            self.generation += 1
+            self._items.pop(ip, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+
+run_config_cache = RunConfigCache(
+    ttl_seconds=float(os.getenv("RUN_CONFIG_CACHE_TTL_SECONDS", "10")),
+    max_size=int(os.getenv("RUN_CONFIG_CACHE_SIZE", "4096")),
+)
+
+
+def snapshot_run_config(run_config: RunConfig) -> RunConfigSnapshot:
+    return RunConfigSnapshot(
+        id=run_config.id,
+        client_ip=run_config.client_ip,
+        commit_id=run_config.commit_id,
+        metrics_config=run_config.metrics_config,
+    )
+
+
+def publish_run_config_invalidation(ip: str):
+    """Drops cached run config for ip in this process and in every API process subscribed to the channel"""
+    run_config_cache.invalidate(ip)
+    pubsub.publish(RUN_CONFIG_INVALIDATION_CHANNEL, ip)
+
+
+def start_run_config_invalidation_listener():
+    def on_reconnect():
+        logging.debug("(re)subscribed to run config invalidations, clearing run config cache")
+        run_config_cache.clear()
+
+    pubsub.subscribe(
+        RUN_CONFIG_INVALIDATION_CHANNEL,
+        run_config_cache.invalidate,
+        on_reconnect=on_reconnect,
+    )
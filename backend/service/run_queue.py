@@ -0,0 +1,279 @@
+import logging
+import os
+import shutil
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import sqlmodel
+from apscheduler.triggers.interval import IntervalTrigger
+from db import local_session
+from model import Commit, Repo, RunQueueEntry, RunQueueStats, RunQueueStatusEnum
+from scheduler import get_jobs_scheduler
+from sqlalchemy import delete, func, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+
+# arbitrary constant, identifies the dispatcher in pg_advisory_xact_lock
+_DISPATCH_LOCK_KEY = 7_340_001
+
+
+def _host_memory_mb() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_host_run_slots() -> int:
+    """Number of containers run at once on the host.
+
+    RUN_HOST_SLOTS if set, otherwise as many as fit by RUN_CPUS_PER_SLOT and RUN_MEMORY_MB_PER_SLOT.
+    """
+    if os.getenv("RUN_HOST_SLOTS"):
+        return int(os.getenv("RUN_HOST_SLOTS"))
+
+    slots = (os.cpu_count() or 1) // int(os.getenv("RUN_CPUS_PER_SLOT", "2"))
+    memory_mb = _host_memory_mb()
+    if memory_mb is not None:
+        slots = min(slots, memory_mb // int(os.getenv("RUN_MEMORY_MB_PER_SLOT", "2048")))
+    return max(slots, 1)
+
+
+# commits older than this are historical backfill and go after fresh ones
+backfill_age = timedelta(days=int(os.getenv("RUN_BACKFILL_AGE_DAYS", "7")))
+
+max_runs_per_account = int(os.getenv("RUN_MAX_PER_ACCOUNT", "2"))
+max_runs_per_repo = int(os.getenv("RUN_MAX_PER_REPO", "1"))
+# number of queued commits downloaded ahead, by default one per host slot
+prefetch_count = int(os.getenv("RUN_PREFETCH_COUNT", "0")) or get_host_run_slots()
+dispatch_interval_seconds = int(os.getenv("RUN_DISPATCH_INTERVAL_SECONDS", "10"))
+# running entries older than this are considered lost with a crashed worker and queued again
+stale_run_timeout = timedelta(seconds=int(os.getenv("RUN_STALE_TIMEOUT_SECONDS", "3600")))
+
+
+PRIORITY_BACKFILL = 0
+PRIORITY_RECENT = 1
+PRIORITY_BRANCH_HEAD = 2
+
+_prefetch_celery_priority = {PRIORITY_BRANCH_HEAD: 3, PRIORITY_RECENT: 6, PRIORITY_BACKFILL: 9}
+
+
+def get_run_priority(commit: Commit, head_shas: set[str], now: datetime) -> int:
+    if commit.sha in head_shas:
+        return PRIORITY_BRANCH_HEAD
+    committed = commit.committed_datetime
+    if committed.tzinfo is None:
+        committed = committed.replace(tzinfo=timezone.utc)
+    return PRIORITY_RECENT if now - committed < backfill_age else PRIORITY_BACKFILL
+
+
+def enqueue_commit_runs(commits: list[Commit], repo: Repo, session: Session):
+    if not commits:
+        return
+
+    head_shas = {b.sha for b in repo.branches}
+    now = datetime.now(timezone.utc)
+    session.exec(
+        insert(RunQueueEntry)
+        .values(
+            [
+                {
+                    "commit_id": c.id,
+                    "repo_id": repo.id,
+                    "account_id": repo.account_id,
+                    "priority": get_run_priority(c, head_shas, now),
+                    "committed_datetime": c.committed_datetime,
+                }
+                for c in commits
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=[RunQueueEntry.commit_id])
+    )
+    session.commit()
+
+
+def remove_downloads(download_paths: list[Optional[str]]):
+    """Removes commit dirs downloaded for run queue entries, called once the entries are deleted"""
+    for path in download_paths:
+        if path:
+            # download_path is the extracted repo inside the dir of the commit
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def release_run_slot(commit_id: int):
+    with local_session() as session:
+        download_paths = session.exec(
+            delete(RunQueueEntry)
+            .where(RunQueueEntry.commit_id == commit_id)
+            .returning(RunQueueEntry.download_path)
+        ).scalars().all()
+        session.commit()
+
+    # a run removes its files itself, these are left by failed runs
+    remove_downloads(download_paths)
+
+
+def _run_order(entry: RunQueueEntry):
+    return -entry.priority, -entry.committed_datetime.timestamp(), entry.id
+
+
+def _pick_entries(
+    queued: list[RunQueueEntry], running: list[RunQueueEntry], free_slots: int
+) -> list[RunQueueEntry]:
+    """Round-robin over accounts, accounts with fewer running commits and older queued commits go first.
+
+    Within an account entries are taken in _run_order.
+    """
+    running_by_account: dict[int, int] = {}
+    running_by_repo: dict[int, int] = {}
+    for entry in running:
+        running_by_account[entry.account_id] = running_by_account.get(entry.account_id, 0) + 1
+        running_by_repo[entry.repo_id] = running_by_repo.get(entry.repo_id, 0) + 1
+
+    by_account: dict[int, deque[RunQueueEntry]] = {}
+    for entry in sorted(queued, key=_run_order):
+        by_account.setdefault(entry.account_id, deque()).append(entry)
+
+    oldest_by_account = {a: min(e.created_at for e in entries) for a, entries in by_account.items()}
+    accounts = sorted(
+        by_account, key=lambda a: (running_by_account.get(a, 0), oldest_by_account[a])
+    )
+
+    picked = []
+    while accounts and len(picked) < free_slots:
+        for account_id in list(accounts):
+            if len(picked) >= free_slots:
+                break
+
+            entries = by_account[account_id]
+            if running_by_account.get(account_id, 0) >= max_runs_per_account:
+                entries.clear()
+            # entries of repos at their cap are dropped, the rest of the account keeps its turn
+            while entries and running_by_repo.get(entries[0].repo_id, 0) >= max_runs_per_repo:
+                entries.popleft()
+            if not entries:
+                accounts.remove(account_id)
+                continue
+
+            entry = entries.popleft()
+            picked.append(entry)
+            running_by_account[account_id] = running_by_account.get(account_id, 0) + 1
+            running_by_repo[entry.repo_id] = running_by_repo.get(entry.repo_id, 0) + 1
+
+    return picked
+
+
+def dispatch_runs():
+    """Moves queued commits into free run slots and sends them to workers.
+
+    Called periodically from the api scheduler and by workers after every finished run,
+    concurrent calls are serialized with an advisory lock.
+    """
+    with local_session() as session:
+        session.exec(sqlmodel.select(func.pg_advisory_xact_lock(_DISPATCH_LOCK_KEY)))
+
+        now = datetime.now(timezone.utc)
+        session.exec(
+            update(RunQueueEntry)
+            .where(
+                RunQueueEntry.status == RunQueueStatusEnum.running,
+                RunQueueEntry.started_at < now - stale_run_timeout,
+            )
+            .values(status=RunQueueStatusEnum.queued, started_at=None)
+        )
+
+        entries = session.exec(
+            sqlmodel.select(RunQueueEntry).order_by(RunQueueEntry.created_at, RunQueueEntry.id)
+        ).all()
+        running = [e for e in entries if e.status == RunQueueStatusEnum.running]
+        queued = [e for e in entries if e.status == RunQueueStatusEnum.queued]
+
+        free_slots = get_host_run_slots() - len(running)
+        picked = _pick_entries(queued, running, free_slots) if free_slots > 0 else []
+
+        for entry in picked:
+            entry.status = RunQueueStatusEnum.running
+            entry.started_at = now
+            session.add(entry)
+
+        to_prefetch = _pick_prefetch_entries(queued, picked)
+        for entry in to_prefetch:
+            entry.prefetch_requested = True
+            session.add(entry)
+
+        dispatched = [(e.commit_id, e.repo_id, e.account_id) for e in picked]
+        prefetched = [(e.commit_id, e.account_id, e.priority) for e in to_prefetch]
+        session.commit()
+
+    if dispatched:
+        logging.debug(f"dispatching runs of commits {[x[0] for x in dispatched]}")
+    _send_runs(dispatched, prefetched)
+
+
+def _pick_prefetch_entries(
+    queued: list[RunQueueEntry], picked: list[RunQueueEntry]
+) -> list[RunQueueEntry]:
+    """Next queued entries to download while the current runs execute"""
+    picked_ids = {e.id for e in picked}
+    waiting = sorted((e for e in queued if e.id not in picked_ids), key=_run_order)
+    already_requested = sum(1 for e in waiting if e.prefetch_requested)
+    limit = max(prefetch_count - already_requested, 0)
+    return [e for e in waiting if not e.prefetch_requested][:limit]
+
+
+def _send_runs(dispatched: list[tuple[int, int, int]], prefetched: list[tuple[int, int, int]]):
+    # tasks import this module to release slots
+    from celery import chain
+    from tasks.tasks import download_commit, execute_compose_in_commit_repo, finish_commit_run
+
+    for commit_id, repo_id, account_id in dispatched:
+        finish = finish_commit_run.si(commit_id, repo_id)
+        chain(
+            # a slot is already waiting for this download, so it goes before any prefetch
+            download_commit.s(account_id, commit_id).set(priority=0),
+            execute_compose_in_commit_repo.s(commit_id),
+            finish,
+        ).on_error(finish).apply_async()
+
+    for commit_id, account_id, priority in prefetched:
+        download_commit.apply_async(
+            (account_id, commit_id), priority=_prefetch_celery_priority[priority]
+        )
+
+
+def start_run_dispatcher():
+    get_jobs_scheduler().add_job(
+        dispatch_runs,
+        trigger=IntervalTrigger(seconds=dispatch_interval_seconds),
+        id="dispatch_runs",
+        replace_existing=True,
+        next_run_time=datetime.now(),
+    )
+
+
+def get_run_queue_stats(account_id: int, session: Session) -> RunQueueStats:
+    entries = session.exec(
+        sqlmodel.select(RunQueueEntry).where(RunQueueEntry.account_id == account_id)
+    ).all()
+    now = datetime.now(timezone.utc)
+
+    queued = [e for e in entries if e.status == RunQueueStatusEnum.queued]
+    running = [e for e in entries if e.status == RunQueueStatusEnum.running]
+
+    return RunQueueStats(
+        queued=len(queued),
+        running=len(running),
+        oldest_queued_wait=(
+            (now - min(e.created_at for e in queued)).total_seconds() if queued else None
+        ),
+        mean_running_wait=(
+            sum((e.started_at - e.created_at).total_seconds() for e in running) / len(running)
+            if running
+            else None
+        ),
+    )
@@ -0,0 +1,220 @@
+import base64
+import datetime
+import json
+from enum import Enum
+from typing import Optional
+
+import sqlmodel
+from exception import ClientFailure
+from model import (
+    Account,
+    Branch,
+    Commit,
+    MetricChangePoint,
+    MetricSeries,
+    MetricSeriesPoint,
+    MetricValue,
+    Repo,
+)
+from service.downsample import lttb, min_max_buckets
+from sqlalchemy import and_, or_
+from sqlmodel import Session
+
+# selectable fields, "branch" is the branch name taken from the joined Branch
+commit_fields = {
+    name: getattr(Commit, name)
+    for name in (
+        "id",
+        "sha",
+        "committed_datetime",
+        "message",
+        "branch_id",
+        "processed",
+        "run_ok",
+        "json_run_result",
+        "run_finished_at",
+        "run_error",
+        "is_interrupted",
+        "created_at",
+    )
+}
+commit_fields["branch"] = Branch.name
+
+default_fields = list(commit_fields)
+max_page_size = 1000
+
+
+class CommitStatusEnum(str, Enum):
+    pending = "pending"
+    ok = "ok"
+    failed = "failed"
+    interrupted = "interrupted"
+
+
+def _status_condition(commit_status: CommitStatusEnum):
+    return {
+        CommitStatusEnum.pending: Commit.processed == False,
+        CommitStatusEnum.ok: and_(Commit.processed == True, Commit.run_ok == True),
+        CommitStatusEnum.failed: and_(Commit.processed == True, Commit.run_ok == False),
+        CommitStatusEnum.interrupted: Commit.is_interrupted == True,
+    }[commit_status]
+
+
+class DownsampleMethodEnum(str, Enum):
+    lttb = "lttb"  # keeps the visual shape, one point per bucket
+    minmax = "minmax"  # keeps extremes of every bucket, two points per bucket
+
+
+def _get_account_repo(repo_id: int, account: Account, session: Session) -> Repo:
+    repo = session.get(Repo, repo_id)
+    if repo is None or repo.account_id != account.id:
+        raise ClientFailure("no repo with such ID")
+    return repo
+
+
+def encode_cursor(committed_datetime: datetime.datetime, commit_id: int) -> str:
+    payload = json.dumps([committed_datetime.isoformat(), commit_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    try:
+        committed, commit_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.datetime.fromisoformat(committed), int(commit_id)
+    except (ValueError, TypeError):
+        raise ClientFailure("invalid cursor")
+
+
+def get_commits_page(
+    repo_id: int,
+    account: Account,
+    session: Session,
+    fields: Optional[list[str]] = None,
+    branch: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    commit_status: Optional[CommitStatusEnum] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+) -> tuple[list[dict], Optional[str]]:
+    """Commits of the repo from newest to oldest with keyset pagination.
+
+    Returns requested fields of at most limit commits and the cursor of the next page, if there is one.
+    """
+    _get_account_repo(repo_id, account, session)
+
+    fields = fields or default_fields
+    unknown = [f for f in fields if f not in commit_fields]
+    if unknown:
+        raise ClientFailure(f"unknown fields: {', '.join(unknown)}")
+    limit = min(max(limit, 1), max_page_size)
+
+    # the keyset columns are always selected, for the next cursor
+    columns = [commit_fields[f].label(f) for f in fields]
+    columns += [Commit.committed_datetime.label("_cursor_datetime"), Commit.id.label("_cursor_id")]
+
+    query = (
+        sqlmodel.select(*columns)
+        .join(Branch, Branch.id == Commit.branch_id)
+        .where(Branch.repo_id == repo_id)
+    )
+    if branch is not None:
+        query = query.where(Branch.name == branch)
+    if since is not None:
+        query = query.where(Commit.committed_datetime >= since)
+    if until is not None:
+        query = query.where(Commit.committed_datetime < until)
+    if commit_status is not None:
+        query = query.where(_status_condition(commit_status))
+    if cursor is not None:
+        cursor_datetime, cursor_id = decode_cursor(cursor)
+        query = query.where(
+            or_(
+                Commit.committed_datetime < cursor_datetime,
+                and_(Commit.committed_datetime == cursor_datetime, Commit.id < cursor_id),
+            )
+        )
+
+    rows = session.exec(
+        query.order_by(Commit.committed_datetime.desc(), Commit.id.desc()).limit(limit + 1)
+    ).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]._cursor_datetime, rows[-1]._cursor_id)
+
+    return [{f: row._mapping[f] for f in fields} for row in rows], next_cursor
+
+
+def get_metric_series(
+    repo_id: int,
+    account: Account,
+    session: Session,
+    metric: str,
+    branch: Optional[str] = None,
+    points: Optional[int] = None,
+    method: DownsampleMethodEnum = DownsampleMethodEnum.lttb,
+) -> MetricSeries:
+    """Numeric values of the metric over successful runs ordered by commit time, one point per sha.
+
+    When there are more than points values, the series is downsampled on the server.
+    """
+    _get_account_repo(repo_id, account, session)
+
+    query = sqlmodel.select(
+        MetricValue.committed_datetime, MetricValue.sha, MetricValue.numeric_value
+    ).where(
+        MetricValue.repo_id == repo_id,
+        MetricValue.metric_name == metric,
+        MetricValue.numeric_value != None,
+    )
+    if branch is not None:
+        query = query.join(Branch, Branch.id == MetricValue.branch_id).where(Branch.name == branch)
+
+    series, seen_shas = [], set()
+    for committed_datetime, sha, value in session.exec(
+        query.order_by(MetricValue.committed_datetime, MetricValue.commit_id)
+    ):
+        if sha in seen_shas:
+            continue
+        seen_shas.add(sha)
+        series.append(MetricSeriesPoint(committed_datetime=committed_datetime, sha=sha, value=value))
+
+    total_points = len(series)
+    if points is not None and points < total_points:
+        values = [p.value for p in series]
+        if method == DownsampleMethodEnum.lttb:
+            kept = lttb([p.committed_datetime.timestamp() for p in series], values, points)
+        else:
+            kept = min_max_buckets(values, points)
+        series = [series[i] for i in kept]
+
+    return MetricSeries(metric=metric, total_points=total_points, points=series)
+
+
+def get_change_points(
+    repo_id: int,
+    account: Account,
+    session: Session,
+    metric: Optional[str] = None,
+    branch: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    limit: int = 100,
+) -> list[MetricChangePoint]:
+    """Change points found in metric series of the repo, newest commits first"""
+    _get_account_repo(repo_id, account, session)
+
+    query = sqlmodel.select(MetricChangePoint).where(MetricChangePoint.repo_id == repo_id)
+    if metric is not None:
+        query = query.where(MetricChangePoint.metric_name == metric)
+    if branch is not None:
+        query = query.join(Branch, Branch.id == MetricChangePoint.branch_id).where(Branch.name == branch)
+    if since is not None:
+        query = query.where(MetricChangePoint.committed_datetime >= since)
+
+    return session.exec(
+        query.order_by(MetricChangePoint.committed_datetime.desc(), MetricChangePoint.id.desc()).limit(
+            min(max(limit, 1), max_page_size)
+        )
+    ).all()
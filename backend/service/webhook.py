@@ -0,0 +1,119 @@
+import hashlib
+import hmac
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+import dateutil.parser
+import sqlmodel
+from db import local_session
+from exception import ClientFailure
+from git import new_commits_limit
+from model import Branch, Commit, Repo
+from service.repo import (
+    enqueue_new_commits,
+    insert_branch_commits,
+    request_webhook_fallback_check,
+    reschedule_check_commits_job,
+    upsert_branch_heads,
+)
+from sqlalchemy import func
+from sqlmodel import Session
+
+# github cuts commits of a push payload at this number
+_PAYLOAD_MAX_COMMITS = 2048
+
+
+def signature_matches(secret: Optional[str], body: bytes, signature: Optional[str]) -> bool:
+    """Checks X-Hub-Signature-256 of the raw request body"""
+    if not secret or not signature:
+        return False
+    expected = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def _apply_push(repo: Repo, payload: dict, session: Session):
+    """Stores commits of a push event and queues their runs.
+
+    Only pushes that continue the known head of a branch are applied from the payload, new branches,
+    force pushes and pushes after missed deliveries are left to a poll of the repo.
+    """
+    ref = payload.get("ref") or ""
+    if not ref.startswith("refs/heads/") or payload.get("deleted"):
+        return
+    name = ref[len("refs/heads/"):]
+    before, after = payload.get("before"), payload.get("after")
+    commits = payload.get("commits") or []
+
+    branch = session.exec(
+        sqlmodel.select(Branch).where(Branch.repo_id == repo.id, Branch.name == name).with_for_update()
+    ).first()
+    if branch is not None and branch.sha == after:
+        session.rollback()
+        return
+
+    limit = new_commits_limit(before)
+    if (
+        branch is None
+        or branch.sha != before
+        or payload.get("forced")
+        or len(commits) == 0
+        or commits[-1]["id"] != after
+        or _PAYLOAD_MAX_COMMITS <= len(commits) < limit
+    ):
+        session.rollback()
+        logging.info(f"push to {name} of repo_id={repo.id} can not be applied from the payload, polling the repo")
+        request_webhook_fallback_check(repo)
+        return
+
+    branch_commits = [
+        Commit(
+            sha=c["id"],
+            committed_datetime=dateutil.parser.isoparse(c["timestamp"]),
+            message=c["message"],
+        )
+        for c in commits[-limit:]
+    ]
+    # new head is saved in the same transaction as commits up to it
+    branch_ids = upsert_branch_heads(repo.id, [Branch(name=name, sha=after)], session)
+    insert_branch_commits(branch_ids, {name: branch_commits}, session)
+    session.commit()
+
+    enqueue_new_commits(repo, session)
+
+
+def handle_github_event(event: str, body: bytes, signature: Optional[str]) -> int:
+    """Applies a github webhook delivery to every repo whose webhook secret signed it, returns their number"""
+    try:
+        payload = json.loads(body)
+        repository = payload["repository"]
+        owner = repository["owner"].get("login") or repository["owner"]["name"]
+        name = repository["name"]
+    except (ValueError, TypeError, KeyError):
+        raise ClientFailure("not a repository webhook payload")
+
+    with local_session() as session:
+        # one github repo may be added by several accounts, each with its own secret
+        candidates = session.exec(
+            sqlmodel.select(Repo).where(
+                func.lower(Repo.owner) == owner.lower(),
+                func.lower(Repo.name) == name.lower(),
+            )
+        ).all()
+        repos = [r for r in candidates if signature_matches(r.webhook_secret, body, signature)]
+        if len(repos) == 0:
+            raise ClientFailure("signature does not match any repo")
+
+        for repo in repos:
+            first_delivery = repo.webhook_received_at is None
+            repo.webhook_received_at = datetime.now(timezone.utc)
+            session.add(repo)
+            session.commit()
+            if first_delivery:
+                reschedule_check_commits_job(repo)
+
+            if event == "push":
+                _apply_push(repo, payload, session)
+
+    return len(repos)
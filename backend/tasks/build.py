@@ -0,0 +1,185 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+from contextlib import contextmanager
+
+from exception import ServerFailure
+from model import BuildCacheModeEnum, Repo
+
+# BuildKit local cache directory, cache of every repo is kept in its own subdirectory.
+# Without it "cached" modes rely on the layer cache of the docker daemon.
+build_cache_path = os.getenv("DOCKER_BUILD_CACHE_PATH")
+buildx_builder_name = os.getenv("DOCKER_BUILDX_BUILDER", "traig-builder")
+
+
+def compose_project_name(repo: Repo) -> str:
+    """Same for all commits of the repo, so images are tagged per repo and not per commit dir"""
+    return f"traig-repo-{repo.id}"
+
+
+def repo_image_name(repo: Repo) -> str:
+    return f"{compose_project_name(repo)}-{repo.reporting_docker_services_name}"
+
+
+def _compose_cmd(repo: Repo) -> str:
+    return f"docker compose -p {compose_project_name(repo)} -f {repo.traig_compose_file_path_from_repo_root}"
+
+
+@contextmanager
+def _build_lock(name: str):
+    lock_dir = os.getenv("REPOS_DOWNLOAD_PATH") or "/tmp"
+    with open(os.path.join(lock_dir, f"{name}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def repo_build_lock(repo: Repo, image: str):
+    """Builds of one repo share image tags and cache dir, so they are serialized between worker processes.
+
+    Builds of repos whose compose files name the same image are serialized as well, from the build
+    until the image is tagged. The image lock is always taken second, so the locks can not deadlock.
+    """
+    with _build_lock(f"build-{repo.id}"):
+        if image == repo_image_name(repo):
+            yield
+            return
+        with _build_lock("build-image-" + hashlib.sha256(image.encode("utf-8")).hexdigest()[:16]):
+            yield
+
+
+def _service_config(commit_dir_path: str, repo: Repo) -> dict:
+    result = subprocess.run(
+        f"{_compose_cmd(repo)} config --format json",
+        shell=True,
+        cwd=commit_dir_path,
+        check=True,
+        capture_output=True,
+    )
+    service = json.loads(result.stdout)["services"].get(repo.reporting_docker_services_name)
+    if service is None or "build" not in service:
+        raise ServerFailure(
+            f"service {repo.reporting_docker_services_name} has no build section "
+            f"in {repo.traig_compose_file_path_from_repo_root}"
+        )
+    return service
+
+
+def hash_build_context(commit_dir_path: str, build: dict) -> str:
+    """Hash of the resolved compose build section and of every file of the build context.
+
+    .dockerignore is not applied, so an ignored file change causes a rebuild, which is only slower.
+    """
+    # compose config resolves paths to absolute ones, which differ for every commit dir
+    context = os.path.join(commit_dir_path, build.get("context", "."))
+    dockerfile = os.path.join(context, build.get("dockerfile", "Dockerfile"))
+    build = {
+        **build,
+        "context": os.path.relpath(context, commit_dir_path),
+        "dockerfile": os.path.relpath(dockerfile, context),
+    }
+
+    digest = hashlib.sha256(json.dumps(build, sort_keys=True).encode("utf-8"))
+
+    paths = []
+    for root, dirs, files in os.walk(context):
+        dirs[:] = [d for d in dirs if d != ".git"]
+        paths.extend(os.path.join(root, f) for f in files)
+
+    if os.path.isfile(dockerfile):
+        paths.append(dockerfile)
+
+    for path in sorted(set(paths)):
+        digest.update(os.path.relpath(path, context).encode("utf-8") + b"\0")
+        if os.path.islink(path):
+            digest.update(os.readlink(path).encode("utf-8"))
+        elif os.path.isfile(path):
+            digest.update(b"%o\0" % (os.stat(path).st_mode & 0o111))
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def image_exists(image: str) -> bool:
+    return (
+        subprocess.run(["docker", "image", "inspect", image], capture_output=True).returncode == 0
+    )
+
+
+def _ensure_buildx_builder():
+    """Exporting cache to a local directory needs the docker-container driver"""
+    if subprocess.run(
+        ["docker", "buildx", "inspect", buildx_builder_name], capture_output=True
+    ).returncode != 0:
+        subprocess.run(
+            ["docker", "buildx", "create", "--name", buildx_builder_name, "--driver", "docker-container"],
+            check=True,
+        )
+
+
+def _build(commit_dir_path: str, repo: Repo, image: str):
+    service = repo.reporting_docker_services_name
+
+    if repo.build_cache_mode == BuildCacheModeEnum.clean:
+        cmd = f"{_compose_cmd(repo)} build --no-cache {service}"
+    elif build_cache_path:
+        _ensure_buildx_builder()
+        cache_dir = os.path.join(build_cache_path, str(repo.id))
+        cmd = (
+            f"docker buildx bake --builder {buildx_builder_name} --load "
+            f"-f {repo.traig_compose_file_path_from_repo_root} "
+            f"--set {service}.tags={image} "
+            f"--set {service}.cache-from=type=local,src={cache_dir} "
+            f"--set {service}.cache-to=type=local,dest={cache_dir},mode=max "
+            f"{service}"
+        )
+    else:
+        cmd = f"{_compose_cmd(repo)} build {service}"
+
+    subprocess.run(cmd, shell=True, cwd=commit_dir_path, check=True)
+
+
+def build_commit_image(commit_dir_path: str, repo: Repo, commit_sha: str) -> str:
+    """Builds image of the reporting service according to repo.build_cache_mode.
+
+    Returns a tag unique to the commit, that stays valid while other commits of the repo are built,
+    it should be removed with remove_commit_image after the run.
+    """
+    service = _service_config(commit_dir_path, repo)
+    # compose tags the build with its image name, which other repos and accounts may use as well,
+    # so commit and context tags are always added to the name of the repo
+    image = service.get("image") or repo_image_name(repo)
+    image_name = repo_image_name(repo)
+    run_tag = f"{image_name}:{commit_sha}"
+
+    with repo_build_lock(repo, image):
+        source = image
+        if repo.build_cache_mode == BuildCacheModeEnum.skip_unchanged:
+            context_hash = hash_build_context(commit_dir_path, service["build"])
+            context_tag = f"{image_name}:context-{context_hash[:32]}"
+            if image_exists(context_tag):
+                logging.debug(f"build context of {commit_sha} did not change, reusing {context_tag}")
+                source = context_tag
+            else:
+                _build(commit_dir_path, repo, image)
+                subprocess.run(["docker", "tag", image, context_tag], check=True)
+        else:
+            _build(commit_dir_path, repo, image)
+
+        subprocess.run(["docker", "tag", source, run_tag], check=True)
+
+    return run_tag
+
+
+def remove_commit_image(run_tag: str):
+    """Only untags, layers stay while the repo image or a context tag refers to them"""
+    subprocess.run(["docker", "rmi", run_tag], check=False, capture_output=True)
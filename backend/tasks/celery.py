@@ -5,5 +5,19 @@ redis_url = "redis://redis:6379/0"
 app = Celery("tasks", broker=redis_url, include=["tasks.tasks"])
 app.conf.result_backend = redis_url
 
+# downloads are network and disk bound, runs are cpu bound, they get separate workers
+app.conf.task_routes = {
+    "tasks.tasks.download_commit": {"queue": "io"},
+    "tasks.tasks.finish_commit_run": {"queue": "io"},
+    "tasks.tasks.execute_compose_in_commit_repo": {"queue": "cpu"},
+}
+# 0 is the highest priority for the redis broker
+app.conf.broker_transport_options = {
+    "queue_order_strategy": "priority",
+    "priority_steps": list(range(10)),
+}
+# tasks are long, a worker should not reserve tasks that another idle worker could take
+app.conf.worker_prefetch_multiplier = 1
+
 if __name__ == "__main__":
     app.start()
@@ -0,0 +1,60 @@
+import os
+import threading
+from typing import BinaryIO
+
+head_bytes = int(os.getenv("LOG_CAPTURE_HEAD_BYTES", str(256 * 1024)))
+tail_bytes = int(os.getenv("LOG_CAPTURE_TAIL_BYTES", str(768 * 1024)))
+
+
+class HeadTailLog:
+    """Keeps the first head_size and the last tail_size bytes of a stream, memory does not grow past that"""
+
+    def __init__(self, head_size: int = head_bytes, tail_size: int = tail_bytes):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_size = 0
+
+    def write(self, chunk: bytes):
+        self.total_size += len(chunk)
+
+        if len(self.head) < self.head_size:
+            taken = self.head_size - len(self.head)
+            self.head += chunk[:taken]
+            chunk = chunk[taken:]
+
+        if not chunk or self.tail_size == 0:
+            return
+        self.tail += chunk
+        # trimmed in batches, so the copy is amortized over many small writes
+        if len(self.tail) > 2 * self.tail_size:
+            del self.tail[: len(self.tail) - self.tail_size]
+
+    @property
+    def skipped_size(self) -> int:
+        return self.total_size - len(self.head) - min(len(self.tail), self.tail_size)
+
+    @property
+    def truncated(self) -> bool:
+        return self.skipped_size > 0
+
+    def getvalue(self) -> bytes:
+        tail = bytes(self.tail[-self.tail_size:]) if self.tail_size else b""
+        if not self.truncated:
+            return bytes(self.head) + tail
+        marker = f"\n... [{self.skipped_size} bytes skipped] ...\n".encode("utf-8")
+        return bytes(self.head) + marker + tail
+
+
+def capture_stream(stream: BinaryIO, log: HeadTailLog) -> threading.Thread:
+    """Drains stream into log from a background thread, until EOF"""
+
+    def drain():
+        with stream:
+            for chunk in iter(lambda: stream.read1(64 * 1024), b""):
+                log.write(chunk)
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    return thread
@@ -1,39 +1,39 @@
-import json
 import logging
 import os
 import shutil
 import subprocess
-import tempfile
+from contextlib import contextmanager
 from datetime import datetime
-from ipaddress import IPv4Network
 
-import sqlalchemy.exc
 import sqlmodel
-from db import local_session
+from db import engine, local_session
 from db.create_view import create_metrics_view
 from exception import ClientFailure, ServerFailure
-from git.github import GithubClient
-from model import Account, Commit, MetricTypeEnum, MetricUpdate, Repo, RunConfig
+from git import get_git_client
+from model import (
+    Account,
+    Commit,
+    LogStreamEnum,
+    MetricAggregate,
+    Repo,
+    RunConfig,
+    RunQueueEntry,
+)
+from service.aggregate import finalize_metric_aggregate
+from service.change_point import detect_change_points
+from service.commit import fan_out_run_result
+from service.commit_log import save_commit_log
+from service.ip_pool import docker_network_name, lease_ip_for_commit, release_ip
+from service.metric_buffer import request_metric_buffer_drain
+from service.run_config_cache import publish_run_config_invalidation
+from service.run_queue import dispatch_runs, release_run_slot, remove_downloads
+from sqlalchemy import delete, func, update
+from tasks.build import build_commit_image, remove_commit_image
 from tasks.celery import app
+from tasks.log_capture import HeadTailLog, capture_stream
 
-docker_network_name = os.getenv("DOCKER_NETWORK_NAME", "traig_traignetwork")
-
-
-def get_traig_docker_network_subnet() -> tuple[str, list[str]]:
-    result = subprocess.run(
-        f"docker network inspect {docker_network_name}",
-        shell=True,
-        check=True,
-        capture_output=True,
-    )
-    network_info = [
-        x for x in json.loads(result.stdout) if x["Name"] == docker_network_name
-    ][0]
-    network_subnet = network_info["IPAM"]["Config"][0]["Subnet"]
-    reserved_ips = [
-        x["IPv4Address"].split("/")[0] for x in network_info["Containers"].values()
-    ]
-    return network_subnet, reserved_ips
+# first key of pg_advisory_lock(class, commit_id) taken while a commit is downloaded
+download_lock_class = 1
 
 
 def rm_f_container(container_name: str, commit_dir_path: str):
@@ -42,7 +42,7 @@ def rm_f_container(container_name: str, commit_dir_path: str):
     )
 
 
-def run_docker_cmd(commit_dir_path: str, container_ip: str, repo: Repo):
+def run_docker_cmd(commit_dir_path: str, container_ip: str, repo: Repo, commit_sha: str):
     if not os.path.isfile(
         os.path.join(commit_dir_path, repo.traig_compose_file_path_from_repo_root)
     ):
@@ -52,151 +52,139 @@ def run_docker_cmd(commit_dir_path: str, container_ip: str, repo: Repo):
         )
 
     parent_dir_name = os.path.basename(commit_dir_path).lower()
-    image_name = parent_dir_name + "-" + repo.reporting_docker_services_name
-    container_name = f"{image_name}-1"
-    subprocess.run(
-        f"docker compose -f {repo.traig_compose_file_path_from_repo_root} build --no-cache",
-        shell=True,
-        cwd=commit_dir_path,
-        check=True,
-    )
+    # container name stays unique per commit dir, image is shared by commits of the repo
+    container_name = f"{parent_dir_name}-{repo.reporting_docker_services_name}-1"
+    image_name = build_commit_image(commit_dir_path, repo, commit_sha)
     rm_f_container(container_name, commit_dir_path)
 
-    stdout = tempfile.TemporaryFile()
-    stderr = tempfile.TemporaryFile()
+    cmd = (
+        "docker run --env TRAIG_SESSION=1 "
+        f"--network={docker_network_name} "
+        f"--ip={container_ip} "
+        f"--name {container_name} "
+        "--rm " + image_name
+    )
+    stdout, stderr = HeadTailLog(), HeadTailLog()
     exc_str = None
     is_interrupted = False
 
     try:
-        subprocess.run(
-            [
-                "docker run --env TRAIG_SESSION=1 "
-                f"--network={docker_network_name} "
-                f"--ip={container_ip} "
-                f"--name {container_name} "
-                "--rm " + image_name,
-            ],
-            shell=True,
-            cwd=commit_dir_path,
-            check=True,
-            stdout=stdout,
-            stderr=stderr,
-            timeout=60 * 10,  # TODO продумать
+        process = subprocess.Popen(
+            cmd, shell=True, cwd=commit_dir_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
-    except subprocess.TimeoutExpired:
-        is_interrupted = True
+        readers = [capture_stream(process.stdout, stdout), capture_stream(process.stderr, stderr)]
+        try:
+            process.wait(timeout=60 * 10)  # TODO продумать
+        except subprocess.TimeoutExpired:
+            is_interrupted = True
+            process.kill()
+            process.wait()
+        for reader in readers:
+            reader.join()
+        if process.returncode != 0 and not is_interrupted:
+            exc_str = str(subprocess.CalledProcessError(process.returncode, cmd))
     except Exception as e:
         exc_str = str(e)
 
     rm_f_container(container_name, commit_dir_path)
+    remove_commit_image(image_name)
 
-    stdout.seek(0)
-    stderr.seek(0)
-
-    stdout_str = stdout.read()  # TODO: поставить ограничение на размер лога
-    stderr_str = stderr.read()
+    return stdout, stderr, exc_str, is_interrupted
 
-    stdout.close()
-    stderr.close()
 
-    return stdout_str.decode("utf-8"), stderr_str.decode("utf-8"), exc_str, is_interrupted
+@contextmanager
+def commit_download_lock(commit_id: int):
+    """Session level advisory lock on a connection of its own in autocommit mode, so no transaction
+    stays open while the commit is downloaded"""
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(sqlmodel.select(func.pg_advisory_lock(download_lock_class, commit_id)))
+        try:
+            yield
+        finally:
+            connection.execute(sqlmodel.select(func.pg_advisory_unlock(download_lock_class, commit_id)))
 
 
 @app.task
 def download_commit(account_id: int, commit_id: int):
-    with local_session() as session:
-        account = session.get(Account, account_id)
-        if not account:
-            raise ServerFailure(f"account not found for id: {account_id}")
-
-        commit = session.get(Commit, commit_id)
-        if not commit:
-            raise ServerFailure(f"commit not found for id: {commit_id}")
-
-        repo = commit.branch.repo
-
-        github = GithubClient(account.github_personal_api_token)
-        commit_dir_path = github.download_and_unzip_commit(commit)
-
-    result_path = os.path.join(commit_dir_path, f"{repo.owner}-{repo.name}-{commit.sha}")
-
-    if not os.path.isdir(result_path):
-        raise FileNotFoundError(f'commit was not downloaded to {result_path}')
-
-    return os.path.join(commit_dir_path, f"{repo.owner}-{repo.name}-{commit.sha}")
-
-
-def mode(vals: list):
-    counts = {}
-
-    for val in vals:
-        if val not in counts:
-            counts[val] = 1
-        else:
-            counts[val] += 1
-
-    max_count = max(counts.values())
+    """Downloads commit files once, a prefetched download is reused by the run"""
+    # prefetch and the run itself may download the same commit at the same time
+    with commit_download_lock(commit_id):
+        with local_session() as session:
+            account = session.get(Account, account_id)
+            if not account:
+                raise ServerFailure(f"account not found for id: {account_id}")
+
+            commit = session.get(Commit, commit_id)
+            if not commit:
+                raise ServerFailure(f"commit not found for id: {commit_id}")
+
+            entry = session.exec(
+                sqlmodel.select(RunQueueEntry).where(RunQueueEntry.commit_id == commit_id)
+            ).first()
+            if entry is None:
+                raise ServerFailure(f"commit_id={commit_id} is not in the run queue, not downloading it")
+            if entry.download_path is not None and os.path.isdir(entry.download_path):
+                return entry.download_path
+
+            # loads everything the download needs before the session is closed
+            repo = commit.branch.repo
+            git_client = get_git_client(repo)
+
+        commit_dir_path = git_client.download_and_unzip_commit(commit)
+
+        result_path = os.path.join(commit_dir_path, f"{repo.owner}-{repo.name}-{commit.sha}")
+
+        if not os.path.isdir(result_path):
+            raise FileNotFoundError(f'commit was not downloaded to {result_path}')
+
+        with local_session() as session:
+            updated = session.exec(
+                update(RunQueueEntry)
+                .where(RunQueueEntry.commit_id == commit_id)
+                .values(download_path=result_path)
+            )
+            session.commit()
 
-    result = [k for k, v in counts.items() if v == max_count]
+        if updated.rowcount == 0:
+            # the entry was deleted while downloading, so nothing would remove the files later
+            remove_downloads([result_path])
+            raise ServerFailure(f"commit_id={commit_id} left the run queue while it was downloaded")
 
-    return result[0] if len(result) == 1 else result
+    return result_path
 
 
-def save_run_result_and_delete_updates(
+def save_run_result_and_delete_aggregates(
     run_config: RunConfig,
     run_ok: bool,
     err_str: str | None,
-    stdout: str | None,
-    stderr: str | None,
+    stdout: HeadTailLog | None,
+    stderr: HeadTailLog | None,
     is_interrupted: bool
 ):
+    request_metric_buffer_drain(run_config.commit_id)
+
     with local_session() as session:
-        session_updates = session.exec(
-            sqlmodel.select(MetricUpdate)
-            .where(MetricUpdate.commit_id == run_config.commit_id)
-            .order_by(MetricUpdate.created_at)
-        ).all()
+        aggregates = {
+            a.name: a
+            for a in session.exec(
+                sqlmodel.select(MetricAggregate).where(
+                    MetricAggregate.commit_id == run_config.commit_id
+                )
+            ).all()
+        }
 
         result = None
         if run_config.metrics_config is not None:
-            all_metric_vals = {k: [] for k in run_config.metrics_config.keys()}
-
-            for update in session_updates:
-                for k, v in update.data.items():
-                    all_metric_vals[k].append(v)
-
             result = dict()
 
-            for metric_name, metric_vals in all_metric_vals.items():
-                if len(metric_vals) == 0:
+            for metric_name, metric_type in run_config.metrics_config.items():
+                if metric_name not in aggregates:
                     result[metric_name] = None
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.value:
-                    result[metric_name] = metric_vals[-1]
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.max:
-                    result[metric_name] = max(metric_vals)
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.min:
-                    result[metric_name] = min(metric_vals)
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.sum:
-                    result[metric_name] = sum(metric_vals)
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.mean:
-                    result[metric_name] = sum(metric_vals) / len(metric_vals)
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.median:
-                    sorted_vals = sorted(metric_vals)
-                    if len(sorted_vals) % 2:
-                        result[metric_name] = sorted_vals[len(sorted_vals) // 2]
-                    else:
-                        result[metric_name] = (
-                            sorted_vals[len(sorted_vals) // 2]
-                            + sorted_vals[len(sorted_vals) // 2 + 1]
-                        ) / 2
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.count:
-                    result[metric_name] = len(metric_vals)
-                elif run_config.metrics_config[metric_name] == MetricTypeEnum.mode:
-                    result[metric_name] = mode(metric_vals)
-                else:
-                    raise ServerFailure(
-                        f'metric type "{run_config.metrics_config[metric_name]}" is not known'
-                    )
+                    continue
+                result[metric_name] = finalize_metric_aggregate(
+                    aggregates[metric_name], metric_type
+                )
         else:
             logging.debug(
                 f"seems like metrics were not initialized for commit_id={run_config.commit_id}, "
@@ -209,53 +197,31 @@ def save_run_result_and_delete_updates(
         commit.run_ok = run_ok
         commit.processed = True
         commit.run_error = err_str
-        commit.container_stdout = stdout
-        commit.container_stderr = stderr
         commit.run_finished_at = datetime.now()
         commit.is_interrupted = is_interrupted
 
         session.add(commit)
-        for session_update in session_updates:
-            session.delete(session_update)
+        session.flush()
+        fan_out_run_result(commit, commit.branch.repo_id, session)
+        for stream, log in ((LogStreamEnum.stdout, stdout), (LogStreamEnum.stderr, stderr)):
+            if log is not None:
+                save_commit_log(
+                    commit.branch.repo_id, commit.sha, stream, log.getvalue(), log.total_size, session
+                )
+        session.exec(
+            delete(MetricAggregate).where(
+                MetricAggregate.commit_id == run_config.commit_id
+            )
+        )
         session.commit()
 
 
 def register_run_config_with_available_ip_address_for_commit(
     commit_id: int,
 ) -> RunConfig:
-    subnet_str, reserved_ips = get_traig_docker_network_subnet()
-    network = IPv4Network(subnet_str)
-
-    run_config = None
-    with local_session() as session:
-        current_runs = session.exec(sqlmodel.select(RunConfig)).all()
-        reserved_ips.extend([x.client_ip for x in current_runs])
-
-        hosts = network.hosts()
-        next(hosts)  # пропускаем gateway
-        for host in hosts:
-            if str(host) in reserved_ips:
-                continue
-
-            run_config = RunConfig(commit_id=commit_id, client_ip=str(host))
-            session.add(run_config)
-            try:
-                session.commit()
-                session.refresh(run_config)
-            except (
-                sqlalchemy.exc.IntegrityError
-            ):  # если этот адрес стал занят, берем следующий
-                logging.debug(
-                    f"seems like ip {str(host)} is already reserved for some session, wil try other one"
-                )
-                session.rollback()
-                run_config = None
-                continue
-
-            break
+    run_config = lease_ip_for_commit(commit_id)
 
-    if run_config is None:
-        raise ServerFailure("unable to find available ip, will retry later")
+    publish_run_config_invalidation(run_config.client_ip)
 
     return run_config
 
@@ -269,13 +235,14 @@ def execute_compose_in_commit_repo(commit_dir_path: str, commit_id: int):
     with local_session() as session:
         commit = session.get(Commit, commit_id)
         repo = commit.branch.repo
+        commit_sha = commit.sha
 
     run_config = register_run_config_with_available_ip_address_for_commit(commit_id)
 
     run_err, stdout, stderr, is_interrupted = None, None, None, False
     try:
         stdout, stderr, run_err, is_interrupted = run_docker_cmd(
-            commit_dir_path, run_config.client_ip, repo
+            commit_dir_path, run_config.client_ip, repo, commit_sha
         )
     except Exception as e:
         logging.error(f"failed to run container for commit: {e}")
@@ -285,18 +252,32 @@ def execute_compose_in_commit_repo(commit_dir_path: str, commit_id: int):
         run_ok = run_err is None
     logging.debug(f"finished container execution for commit_id={commit_id}")
 
+    client_ip = run_config.client_ip
     with local_session() as session:
         run_config = session.get(RunConfig, run_config.id)
+        if run_config is None:
+            raise ServerFailure(
+                f"ip {client_ip} of commit_id={commit_id} was reclaimed as stale before the run finished"
+            )
 
-        save_run_result_and_delete_updates(run_config, run_ok, run_err, stdout, stderr, is_interrupted)
+        save_run_result_and_delete_aggregates(run_config, run_ok, run_err, stdout, stderr, is_interrupted)
 
         session.delete(run_config)
+        release_ip(client_ip, commit_id, session)
         session.commit()
 
+    publish_run_config_invalidation(client_ip)
+
     shutil.rmtree(commit_dir_path)
 
 
 @app.task
-def create_result_metrics_view(group_result, repo_id: int):
+def finish_commit_run(commit_id: int, repo_id: int):
+    """Last task of a dispatched run, also called when any task of the run fails"""
+    release_run_slot(commit_id)
+
     with local_session() as session:
         create_metrics_view(session.get(Repo, repo_id), session)
+
+    dispatch_runs()
+    detect_change_points(repo_id)
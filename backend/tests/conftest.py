@@ -0,0 +1,15 @@
+import os
+import sys
+
+# backend modules are imported the way the server imports them, from the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# engines are created on import of db, unit tests never connect to them
+for name, value in (
+    ("POSTGRES_HOST", "localhost"),
+    ("POSTGRES_PORT", "5432"),
+    ("POSTGRES_USER", "traig"),
+    ("POSTGRES_PASSWORD", "traig"),
+    ("POSTGRES_DB", "traig"),
+):
+    os.environ.setdefault(name, value)
@@ -0,0 +1,62 @@
+import numpy as np
+from service.change_point import confirm_points, find_change_points, window
+
+
+def analyze_run_by_run(values: np.ndarray) -> tuple[list[int], int]:
+    """Feeds the series one point per run the way detect_change_points does, returns change points and
+    the last decided point.
+
+    Every analysis starts at the first undecided point, or the first point of the series until one is
+    decided, with at most 2 * window points of history before it.
+    """
+    positions, decided = [], None
+    for n in range(1, len(values) + 1):
+        start = 0 if decided is None else decided + 1
+        offset = max(start - 2 * window, 0)
+        found = find_change_points(values[offset:n], start - offset)
+        positions.extend(int(p) + offset for p in found.positions)
+        if found.decided is not None and found.decided >= start - offset:
+            decided = found.decided + offset
+    return positions, decided
+
+
+def step_series(points: int, step_at: int, before: float, after: float, seed: int = 0) -> np.ndarray:
+    noise = np.random.default_rng(seed).normal(0, 1, points)
+    return np.where(np.arange(points) < step_at, before, after) + noise
+
+
+def test_step_is_found_run_by_run():
+    values = step_series(100, 60, before=100, after=120)
+
+    positions, decided = analyze_run_by_run(values)
+
+    assert positions == [60]
+    assert decided == len(values) - confirm_points
+
+
+def test_run_by_run_matches_analysis_of_whole_series():
+    values = np.concatenate(
+        [step_series(50, 50, 100, 100, seed=1), step_series(50, 0, 100, 80, seed=2), step_series(50, 0, 100, 95)]
+    )
+
+    positions, _ = analyze_run_by_run(values)
+
+    assert positions == [50, 100]
+    assert positions == list(find_change_points(values, 0).positions)
+
+
+def test_single_outlier_is_not_a_change_point():
+    values = step_series(60, 60, before=100, after=100)
+    values[30] = 150
+
+    positions, decided = analyze_run_by_run(values)
+
+    assert positions == []
+    assert decided == len(values) - confirm_points
+
+
+def test_short_series_is_decided_without_change_points():
+    found = find_change_points(np.array([1.0, 2.0, 30.0, 30.0]), 0)
+
+    assert found.decided == 1
+    assert len(found.positions) == 0
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from git.github import GithubClient
+from model import Branch, Repo
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, data=None, links: dict = None):
+        self.status_code = status_code
+        self.data = data
+        self.links = links or {}
+        self.headers = {}
+        self.text = ""
+
+    def json(self):
+        return self.data
+
+
+class FakeGithub:
+    """Answers /commits and /compare of one repo from a commit graph, like github does.
+
+    /commits lists ancestors of a sha newest first by date, /compare lists commits reachable from head
+    and not from base oldest first.
+    """
+
+    def __init__(self):
+        self.started = datetime(2023, 1, 1)
+        self.commits: dict[str, tuple[datetime, list[str]]] = {}
+        self.requests: list[str] = []
+
+    def commit(self, sha: str, minutes: int, *parents: str) -> str:
+        self.commits[sha] = (self.started + timedelta(minutes=minutes), list(parents))
+        return sha
+
+    def ancestors(self, sha: str) -> set[str]:
+        seen, stack = set(), [sha]
+        while stack:
+            current = stack.pop()
+            if current not in seen:
+                seen.add(current)
+                stack.extend(self.commits[current][1])
+        return seen
+
+    def _item(self, sha: str) -> dict:
+        return {"sha": sha, "commit": {"committer": {"date": self.commits[sha][0].isoformat() + "Z"}, "message": sha}}
+
+    def get(self, url: str, params: dict = None, **kwargs) -> FakeResponse:
+        parsed = urlparse(url)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        query.update(params or {})
+        per_page, page = int(query.get("per_page", 30)), int(query.get("page", 1))
+        self.requests.append(parsed.path)
+
+        if "/compare/" in parsed.path:
+            base, head = parsed.path.rsplit("/", 1)[1].split("...")
+            if base not in self.commits:
+                return FakeResponse(404)
+            shas = sorted(self.ancestors(head) - self.ancestors(base), key=lambda s: self.commits[s][0])
+            status = "ahead" if base in self.ancestors(head) else "diverged"
+            items = [self._item(s) for s in shas[(page - 1) * per_page:page * per_page]]
+            return FakeResponse(200, {"status": status, "total_commits": len(shas), "commits": items})
+
+        shas = sorted(self.ancestors(query["sha"]), key=lambda s: self.commits[s][0], reverse=True)
+        items = [self._item(s) for s in shas[(page - 1) * per_page:page * per_page]]
+        links = {}
+        if page * per_page < len(shas):
+            links["next"] = {"url": f"{url.split('?')[0]}?sha={query['sha']}&per_page={per_page}&page={page + 1}"}
+        return FakeResponse(200, items, links)
+
+
+@pytest.fixture
+def github():
+    return FakeGithub()
+
+
+@pytest.fixture
+def client(github):
+    client = GithubClient("-", api_url="https://github.test", http_session=github)
+    client.rate_limiter = mock.Mock()
+    return client
+
+
+@pytest.fixture
+def repo():
+    return Repo(id=1, owner="traig", name="bench", account_id=1)
+
+
+def new_commits(client, repo, head: str, known_sha: str = None) -> list[str]:
+    branch = Branch(id=1, name="main", sha=head, repo_id=repo.id)
+    return [c.sha for c in client.get_branch_commits(repo, branch, known_sha=known_sha)]
+
+
+def test_merged_commits_older_than_known_head_are_found(github, client, repo):
+    root = github.commit("root", 0)
+    # a side branch, never polled, with commits older than the known head of main
+    side_1 = github.commit("side-1", 1, root)
+    side_2 = github.commit("side-2", 2, side_1)
+    known = github.commit("known", 5, root)
+    after = github.commit("after", 6, known)
+    merge = github.commit("merge", 7, after, side_2)
+
+    assert new_commits(client, repo, merge, known_sha=known) == [side_1, side_2, after, merge]
+
+
+def test_force_push_takes_commits_since_merge_base(github, client, repo):
+    root = github.commit("root", 0)
+    github.commit("rewritten", 1, root)
+    amended = github.commit("amended", 2, root)
+
+    assert new_commits(client, repo, amended, known_sha="rewritten") == [amended]
+
+
+def test_known_head_removed_from_github_falls_back_to_walk(github, client, repo, monkeypatch):
+    monkeypatch.setenv("GIT_MAX_NEW_COMMITS", "2")
+    root = github.commit("root", 0)
+    first = github.commit("first", 1, root)
+    second = github.commit("second", 2, first)
+
+    assert new_commits(client, repo, second, known_sha="collected") == [first, second]
+
+
+def test_only_pages_with_newest_commits_are_compared(github, client, repo, monkeypatch):
+    monkeypatch.setenv("GIT_MAX_NEW_COMMITS", "120")
+    shas = [github.commit("known", 0)]
+    for i in range(1, 251):
+        shas.append(github.commit(f"c{i}", i, shas[-1]))
+
+    assert new_commits(client, repo, shas[-1], known_sha="known") == shas[-120:]
+    # the first page for the total, then the pages of commits 130..250
+    assert len(github.requests) == 3
+
+
+def test_new_branch_is_walked_from_head(github, client, repo, monkeypatch):
+    monkeypatch.setenv("GIT_INITIAL_COMMITS_LIMIT", "150")
+    shas = [github.commit("c0", 0)]
+    for i in range(1, 200):
+        shas.append(github.commit(f"c{i}", i, shas[-1]))
+
+    assert new_commits(client, repo, shas[-1]) == shas[-150:]
+    assert all(path.endswith("/commits") for path in github.requests)
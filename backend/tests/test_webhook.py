@@ -0,0 +1,205 @@
+import contextlib
+import copy
+import hashlib
+import hmac
+import json
+import os
+from unittest import mock
+
+import pytest
+from exception import ClientFailure
+from model import Branch, Repo
+from service import webhook
+
+SECRET = "4f1c2d9e8b7a6f5e4d3c2b1a0f9e8d7c6b5a4f3e"
+
+with open(os.path.join(os.path.dirname(__file__), "data", "github_push.json"), "rb") as f:
+    # body of a push delivery as github sends it, signatures are computed over these bytes
+    PUSH_BODY = f.read()
+PUSH = json.loads(PUSH_BODY)
+
+
+def sign(body: bytes, secret: str = SECRET) -> str:
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def repo():
+    return Repo(id=7, owner="traig-dev", name="bench-target", account_id=1, webhook_secret=SECRET)
+
+
+@pytest.fixture
+def session():
+    return mock.MagicMock()
+
+
+@pytest.fixture
+def repo_service():
+    """Database side of applying a push and the fallback poll, as mocks"""
+    with mock.patch.multiple(
+        webhook,
+        upsert_branch_heads=mock.DEFAULT,
+        insert_branch_commits=mock.DEFAULT,
+        enqueue_new_commits=mock.DEFAULT,
+        request_webhook_fallback_check=mock.DEFAULT,
+        reschedule_check_commits_job=mock.DEFAULT,
+    ) as mocks:
+        mocks["upsert_branch_heads"].return_value = {"main": 11}
+        yield mocks
+
+
+def stored_branch(session, sha):
+    """Head of the pushed branch as stored before the delivery, None for a branch not stored yet"""
+    branch = None if sha is None else Branch(id=11, name="main", sha=sha, repo_id=7)
+    session.exec.return_value.first.return_value = branch
+
+
+def assert_polled_instead(repo, repo_service):
+    repo_service["request_webhook_fallback_check"].assert_called_once_with(repo)
+    repo_service["upsert_branch_heads"].assert_not_called()
+    repo_service["insert_branch_commits"].assert_not_called()
+    repo_service["enqueue_new_commits"].assert_not_called()
+
+
+def test_signature_of_recorded_delivery():
+    signature = sign(PUSH_BODY)
+
+    assert webhook.signature_matches(SECRET, PUSH_BODY, signature)
+    assert not webhook.signature_matches("another secret", PUSH_BODY, signature)
+    assert not webhook.signature_matches(SECRET, PUSH_BODY.replace(b"main", b"evil"), signature)
+    assert not webhook.signature_matches(SECRET, PUSH_BODY, signature.replace("sha256=", "sha1="))
+    assert not webhook.signature_matches(SECRET, PUSH_BODY, None)
+    assert not webhook.signature_matches(None, PUSH_BODY, signature)
+
+
+@contextlib.contextmanager
+def delivery_session(repos):
+    session = mock.MagicMock()
+    session.exec.return_value.all.return_value = repos
+
+    @contextlib.contextmanager
+    def local_session():
+        yield session
+
+    with mock.patch.object(webhook, "local_session", local_session), mock.patch.object(
+        webhook, "_apply_push"
+    ) as apply_push:
+        yield apply_push
+
+
+def test_delivery_is_applied_to_repos_whose_secret_signed_it(repo, repo_service):
+    other_account_repo = Repo(id=8, owner="Traig-Dev", name="bench-target", account_id=2, webhook_secret="other")
+
+    with delivery_session([repo, other_account_repo]) as apply_push:
+        applied = webhook.handle_github_event("push", PUSH_BODY, sign(PUSH_BODY))
+
+    assert applied == 1
+    apply_push.assert_called_once_with(repo, PUSH, mock.ANY)
+    assert repo.webhook_received_at is not None
+    # polling of the repo slows down once webhooks are known to arrive
+    repo_service["reschedule_check_commits_job"].assert_called_once_with(repo)
+
+
+@pytest.mark.parametrize(
+    "signature",
+    [None, sign(PUSH_BODY, "wrong secret"), sign(PUSH_BODY.replace(b"0d1a26e6", b"0d1a26e7"))],
+)
+def test_delivery_with_wrong_signature_is_rejected(repo, repo_service, signature):
+    with delivery_session([repo]) as apply_push:
+        with pytest.raises(ClientFailure):
+            webhook.handle_github_event("push", PUSH_BODY, signature)
+
+    apply_push.assert_not_called()
+    assert repo.webhook_received_at is None
+
+
+def test_fast_forward_push_is_applied_from_payload(repo, session, repo_service):
+    stored_branch(session, PUSH["before"])
+
+    webhook._apply_push(repo, PUSH, session)
+
+    (repo_id, branches, _), _ = repo_service["upsert_branch_heads"].call_args
+    assert repo_id == 7
+    assert [(b.name, b.sha) for b in branches] == [("main", PUSH["after"])]
+
+    (branch_ids, branch_commits, _), _ = repo_service["insert_branch_commits"].call_args
+    assert branch_ids == {"main": 11}
+    assert [(c.sha, c.message) for c in branch_commits["main"]] == [
+        ("9f5d3b8c2a41e6f07b12c4d8e9a0b3c5d7e1f248", "Cache parsed config between runs"),
+        ("0d1a26e67d8f5eaf1f6ba5c57fc3c7d91ac0fd1c", "Report cache hit ratio to traig"),
+    ]
+    assert branch_commits["main"][-1].committed_datetime.isoformat() == "2023-03-14T13:28:17+03:00"
+
+    session.commit.assert_called_once()
+    repo_service["enqueue_new_commits"].assert_called_once_with(repo, session)
+    repo_service["request_webhook_fallback_check"].assert_not_called()
+
+
+def test_push_already_stored_by_a_poll_is_ignored(repo, session, repo_service):
+    stored_branch(session, PUSH["after"])
+
+    webhook._apply_push(repo, PUSH, session)
+
+    repo_service["upsert_branch_heads"].assert_not_called()
+    repo_service["request_webhook_fallback_check"].assert_not_called()
+    repo_service["enqueue_new_commits"].assert_not_called()
+
+
+def test_new_branch_is_polled(repo, session, repo_service):
+    push = {**PUSH, "ref": "refs/heads/feature", "before": "0" * 40, "created": True}
+    stored_branch(session, None)
+
+    webhook._apply_push(repo, push, session)
+
+    assert_polled_instead(repo, repo_service)
+
+
+def test_force_push_is_polled(repo, session, repo_service):
+    push = {**PUSH, "forced": True}
+    stored_branch(session, PUSH["before"])
+
+    webhook._apply_push(repo, push, session)
+
+    assert_polled_instead(repo, repo_service)
+
+
+def test_push_after_missed_delivery_is_polled(repo, session, repo_service):
+    # the stored head is older than before of the delivery, commits in between are not in the payload
+    stored_branch(session, "c2b6f1e0a9d8c7b6a5f4e3d2c1b0a9f8e7d6c5b4")
+
+    webhook._apply_push(repo, PUSH, session)
+
+    assert_polled_instead(repo, repo_service)
+
+
+def test_truncated_commit_list_is_polled(repo, session, repo_service, monkeypatch):
+    # github sends at most 2048 commits of a push, more new commits than that are taken from a branch
+    monkeypatch.setenv("GIT_MAX_NEW_COMMITS", "5000")
+    push = copy.deepcopy(PUSH)
+    head = push["commits"][-1]
+    push["commits"] = [{**head, "id": f"{i:040x}"} for i in range(2047)] + [head]
+    stored_branch(session, PUSH["before"])
+
+    webhook._apply_push(repo, push, session)
+
+    assert_polled_instead(repo, repo_service)
+
+
+def test_commit_list_without_head_is_polled(repo, session, repo_service):
+    push = {**PUSH, "commits": PUSH["commits"][:1]}
+    stored_branch(session, PUSH["before"])
+
+    webhook._apply_push(repo, push, session)
+
+    assert_polled_instead(repo, repo_service)
+
+
+@pytest.mark.parametrize(
+    "change", [{"ref": "refs/tags/v1.0"}, {"deleted": True, "after": "0" * 40, "commits": []}]
+)
+def test_tags_and_deleted_branches_are_ignored(repo, session, repo_service, change):
+    webhook._apply_push(repo, {**PUSH, **change}, session)
+
+    session.exec.assert_not_called()
+    repo_service["request_webhook_fallback_check"].assert_not_called()
+    repo_service["upsert_branch_heads"].assert_not_called()
@@ -0,0 +1,46 @@
+"""Reporting metrics from inside a container run by Traig.
+
+    import traig
+
+    traig.init({"latency": "median", "requests": "count"})
+    for ...:
+        traig.update({"latency": elapsed, "requests": 1})
+
+Outside of a Traig run (TRAIG_SESSION is not "1") every call is a no-op.
+Updates are buffered and sent in batches by a background thread, pending ones are flushed at exit.
+With TRAIG_TRANSPORT=udp every update is sent right away as a datagram to TRAIG_UDP_PORT instead,
+which is cheaper but lossy and needs the server to listen with METRIC_UDP_PORT.
+"""
+import os
+
+from traig.client import Client, UdpClient
+
+__all__ = ["Client", "UdpClient", "init", "update", "flush"]
+
+_client = None
+
+
+def init(metrics, server_url=None):
+    """Declares metrics as {name: type}, type is one of value, max, min, sum, mean, mode, median, count"""
+    global _client
+    if os.getenv("TRAIG_SESSION") != "1":
+        return
+    if _client is None:
+        server_url = server_url or os.getenv("TRAIG_SERVER_URL", "http://traigserver.io")
+        if os.getenv("TRAIG_TRANSPORT") == "udp":
+            _client = UdpClient(server_url, int(os.getenv("TRAIG_UDP_PORT", "8125")))
+        else:
+            _client = Client(server_url)
+    _client.init(metrics)
+
+
+def update(data):
+    """Queues {name: value} update, returns immediately"""
+    if _client is not None:
+        _client.update(data)
+
+
+def flush():
+    """Blocks until every queued update is sent"""
+    if _client is not None:
+        _client.flush()
@@ -0,0 +1,126 @@
+import atexit
+import collections
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+import urllib.parse
+
+logger = logging.getLogger("traig")
+
+
+class Client:
+    """Keeps one HTTP connection to the server and sends queued updates from a background thread"""
+
+    def __init__(self, server_url, flush_interval=None, batch_size=None):
+        url = urllib.parse.urlsplit(server_url)
+        connection_class = (
+            http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        )
+        self._connection_factory = lambda: connection_class(url.hostname, url.port, timeout=10)
+        self._path_prefix = url.path.rstrip("/")
+        self._connection = None
+        self._connection_lock = threading.Lock()
+        # pops and sends happen under one lock, so batches reach the server in update order
+        self._send_lock = threading.Lock()
+
+        self.flush_interval = flush_interval or float(os.getenv("TRAIG_FLUSH_INTERVAL", "0.2"))
+        self.batch_size = batch_size or int(os.getenv("TRAIG_BATCH_SIZE", "1000"))
+
+        # deque.append is atomic, so update() needs no lock
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def _post(self, path, payload):
+        body = json.dumps(payload).encode("utf-8")
+        with self._connection_lock:
+            for attempt in range(2):
+                try:
+                    if self._connection is None:
+                        self._connection = self._connection_factory()
+                    self._connection.request(
+                        "POST",
+                        self._path_prefix + path,
+                        body=body,
+                        headers={"Content-Type": "application/json"},
+                    )
+                    response = self._connection.getresponse()
+                    text = response.read()
+                    if response.status != 200:
+                        logger.warning("traig server returned %s on %s: %s", response.status, path, text)
+                    return response.status == 200
+                except (http.client.HTTPException, OSError) as e:
+                    # connection may have been closed by the server while idle, reconnect once
+                    if self._connection is not None:
+                        self._connection.close()
+                    self._connection = None
+                    if attempt == 1:
+                        logger.warning("failed to send to traig server %s: %s", path, e)
+            return False
+
+    def init(self, metrics):
+        self._post("/metric/init", {"data": metrics})
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="traig-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def update(self, data):
+        self._queue.append(data)
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _send_pending(self):
+        with self._send_lock:
+            while self._queue:
+                batch = []
+                while self._queue and len(batch) < self.batch_size:
+                    batch.append({"data": self._queue.popleft()})
+                self._post("/metric/update/batch", batch)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._send_pending()
+
+    def flush(self):
+        self._send_pending()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval * 2)
+        self._send_pending()
+        with self._connection_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class UdpClient(Client):
+    """Declares metrics over HTTP, then sends every update as fire-and-forget "name:value" datagrams"""
+
+    def __init__(self, server_url, udp_port):
+        super().__init__(server_url)
+        host = urllib.parse.urlsplit(server_url).hostname
+        self._address = socket.getaddrinfo(host, udp_port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def init(self, metrics):
+        self._post("/metric/init", {"data": metrics})
+
+    def update(self, data):
+        payload = "\n".join(f"{name}:{value}" for name, value in data.items()).encode("utf-8")
+        try:
+            self._socket.sendto(payload, self._address)
+        except OSError:
+            pass
+
+    def flush(self):
+        pass
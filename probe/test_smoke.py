@@ -51,7 +51,18 @@ def create_repo(client: PrefixUrlHttpSession) -> dict:
 
 
 def get_statistics(client: PrefixUrlHttpSession, repo_id: int) -> list[dict]:
-    return client.get(f"statistics/{repo_id}").json()
+    fields = "sha,message,processed,run_ok,json_run_result"
+    stats, params = [], {"fields": fields}
+    while True:
+        response = client.get(f"statistics/{repo_id}", params=params)
+        stats.extend(response.json())
+        if "X-Next-Cursor" not in response.headers:
+            return stats
+        params = {"fields": fields, "cursor": response.headers["X-Next-Cursor"]}
+
+
+def get_commit_stdout(client: PrefixUrlHttpSession, repo_id: int, sha: str) -> str:
+    return client.get(f"statistics/{repo_id}/logs/{sha}/stdout").text
 
 
 def test_smoke(client, email):
@@ -85,4 +96,4 @@ def test_smoke(client, email):
 
     commit_to_test = [c for c in get_statistics(client, repo["id"]) if c['message'] == 'added print'][0]
 
-    assert commit_to_test['container_stdout'].strip() == 'test!'
+    assert get_commit_stdout(client, repo["id"], commit_to_test['sha']).strip() == 'test!'